@@ -0,0 +1,281 @@
+"""
+Admission control of the classifications. Every model has a limit of
+concurrent classifications and a bounded queue, so that a burst of
+requests for a slow model (vgg16) cannot fill the inference pool and
+starve the other models and endpoints. A request is queued only if the
+wait that it can expect, estimated from the recent classification times
+of the model, stays within the latency objective of the model, and it
+never waits longer than that objective.
+
+A request that is not admitted is degraded according to
+conf.admission_degrade: it is answered with the cached result of the
+requested model if there is one ("cache"), or classified by the faster
+conf.admission_fallback_model ("fallback") if that model is within its
+own budget. Otherwise it is rejected with ServiceOverloaded (503). The
+model that actually answered and the degradation are reported to the
+client in the X-Served-Model and X-Degraded headers.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import threading
+import time
+
+from app.config import Configuration
+from app.executors import ServiceOverloaded, codec_pool, inference_pool
+from app.startup import cached_classification, classify_image
+
+
+conf = Configuration()
+
+# weight of the latest classification time in the moving average
+EWMA_WEIGHT = 0.2
+
+
+class ModelLimiter:
+    """Limits the concurrent classifications of a model, with a queue
+    bounded in length and in expected wait. Slots are taken from the
+    event loop by the requests and from worker threads by the jobs; the
+    waiters are concurrent futures, which both can wait for."""
+
+    def __init__(self, name, max_concurrent, max_queued, slo_ms, retry_after=1):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.slo = slo_ms / 1000
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._waiters = collections.deque()
+        self.running = 0
+        # moving average of the classification time, in seconds
+        self.service_time = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def expected_wait(self):
+        """Returns the time that a new request would wait for a slot. Must
+        be called holding the lock."""
+        if self.running < self.max_concurrent:
+            return 0.0
+        rounds = (len(self._waiters) + 1) / self.max_concurrent
+        return rounds * self.service_time
+
+    def _enter(self):
+        """Takes a free slot and returns True, returns False if the queue is
+        over budget, or queues and returns a waiter."""
+        with self._lock:
+            if self.running < self.max_concurrent and not self._waiters:
+                self.running += 1
+                self.admitted += 1
+                return True
+            if len(self._waiters) >= self.max_queued or self.expected_wait() > self.slo:
+                self.rejected += 1
+                return False
+            waiter = concurrent.futures.Future()
+            self._waiters.append(waiter)
+            return waiter
+
+    def _leave(self, waiter):
+        """Ends the wait of a waiter and returns True if it was handed a
+        slot, otherwise withdraws it from the queue."""
+        with self._lock:
+            if waiter.done():
+                self.admitted += 1
+                return True
+            waiter.cancel()
+            self._waiters.remove(waiter)
+            self.timed_out += 1
+            self.rejected += 1
+            return False
+
+    async def acquire(self):
+        """Waits for a slot and returns True, or returns False at once if
+        the queue is over budget, or after waiting for the latency
+        objective of the model."""
+        waiter = self._enter()
+        if not isinstance(waiter, concurrent.futures.Future):
+            return waiter
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(waiter)), self.slo)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # the slot may have been handed over just before
+            if self._leave(waiter):
+                self.release()
+            raise
+        return self._leave(waiter)
+
+    def acquire_blocking(self):
+        """Like acquire, from a worker thread."""
+        waiter = self._enter()
+        if not isinstance(waiter, concurrent.futures.Future):
+            return waiter
+        with contextlib.suppress(concurrent.futures.TimeoutError):
+            waiter.result(self.slo)
+        return self._leave(waiter)
+
+    def release(self, duration=None):
+        """Frees a slot, handing it over to the first waiting request, and
+        records the classification time, if given."""
+        with self._lock:
+            if duration is not None:
+                if self.service_time:
+                    self.service_time += EWMA_WEIGHT * (duration - self.service_time)
+                else:
+                    self.service_time = duration
+            if self._waiters:
+                # the running count is unchanged: the slot changes hands
+                self._waiters.popleft().set_result(True)
+            else:
+                self.running -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Holds a slot of the model, or raises ServiceOverloaded. The time
+        spent holding it is not recorded, since it may cover other work
+        than the classification by this model (e.g. a whole ensemble)."""
+        if not await self.acquire():
+            raise ServiceOverloaded("model " + self.name, self.retry_after)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        """Returns the limiter counters as a dictionary."""
+        with self._lock:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "max_queued": self.max_queued,
+                "slo_ms": self.slo * 1000,
+                "running": self.running,
+                "queued": len(self._waiters),
+                "service_time_ms": self.service_time * 1000,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+            }
+
+
+class AdmissionController:
+    """The limiters of the models, with the degradation policy applied
+    to the requests that they do not admit."""
+
+    def __init__(self, defaults, limits, degrade=(), fallback_model=None, retry_after=1):
+        self.defaults = dict(defaults)
+        self.limits = dict(limits)
+        self.degrade = tuple(degrade)
+        self.fallback_model = fallback_model
+        self.retry_after = retry_after
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self.degraded = collections.Counter()
+
+    def limiter(self, model_id):
+        """Returns the limiter of a model, created on first use."""
+        if model_id not in conf.models:
+            raise ValueError("Unknown model {}".format(model_id))
+        with self._lock:
+            if model_id not in self._limiters:
+                limits = {**self.defaults, **self.limits.get(model_id, {})}
+                self._limiters[model_id] = ModelLimiter(
+                    model_id, retry_after=self.retry_after, **limits
+                )
+            return self._limiters[model_id]
+
+    def slot(self, model_id):
+        """Returns an async context manager holding a slot of a model."""
+        return self.limiter(model_id).slot()
+
+    @contextlib.contextmanager
+    def wait_slot(self, model_id, check=None):
+        """Holds a slot of a model from a worker thread (a job), which is
+        not degraded but waits for its turn, calling check() between the
+        attempts; check may raise to give up. Like slot(), the time is not
+        recorded, since a job may classify a whole chunk of images."""
+        limiter = self.limiter(model_id)
+        while not limiter.acquire_blocking():
+            if check is not None:
+                check()
+            time.sleep(self.retry_after)
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    async def classify(self, model_id, img_id, custom_img_id=None):
+        """Classifies an image with model_id within its budget, degrading
+        the request if the model is over budget. Returns the scores and
+        a dictionary with the model that answered and the degradation
+        ("cache", "fallback" or None)."""
+        limiter = self.limiter(model_id)
+        if await limiter.acquire():
+            start = time.perf_counter()
+            try:
+                scores = await inference_pool.run(
+                    classify_image, model_id=model_id, img_id=img_id, custom_img_id=custom_img_id
+                )
+            finally:
+                limiter.release(time.perf_counter() - start)
+            return scores, {"model": model_id, "degraded": None}
+
+        if "cache" in self.degrade:
+            scores = await codec_pool.run(cached_classification, model_id, img_id, custom_img_id)
+            if scores is not None:
+                self._count("cache")
+                return scores, {"model": model_id, "degraded": "cache"}
+
+        fallback = self.fallback_model
+        if "fallback" in self.degrade and fallback is not None and fallback != model_id:
+            fallback_limiter = self.limiter(fallback)
+            if await fallback_limiter.acquire():
+                start = time.perf_counter()
+                try:
+                    scores = await inference_pool.run(
+                        classify_image, model_id=fallback, img_id=img_id, custom_img_id=custom_img_id
+                    )
+                finally:
+                    fallback_limiter.release(time.perf_counter() - start)
+                self._count("fallback")
+                return scores, {"model": fallback, "degraded": "fallback"}
+
+        raise ServiceOverloaded("model " + model_id, self.retry_after)
+
+    def _count(self, kind):
+        with self._lock:
+            self.degraded[kind] += 1
+
+    def stats(self):
+        """Returns the counters of every limiter and of the degraded requests."""
+        with self._lock:
+            limiters = list(self._limiters.values())
+            degraded = dict(self.degraded)
+        return {
+            "models": {limiter.name: limiter.stats() for limiter in limiters},
+            "degraded": degraded,
+        }
+
+
+def served_headers(served):
+    """Returns the headers reporting the model that answered a request
+    and its degradation."""
+    headers = {"X-Served-Model": served["model"]}
+    if served["degraded"] is not None:
+        headers["X-Degraded"] = served["degraded"]
+    return headers
+
+
+admission = AdmissionController(
+    defaults={
+        "max_concurrent": conf.model_max_concurrent,
+        "max_queued": conf.model_max_queued,
+        "slo_ms": conf.model_latency_slo_ms,
+    },
+    limits=conf.model_limits,
+    degrade=conf.admission_degrade,
+    fallback_model=conf.admission_fallback_model,
+    retry_after=conf.retry_after_seconds,
+)
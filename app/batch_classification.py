@@ -0,0 +1,98 @@
+import asyncio
+import json
+from typing import List
+
+from fastapi import APIRouter, File, Form, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from app.admission import admission
+from app.config import Configuration
+from app.executors import codec_pool, inference_pool
+from app.startup import classify_images
+from app.uploads import UploadError, decode_image, read_upload
+from app.catalog import catalog
+
+router = APIRouter()
+
+
+@router.post("/batch_classifications")
+async def batch_classification(
+    model_ids: List[str] = Form(...),
+    image_ids: List[str] = Form([]),
+    files: List[UploadFile] = File([]),
+):
+    """
+    Classifies many images with many models in a single call.
+
+    Args:
+        model_ids (List[str]): The models to use, among the configured ones.
+        image_ids (List[str]): The gallery images to classify.
+        files (List[UploadFile]): Additional uploaded images to classify.
+
+    Returns:
+        StreamingResponse: One JSON object per line (NDJSON) for each
+        (image, model) pair, in the order in which they are completed.
+    """
+    unknown_models = [m for m in model_ids if m not in Configuration.models]
+    if unknown_models:
+        return JSONResponse(
+            status_code=400, content={"error": f"Unknown models: {unknown_models}"}
+        )
+
+    # items are (name, image), where image is a gallery id or a PIL image
+    items = []
+    errors = []
+    for image_id in image_ids:
+        if image_id in catalog:
+            items.append((image_id, image_id))
+        else:
+            errors.append({"image_id": image_id, "error": "Image not found"})
+    for file in files:
+        try:
+            contents, _ = await read_upload(file)
+            items.append((file.filename, await codec_pool.run(decode_image, contents)))
+        except UploadError as e:
+            errors.append({"image_id": file.filename, "error": str(e)})
+
+    # chunks are submitted a few at a time, not to fill the inference pool,
+    # and at most as many per model as the model admits at once; each chunk
+    # holds a slot of its model, and is rejected if the model is overloaded
+    slots = asyncio.Semaphore(Configuration.inference_workers)
+    model_slots = {
+        model_id: asyncio.Semaphore(admission.limiter(model_id).max_concurrent)
+        for model_id in model_ids
+    }
+
+    async def classify_chunk(model_id, chunk):
+        images = [image for _, image in chunk]
+        try:
+            async with slots, model_slots[model_id], admission.slot(model_id):
+                scores = await inference_pool.run(classify_images, model_id, images)
+        except Exception as e:
+            return [
+                {"image_id": name, "model_id": model_id, "error": str(e)}
+                for name, _ in chunk
+            ]
+        return [
+            {"image_id": name, "model_id": model_id, "classification_scores": s}
+            for (name, _), s in zip(chunk, scores)
+        ]
+
+    async def results():
+        for error in errors:
+            yield json.dumps(error) + "\n"
+        size = Configuration.batch_max_size
+        tasks = [
+            asyncio.ensure_future(classify_chunk(model_id, items[i:i + size]))
+            for model_id in model_ids
+            for i in range(0, len(items), size)
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                for line in await task:
+                    yield json.dumps(line) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
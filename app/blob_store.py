@@ -0,0 +1,209 @@
+"""
+Short-lived server-side store of the uploaded and transformed images.
+Images are kept under an opaque ID and served from /blobs/{id}, so that
+pages can reference them instead of embedding them as base64 data URLs,
+and the download endpoints can receive the ID instead of the image.
+Blobs are kept in memory up to a size cap and for a limited time; when
+the cap is exceeded the oldest blobs are evicted, or moved to a
+temporary directory if spilling to disk is enabled. When the service
+runs in several worker processes, blobs are also written to a directory
+shared by the workers, so that any worker can serve them.
+"""
+import hashlib
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse, Response
+
+from app.config import Configuration
+from app.http_cache import is_fresh
+
+
+conf = Configuration()
+router = APIRouter()
+
+BLOB_PREFIX = "blob_"
+
+
+class Blob:
+    """An image stored in the blob store."""
+
+    def __init__(self, data, media_type, expires, etag=None):
+        self.data = data
+        self.media_type = media_type
+        self.etag = etag or '"{}"'.format(hashlib.sha256(data).hexdigest())
+        self.expires = expires
+
+
+class BlobStore:
+    """Keeps blobs in memory, up to max_bytes in total, for ttl seconds.
+    If spill_dir is given, blobs evicted from memory are moved there
+    until they expire. If shared_dir is given, every blob is also
+    written there, and blobs stored by other processes are read from it."""
+
+    def __init__(self, max_bytes, ttl, spill_dir=None, shared_dir=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self.shared_dir = shared_dir
+        self._memory = OrderedDict()
+        self._spilled = {}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._shared_swept = time.monotonic()
+
+    @staticmethod
+    def is_blob_id(value):
+        return isinstance(value, str) and value.startswith(BLOB_PREFIX)
+
+    def put(self, data, media_type):
+        """Stores data and returns the ID of the new blob."""
+        blob_id = BLOB_PREFIX + secrets.token_urlsafe(16)
+        blob = Blob(data, media_type, time.monotonic() + self.ttl)
+        if self.shared_dir is not None:
+            self._write_shared(blob_id, blob)
+        with self._lock:
+            self._expire()
+            self._memory[blob_id] = blob
+            self._nbytes += len(data)
+            while self._nbytes > self.max_bytes and len(self._memory) > 1:
+                old_id, old_blob = self._memory.popitem(last=False)
+                self._nbytes -= len(old_blob.data)
+                self._spill(old_id, old_blob)
+        return blob_id
+
+    def get(self, blob_id):
+        """Returns the blob with the given ID, or None if it does not
+        exist or has expired."""
+        with self._lock:
+            blob = self._memory.get(blob_id)
+            if blob is None and blob_id in self._spilled:
+                blob = self._load_spilled(blob_id)
+        if blob is None and self.shared_dir is not None and self.is_blob_id(blob_id):
+            blob = self._load_shared(blob_id)
+        if blob is None or blob.expires < time.monotonic():
+            return None
+        return blob
+
+    def _spill(self, blob_id, blob):
+        """Moves a blob evicted from memory to the spill directory, if any.
+        Must be called holding the store lock."""
+        if self.spill_dir is None:
+            return
+        path = os.path.join(self.spill_dir, blob_id)
+        with open(path, "wb") as f:
+            f.write(blob.data)
+        self._spilled[blob_id] = (path, blob.media_type, blob.etag, blob.expires)
+
+    def _load_spilled(self, blob_id):
+        path, media_type, etag, expires = self._spilled[blob_id]
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        return Blob(data, media_type, expires, etag)
+
+    def _write_shared(self, blob_id, blob):
+        """Writes a blob to the shared directory; its metadata is written
+        last, so that other processes never read a partial blob. The
+        expiration time is stored as wall-clock time."""
+        path = os.path.join(self.shared_dir, blob_id)
+        with open(path + ".tmp", "wb") as f:
+            f.write(blob.data)
+        os.replace(path + ".tmp", path)
+        meta = {"media_type": blob.media_type, "etag": blob.etag, "expires": time.time() + self.ttl}
+        with open(path + ".json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".json.tmp", path + ".json")
+
+    def _load_shared(self, blob_id):
+        path = os.path.join(self.shared_dir, os.path.basename(blob_id))
+        try:
+            with open(path + ".json") as f:
+                meta = json.load(f)
+            with open(path, "rb") as f:
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+        expires = time.monotonic() + meta["expires"] - time.time()
+        return Blob(data, meta["media_type"], expires, meta["etag"])
+
+    def _sweep_shared(self):
+        """Removes the expired blobs from the shared directory, at most
+        once a minute. Must be called holding the store lock."""
+        if self.shared_dir is None or time.monotonic() - self._shared_swept < 60:
+            return
+        self._shared_swept = time.monotonic()
+        now = time.time()
+        for name in os.listdir(self.shared_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.shared_dir, name)
+            try:
+                with open(path) as f:
+                    expired = json.load(f)["expires"] < now
+                if expired:
+                    os.remove(path)
+                    os.remove(path[:-len(".json")])
+            except (OSError, ValueError, KeyError):
+                pass
+
+    def _expire(self):
+        """Drops the expired blobs. Must be called holding the store lock."""
+        now = time.monotonic()
+        # blobs are inserted in expiration order, since the ttl is fixed
+        while self._memory:
+            blob_id, blob = next(iter(self._memory.items()))
+            if blob.expires >= now:
+                break
+            del self._memory[blob_id]
+            self._nbytes -= len(blob.data)
+        for blob_id, (path, _, _, expires) in list(self._spilled.items()):
+            if expires < now:
+                del self._spilled[blob_id]
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self._sweep_shared()
+
+    def stats(self):
+        """Returns the store counters as a dictionary."""
+        with self._lock:
+            return {
+                "blobs": len(self._memory),
+                "nbytes": self._nbytes,
+                "spilled": len(self._spilled),
+            }
+
+
+blob_store = BlobStore(
+    max_bytes=conf.blob_max_bytes,
+    ttl=conf.blob_ttl_seconds,
+    spill_dir=tempfile.mkdtemp(prefix="blobs-") if conf.blob_spill_to_disk else None,
+    shared_dir=conf.blob_shared_dir,
+)
+
+
+@router.get("/blobs/{blob_id}", name="get_blob")
+def get_blob(blob_id: str, request: Request):
+    """Serves a stored image, answering conditional requests with 304."""
+    blob = blob_store.get(blob_id)
+    if blob is None:
+        return JSONResponse(status_code=404, content={"error": "Blob not found"})
+    # the content of a blob never changes, so it can be cached until it expires
+    remaining = max(0, int(blob.expires - time.monotonic()))
+    headers = {
+        "ETag": blob.etag,
+        "Cache-Control": "private, max-age={}, immutable".format(remaining),
+    }
+    if is_fresh(request, blob.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=blob.data, media_type=blob.media_type, headers=headers)
@@ -0,0 +1,194 @@
+"""
+In-memory catalog of the gallery images. The image folder is scanned
+once; afterwards it is polled at most every conf.catalog_refresh_seconds
+and rescanned only when the modification time of the folder changes,
+that is when files are added, removed or renamed. On a rescan only the
+new files are examined. The dimensions and the content hash of an image
+are read lazily and kept until the file changes.
+"""
+import bisect
+import hashlib
+import os
+import threading
+import time
+
+from PIL import Image
+
+from app.config import Configuration
+
+
+conf = Configuration()
+
+SUPPORTED_FORMATS = (".JPEG", ".jpeg", ".jpg", ".png")
+
+
+def image_class(name):
+    """Returns the class of a gallery image, which is the WordNet ID
+    that prefixes its name (e.g. n07714571 for n07714571_head_cabbage.JPEG)."""
+    return name.split("_", 1)[0]
+
+
+class ImageEntry:
+    """A gallery image of the catalog."""
+
+    def __init__(self, name, size, mtime_ns):
+        self.name = name
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.width = None
+        self.height = None
+        self.digest = None
+
+
+class ImageCatalog:
+    """Index of the images of a folder, with O(1) lookups by name and
+    paginated listings filtered by name prefix or class."""
+
+    def __init__(self, folder, refresh_interval):
+        self.folder = folder
+        self.refresh_interval = refresh_interval
+        self._entries = {}
+        self._names = ()
+        self._classes = {}
+        self._folder_mtime = None
+        self._checked = float("-inf")
+        self._lock = threading.Lock()
+        self.scans = 0
+
+    def refresh(self, force=False):
+        """Rescans the folder if it has changed since the last scan. Unless
+        force is set, the folder is checked at most once per interval."""
+        now = time.monotonic()
+        if not force and now - self._checked < self.refresh_interval:
+            return
+        with self._lock:
+            if not force and now - self._checked < self.refresh_interval:
+                return
+            self._checked = now
+            try:
+                folder_mtime = os.stat(self.folder).st_mtime_ns
+            except OSError:
+                if self._folder_mtime is not None or self.scans == 0:
+                    print(f"WARNING: Image folder '{self.folder}' does not exist.")
+                self._set_entries({})
+                self._folder_mtime = None
+                self.scans += 1
+                return
+            if folder_mtime == self._folder_mtime and not force:
+                return
+            self._folder_mtime = folder_mtime
+            self._scan()
+
+    def _scan(self):
+        """Lists the folder, keeping the entries of the files already known.
+        Must be called holding the catalog lock."""
+        entries = {}
+        with os.scandir(self.folder) as it:
+            for dir_entry in it:
+                name = dir_entry.name
+                if not name.endswith(SUPPORTED_FORMATS):
+                    continue
+                known = self._entries.get(name)
+                if known is not None:
+                    entries[name] = known
+                    continue
+                try:
+                    st = dir_entry.stat()
+                except OSError:
+                    continue
+                entries[name] = ImageEntry(name, st.st_size, st.st_mtime_ns)
+        self._set_entries(entries)
+        self.scans += 1
+
+    def _set_entries(self, entries):
+        """Replaces the index; readers always see a consistent snapshot."""
+        names = tuple(sorted(entries))
+        classes = {}
+        for name in names:
+            classes.setdefault(image_class(name), []).append(name)
+        self._entries, self._names, self._classes = entries, names, classes
+
+    def names(self):
+        """Returns the sorted names of the images."""
+        self.refresh()
+        return self._names
+
+    def __contains__(self, name):
+        self.refresh()
+        return isinstance(name, str) and name in self._entries
+
+    def __len__(self):
+        self.refresh()
+        return len(self._names)
+
+    def generation(self):
+        """Returns a value that changes whenever the list of images changes,
+        the same in every process."""
+        self.refresh()
+        return self._folder_mtime, len(self._names)
+
+    def get(self, name):
+        """Returns the up-to-date entry of an image, or None if the image
+        does not exist. The entry is renewed if the file has changed."""
+        self.refresh()
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(os.path.join(self.folder, name))
+        except OSError:
+            return None
+        if st.st_mtime_ns != entry.mtime_ns or st.st_size != entry.size:
+            entry = ImageEntry(name, st.st_size, st.st_mtime_ns)
+            self._entries[name] = entry
+        return entry
+
+    def details(self, name):
+        """Returns the name, size, modification time, dimensions and
+        content hash of an image as a dictionary, or None if the image
+        does not exist."""
+        entry = self.get(name)
+        if entry is None:
+            return None
+        path = os.path.join(self.folder, name)
+        if entry.width is None:
+            with Image.open(path) as img:
+                entry.width, entry.height = img.size
+        if entry.digest is None:
+            sha = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(chunk)
+            entry.digest = sha.hexdigest()
+        return {
+            "name": entry.name,
+            "size": entry.size,
+            "mtime": entry.mtime_ns / 1e9,
+            "width": entry.width,
+            "height": entry.height,
+            "sha256": entry.digest,
+        }
+
+    def page(self, offset=0, limit=None, prefix=None, class_id=None):
+        """Returns the total number of images matching the filters and the
+        names of the images in the requested page."""
+        self.refresh()
+        names = self._classes.get(class_id, []) if class_id else self._names
+        if prefix:
+            # names are sorted, so the matches are a contiguous range
+            start = bisect.bisect_left(names, prefix)
+            end = bisect.bisect_left(names, prefix + "\U0010ffff", lo=start)
+            names = names[start:end]
+        end = len(names) if limit is None else offset + limit
+        return len(names), list(names[offset:end])
+
+    def stats(self):
+        """Returns the catalog counters as a dictionary."""
+        return {
+            "images": len(self._names),
+            "classes": len(self._classes),
+            "scans": self.scans,
+        }
+
+
+catalog = ImageCatalog(conf.image_folder_path, conf.catalog_refresh_seconds)
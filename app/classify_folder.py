@@ -0,0 +1,270 @@
+"""
+Offline classification of a whole folder of images, the gallery by
+default. The images are decoded and preprocessed by a pool of worker
+processes, which feeds batches to the models, each loaded once through
+the model registry. The results are written incrementally, one record
+per image and model, as JSON lines or as Parquet part files (which
+require pyarrow). The output is also the checkpoint: an interrupted run
+started again with the same output resumes from the images that are
+not in it yet.
+
+    python app/classify_folder.py --models resnet18 vgg16 --output results.jsonl
+"""
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+# Ensure the project root is in the import path, to reuse the
+# preprocessing and the models of the classification service
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.catalog import SUPPORTED_FORMATS
+from app.config import Configuration
+from app.ml.head import get_head, get_transform, input_size
+from app.ml.model_registry import registry
+from app.ml.result_cache import image_digest
+
+
+def find_images(folder):
+    """Returns the paths of the images under folder, relative to it, sorted."""
+    paths = []
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if name.endswith(SUPPORTED_FORMATS):
+                paths.append(os.path.relpath(os.path.join(root, name), folder))
+    return sorted(paths)
+
+
+def _init_worker():
+    # the decode workers run in parallel, each with a single thread
+    torch.set_num_threads(1)
+
+
+def decode(folder, image, models_by_size):
+    """Decodes an image and preprocesses it for every input size, given
+    with a model that takes it. Runs in a worker process, and returns the
+    image, its digest and the inputs by size as NumPy arrays, or the
+    image and the decoding error."""
+    try:
+        with Image.open(os.path.join(folder, image)) as img:
+            img = img.convert("RGB")
+        inputs = {size: get_transform(model_id)(img).numpy() for size, model_id in models_by_size.items()}
+        return image, image_digest(img), inputs, None
+    except Exception as e:
+        return image, None, None, "{}: {}".format(type(e).__name__, e)
+
+
+def bounded_map(pool, fn, items, window):
+    """Yields fn(*item) for every item, in order, computed by the pool
+    with at most window tasks in flight, so that a slow consumer does
+    not accumulate every decoded image in memory."""
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, *item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class JsonlWriter:
+    """Appends the records to a JSON lines file, flushed after every batch."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def done(self):
+        """Returns the (image, model) pairs already written. A line left
+        incomplete by an interrupted run is truncated."""
+        done = set()
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, "rb+") as f:
+            valid = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                done.add((record["image"], record["model"]))
+                valid += len(line)
+            f.truncate(valid)
+        return done
+
+    def write(self, records):
+        if self._file is None:
+            self._file = open(self.path, "a")
+        for record in records:
+            self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class ParquetWriter:
+    """Writes the records in Parquet part files of part_rows records in
+    the output directory. Every part is written to a temporary file and
+    then renamed, so only complete parts are ever read back."""
+
+    def __init__(self, path, part_rows=4096):
+        import pyarrow
+
+        self.path = path
+        self.part_rows = part_rows
+        self.schema = pyarrow.schema([
+            ("image", pyarrow.string()),
+            ("digest", pyarrow.string()),
+            ("model", pyarrow.string()),
+            ("labels", pyarrow.list_(pyarrow.string())),
+            ("scores", pyarrow.list_(pyarrow.float32())),
+            ("error", pyarrow.string()),
+        ])
+        self._records = []
+        os.makedirs(path, exist_ok=True)
+
+    def _parts(self):
+        return sorted(glob.glob(os.path.join(self.path, "part-*.parquet")))
+
+    def done(self):
+        import pyarrow.parquet
+
+        done = set()
+        for part in self._parts():
+            table = pyarrow.parquet.read_table(part, columns=["image", "model"])
+            done.update(zip(table.column("image").to_pylist(), table.column("model").to_pylist()))
+        return done
+
+    def write(self, records):
+        self._records.extend(records)
+        if len(self._records) >= self.part_rows:
+            self._flush()
+
+    def _flush(self):
+        import pyarrow
+        import pyarrow.parquet
+
+        if not self._records:
+            return
+        columns = {name: [] for name in self.schema.names}
+        for record in self._records:
+            scores = record.get("scores")
+            columns["image"].append(record["image"])
+            columns["digest"].append(record.get("digest"))
+            columns["model"].append(record["model"])
+            columns["labels"].append([label for label, _ in scores] if scores else None)
+            columns["scores"].append([score for _, score in scores] if scores else None)
+            columns["error"].append(record.get("error"))
+        table = pyarrow.Table.from_pydict(columns, schema=self.schema)
+        part = os.path.join(self.path, "part-{:05d}.parquet".format(len(self._parts())))
+        pyarrow.parquet.write_table(table, part + ".tmp")
+        os.replace(part + ".tmp", part)
+        self._records = []
+
+    def close(self):
+        self._flush()
+
+
+def open_writer(path, fmt):
+    if fmt == "parquet":
+        return ParquetWriter(path)
+    return JsonlWriter(path)
+
+
+def classify_batch(batch, model_ids, head, done):
+    """Runs the images of a batch of decoded images that are not done yet
+    through each model and returns the records of their results."""
+    records = []
+    for model_id in model_ids:
+        pending = [item for item in batch if (item[0], model_id) not in done]
+        if not pending:
+            continue
+        size = input_size(model_id)
+        batch_inputs = torch.from_numpy(np.stack([inputs[size] for _, _, inputs in pending]))
+        with torch.inference_mode():
+            out = registry.get(model_id)(batch_inputs)
+        for (image, digest, _), scores in zip(pending, head(out)):
+            records.append({"image": image, "digest": digest, "model": model_id, "scores": scores})
+    return records
+
+
+def classify_folder(folder, model_ids, output, fmt="jsonl", workers=None, batch_size=32, k=None):
+    """Classifies every image of folder with every model of model_ids and
+    writes the results to output, skipping the results already there."""
+    writer = open_writer(output, fmt)
+    done = writer.done()
+    images = [
+        image for image in find_images(folder)
+        if any((image, model_id) not in done for model_id in model_ids)
+    ]
+    logging.info("{} images to classify in {} ({} results already written)".format(
+        len(images), folder, len(done)))
+    if not images:
+        writer.close()
+        return
+
+    for model_id in model_ids:
+        registry.get(model_id)
+    head = get_head(k)
+    models_by_size = {input_size(model_id): model_id for model_id in model_ids}
+    workers = workers or os.cpu_count() or 1
+
+    start = time.perf_counter()
+    count = 0
+    batch = []
+    # the workers are spawned, not forked, since this process has already
+    # started the torch thread pools to load the models
+    pool = ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker
+    )
+    try:
+        items = ((folder, image, models_by_size) for image in images)
+        for image, digest, inputs, error in bounded_map(pool, decode, items, workers * 4):
+            if error is not None:
+                logging.warning("Skipping {}: {}".format(image, error))
+                writer.write([
+                    {"image": image, "model": model_id, "error": error}
+                    for model_id in model_ids if (image, model_id) not in done
+                ])
+                continue
+            batch.append((image, digest, inputs))
+            if len(batch) == batch_size:
+                count += len(batch)
+                writer.write(classify_batch(batch, model_ids, head, done))
+                batch = []
+                logging.info("{}/{} images, {:.1f} images/s".format(
+                    count, len(images), count / (time.perf_counter() - start)))
+        if batch:
+            count += len(batch)
+            writer.write(classify_batch(batch, model_ids, head, done))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        writer.close()
+    logging.info("{} images classified in {:.1f}s".format(count, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--folder", default=Configuration.image_folder_path)
+    parser.add_argument("--models", nargs="+", choices=Configuration.models, default=Configuration.models[:1])
+    parser.add_argument("--output", required=True, help="JSON lines file, or directory of Parquet parts")
+    parser.add_argument("--format", choices=("jsonl", "parquet"), default="jsonl")
+    parser.add_argument("--workers", type=int, default=None, help="decode processes (one per core by default)")
+    parser.add_argument("--batch-size", type=int, default=Configuration.batch_max_size)
+    parser.add_argument("--top-k", type=int, default=Configuration.top_k)
+    args = parser.parse_args()
+    classify_folder(args.folder, args.models, args.output, args.format, args.workers, args.batch_size, args.top_k)
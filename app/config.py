@@ -14,3 +14,156 @@ class Configuration:
         "vgg16",
         "inception_v3",
     )
+
+    # classification head: number of classes returned, and input sizes
+    # (resize, crop) of the models that do not take the default 256/224
+    top_k = 5
+    model_input_sizes = {"inception_v3": (342, 299)}
+
+    # inference backend of each model, one of the backends listed in
+    # app/ml/backends.py (eager float32 if not listed); the TorchScript and
+    # ONNX variants are exported to compiled_models_path by
+    # app/prepare_models.py
+    model_backends = {}
+    compiled_models_path = os.path.join(project_root, "cache/models")
+
+    # model registry: maximum memory (in bytes) used by the loaded models,
+    # None keeps every model in memory once loaded
+    model_cache_max_bytes = None
+
+    # micro-batching: concurrent requests for the same model are grouped
+    # in a single forward pass of at most batch_max_size images, waiting
+    # at most batch_max_wait_ms for the batch to fill up
+    batching_enabled = True
+    batch_max_size = 16
+    batch_max_wait_ms = 5
+
+    # worker pools: inference, image encoding/decoding and plot rendering
+    # run off the event loop, in pools of the given size. When a pool has
+    # more than *_max_pending queued tasks, requests are rejected with a
+    # 503 response asking the client to retry after retry_after_seconds.
+    # The inference pool should be at least as large as batch_max_size,
+    # since every worker waits for its own batched forward pass.
+    inference_workers = 16
+    inference_max_pending = 64
+    codec_workers = 4
+    codec_max_pending = 64
+    plot_workers = 2
+    plot_max_pending = 32
+    retry_after_seconds = 1
+    # admission control: each model runs at most max_concurrent
+    # classifications, and queues at most max_queued requests, as long as
+    # their expected wait stays within slo_ms (the model_* defaults, which
+    # model_limits overrides by model). Requests that are not admitted are
+    # answered with the cached result of the model ("cache") or by the
+    # admission_fallback_model ("fallback"), in the order of
+    # admission_degrade, and otherwise rejected with a 503 response.
+    model_max_concurrent = 8
+    model_max_queued = 32
+    model_latency_slo_ms = 2000
+    model_limits = {
+        "vgg16": {"max_concurrent": 4, "max_queued": 8},
+        "inception_v3": {"max_concurrent": 4, "max_queued": 16},
+    }
+    admission_degrade = ("cache", "fallback")
+    admission_fallback_model = "resnet18"
+    # number of torch intra-op threads, None keeps the torch default
+    torch_num_threads = None
+
+    # classification results cache: at most result_cache_max_entries
+    # results are kept in memory, each for result_cache_ttl_seconds
+    # (None never expires). If result_cache_path is set, results are
+    # also stored in a sqlite database that survives restarts, with the
+    # same time to live, keeping at most result_cache_disk_max_entries.
+    result_cache_max_entries = 10000
+    result_cache_ttl_seconds = 3600
+    result_cache_path = None
+    result_cache_disk_max_entries = 1_000_000
+
+    # store of the preprocessed gallery images, built by
+    # app/prepare_tensors.py (without the .npy/.json extension). It is
+    # used only if it exists; None disables it.
+    tensor_store_path = os.path.join(project_root, "cache/gallery_tensors")
+    tensor_store_dtype = "float32"
+
+    # histograms: number of images whose histograms are memoized, and
+    # the precomputed gallery histograms built by app/prepare_histograms.py
+    histogram_cache_size = 1024
+    histogram_store_path = os.path.join(project_root, "cache/gallery_histograms")
+
+    # number of rendered charts kept in memory
+    chart_cache_size = 256
+
+    # uploads: maximum size of an uploaded file, size of the chunks in
+    # which it is read, number of bytes used to detect its type, and
+    # maximum number of pixels of an uploaded image
+    upload_max_bytes = 20 * 1024 * 1024
+    upload_chunk_size = 64 * 1024
+    # maximum size of the body of a request, checked on the stream before
+    # the multipart form is parsed and spooled (a batch carries several
+    # files)
+    upload_max_request_bytes = 4 * upload_max_bytes
+    upload_sniff_bytes = 4096
+    upload_max_pixels = 40_000_000
+
+    # blob store of the uploaded and transformed images: maximum memory
+    # used, time to live of each image, and whether images evicted from
+    # memory are moved to a temporary directory until they expire
+    blob_max_bytes = 256 * 1024 * 1024
+    blob_ttl_seconds = 900
+    blob_spill_to_disk = False
+    # directory shared by the worker processes started by app/serve.py,
+    # through which every worker can serve the blobs of the others
+    blob_shared_dir = None
+
+    # catalog of the gallery images: how often the image folder is checked
+    # for changes, and default number of images returned by /info
+    catalog_refresh_seconds = 2.0
+    info_page_size = 1000
+
+    # previews of the transformation page: longest side of the downscaled
+    # proxies, JPEG quality of the previews, and number of decoded proxies
+    # kept in memory
+    preview_max_side = 512
+    preview_quality = 80
+    preview_cache_size = 64
+
+    # embeddings: model whose penultimate-layer features are stored by
+    # app/prepare_embeddings.py for the similarity search, and path of the
+    # store. Stores of at least embedding_ivf_min_images images are split
+    # into about sqrt(N) partitions (embedding_partitions overrides it, 0
+    # disables them), of which embedding_probes are searched per query.
+    embedding_model = "resnet18"
+    embedding_store_path = os.path.join(project_root, "cache/gallery_embeddings")
+    embedding_partitions = None
+    embedding_ivf_min_images = 10000
+    embedding_probes = 8
+
+    # HTTP caching: lifetime of the cached responses of the deterministic
+    # endpoints, after which clients revalidate them with their ETag, and
+    # minimum size of the JSON responses that are compressed
+    http_cache_max_age = 3600
+    compress_min_bytes = 1024
+
+    # startup: models loaded in the background when the server starts,
+    # and run once on a dummy batch of each of warmup_batch_sizes images;
+    # /ready answers 503 until they are ready
+    warmup_models = ("resnet18",)
+    warmup_batch_sizes = (1, 16)
+
+    # jobs: number of job worker threads, maximum number of unfinished
+    # jobs, in total and per client (across the worker processes), sqlite
+    # database of the jobs, time for which finished jobs are kept, interval
+    # of the keep-alive comments of the event streams, and interval at
+    # which the event stream of a job run by another process polls it
+    job_workers = 4
+    job_max_queued = 256
+    job_max_per_client = 16
+    job_store_path = os.path.join(project_root, "cache/jobs.sqlite3")
+    job_ttl_seconds = 24 * 3600
+    job_keepalive_seconds = 15
+    job_poll_seconds = 1.0
+
+    # metrics: whether the duration of every request is recorded by a
+    # middleware; the stage timers and /metrics are always available
+    metrics_enabled = True
@@ -0,0 +1,74 @@
+"""
+Image enhancement engine of the transformation page. The enhancements
+of PIL's ImageEnhance are blends with a degenerate image, computed one
+after the other on full-size intermediate images, even when their
+factor is 1.0. Here enhancements with factor 1.0 are skipped, and
+brightness and contrast, which act on each band independently, are
+fused into one lookup table applied with a single Image.point pass.
+The color blend mixes the bands of each pixel, so it cannot be a lookup
+table: it is left to PIL's blend, which is faster than the equivalent
+NumPy expression. The arithmetic follows PIL's, so the output matches
+the sequential chain exactly.
+"""
+import numpy as np
+from PIL import ImageEnhance
+
+# modes handled by the engine, with the number of color bands
+FUSED_MODES = {"RGB": 3, "RGBA": 3, "L": 1, "LA": 1}
+
+LEVELS = np.arange(256, dtype=np.float32)
+
+
+def enhance_sequential(img, color, brightness, contrast, sharpness):
+    """Applies the enhancements one after the other with ImageEnhance.
+    This is the reference implementation of the engine."""
+    transformed_img = ImageEnhance.Color(img).enhance(color)
+    transformed_img = ImageEnhance.Brightness(transformed_img).enhance(brightness)
+    transformed_img = ImageEnhance.Contrast(transformed_img).enhance(contrast)
+    transformed_img = ImageEnhance.Sharpness(transformed_img).enhance(sharpness)
+    return transformed_img
+
+
+def _blend(degenerate, image, factor):
+    """Blends two float32 arrays like Image.blend: the result is
+    truncated to integers and clipped to [0, 255]. Used to compute
+    the lookup tables."""
+    out = degenerate + np.float32(factor) * (image - degenerate)
+    return np.clip(out, 0, 255, out=out).astype(np.uint8)
+
+
+def _point(img, lut, bands):
+    """Applies a lookup table to the color bands of an image, leaving the
+    alpha band untouched."""
+    identity = list(range(256))
+    table = lut.tolist() * bands + identity * (len(img.getbands()) - bands)
+    return img.point(table)
+
+
+def enhance(img, color=1.0, brightness=1.0, contrast=1.0, sharpness=1.0):
+    """Applies the color, brightness, contrast and sharpness enhancements
+    to an image, in this order, and returns the enhanced image. Alpha
+    bands are left untouched, as ImageEnhance does."""
+    if img.mode not in FUSED_MODES:
+        return enhance_sequential(img, color, brightness, contrast, sharpness)
+    bands = FUSED_MODES[img.mode]
+
+    # color has no effect on grayscale images
+    result = img
+    if bands == 3 and color != 1.0:
+        result = ImageEnhance.Color(img).enhance(color)
+
+    if brightness != 1.0 or contrast != 1.0:
+        lut = _blend(np.float32(0), LEVELS, brightness)
+        if contrast != 1.0:
+            # the contrast blends with the mean luminance of the image
+            # after the brightness enhancement
+            brightened = _point(result, lut, bands) if brightness != 1.0 else result
+            histogram = brightened.convert("L").histogram()
+            mean = int(np.dot(histogram, LEVELS) / sum(histogram) + 0.5)
+            lut = _blend(np.float32(mean), lut.astype(np.float32), contrast)
+        result = _point(result, lut, bands)
+
+    if sharpness != 1.0:
+        result = ImageEnhance.Sharpness(result).enhance(sharpness)
+    return result.copy() if result is img else result
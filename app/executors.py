@@ -0,0 +1,115 @@
+"""
+Bounded worker pools for the CPU-bound work of the service. Model
+inference, image encoding/decoding and plot rendering run in separate
+thread pools, so that they never block the asyncio event loop. Each pool
+accepts a limited number of pending tasks: when it is full, new tasks
+are rejected with ServiceOverloaded, which the app turns into a
+503 response with a Retry-After header.
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.config import Configuration
+
+
+conf = Configuration()
+
+
+class ServiceOverloaded(Exception):
+    """Raised when a pool cannot accept more tasks."""
+
+    def __init__(self, pool_name, retry_after):
+        super().__init__("The {} pool is full, retry later".format(pool_name))
+        self.pool_name = pool_name
+        self.retry_after = retry_after
+
+
+class BoundedExecutor:
+    """A thread pool that accepts at most max_workers running tasks
+    plus max_pending queued ones."""
+
+    def __init__(self, name, max_workers, max_pending, retry_after=1):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedules fn(*args, **kwargs) and returns its Future, or raises
+        ServiceOverloaded if the pool is full."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise ServiceOverloaded(self.name, self.retry_after)
+        with self._lock:
+            self.in_flight += 1
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) in the pool and awaits its result."""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        """Returns the pool counters as a dictionary."""
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_pending": self.max_pending,
+                "in_flight": self.in_flight,
+                "rejected": self.rejected,
+            }
+
+
+@functools.lru_cache(maxsize=None)
+def configure_torch_threads():
+    """Applies the configured number of torch intra-op threads, once."""
+    if conf.torch_num_threads is not None:
+        import torch
+
+        torch.set_num_threads(conf.torch_num_threads)
+
+
+inference_pool = BoundedExecutor(
+    "inference",
+    max_workers=conf.inference_workers,
+    max_pending=conf.inference_max_pending,
+    retry_after=conf.retry_after_seconds,
+)
+codec_pool = BoundedExecutor(
+    "codec",
+    max_workers=conf.codec_workers,
+    max_pending=conf.codec_max_pending,
+    retry_after=conf.retry_after_seconds,
+)
+plot_pool = BoundedExecutor(
+    "plot",
+    max_workers=conf.plot_workers,
+    max_pending=conf.plot_max_pending,
+    retry_after=conf.retry_after_seconds,
+)
+
+
+def stats():
+    """Returns the counters of every pool."""
+    return {pool.name: pool.stats() for pool in (inference_pool, codec_pool, plot_pool)}
@@ -0,0 +1,297 @@
+import functools
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+from fastapi import APIRouter, Query, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+from fastapi.templating import Jinja2Templates
+
+from app.config import Configuration
+from app.executors import codec_pool, plot_pool
+from app.http_cache import cached, image_etag, not_modified
+from app.metrics import stage
+from app.rendering import FORMATS, MEDIA_TYPES, render_histogram_chart
+from app.catalog import catalog
+from app.utils import list_images
+
+router = APIRouter()
+templates = Jinja2Templates(directory="app/templates")
+conf = Configuration()
+IMAGE_FOLDER = Path(conf.image_folder_path)
+
+# rows of the histogram matrix of an image, and the rows of each color space
+CHANNELS = ("gray", "r", "g", "b", "h", "s", "v")
+SPACES = {"gray": ("gray",), "rgb": ("r", "g", "b"), "hsv": ("h", "s", "v")}
+METRICS = ("l1", "chi2", "intersection", "bhattacharyya", "correlation")
+
+
+def compute_histograms(image_path):
+    """Decodes an image once and returns its 256-bin histograms as a
+    (7, 256) uint32 matrix, with the rows in the order of CHANNELS.
+    The hue channel only uses the first 180 bins (OpenCV range)."""
+    # OpenCV is imported with the first histogram, not at startup
+    import cv2
+
+    image = cv2.imread(str(image_path), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Could not decode {image_path}")
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    b, g, r = cv2.split(image)
+    h, s, v = cv2.split(hsv)
+    return np.stack([
+        cv2.calcHist([channel], [0], None, [256], [0, 256]).ravel()
+        for channel in (gray, r, g, b, h, s, v)
+    ]).astype(np.uint32)
+
+
+@functools.lru_cache(maxsize=conf.histogram_cache_size)
+def _cached_histograms(image_path, mtime):
+    with stage("histogram"):
+        return compute_histograms(image_path)
+
+
+def get_histograms(image_path):
+    """Returns the histograms of an image, memoized by path and mtime, or
+    read from the precomputed gallery store when it is up to date."""
+    image_path = str(image_path)
+    mtime = os.stat(image_path).st_mtime_ns
+    store = get_store()
+    if store is not None:
+        entry = store["rows"].get(os.path.basename(image_path))
+        if entry is not None and entry["mtime"] == mtime:
+            return store["array"][entry["row"]]
+    return _cached_histograms(image_path, mtime)
+
+
+def store_paths():
+    path = conf.histogram_store_path
+    return path + ".npy", path + ".json"
+
+
+def precompute_histograms():
+    """Computes the histograms of every gallery image and stores them in a
+    single (N, 7, 256) uint32 array, with an index of the rows."""
+    array_path, index_path = store_paths()
+    os.makedirs(os.path.dirname(array_path), exist_ok=True)
+    images = list_images()
+    array = np.zeros((len(images), len(CHANNELS), 256), dtype=np.uint32)
+    rows = {}
+    for row, image_id in enumerate(images):
+        image_path = IMAGE_FOLDER / image_id
+        rows[image_id] = {"row": row, "mtime": os.stat(image_path).st_mtime_ns}
+        array[row] = compute_histograms(image_path)
+    np.save(array_path + ".tmp.npy", array)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump({"rows": rows}, f)
+    os.replace(array_path + ".tmp.npy", array_path)
+    os.replace(index_path + ".tmp", index_path)
+    logging.info(f"Histograms of {len(images)} images stored in {array_path}.")
+
+
+_store = None
+_store_loaded = False
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Returns the precomputed gallery histograms, if they exist, as a
+    dictionary with the array and the index of its rows."""
+    global _store, _store_loaded
+    with _store_lock:
+        if not _store_loaded:
+            _store_loaded = True
+            array_path, index_path = store_paths()
+            if os.path.exists(array_path) and os.path.exists(index_path):
+                with open(index_path) as f:
+                    rows = json.load(f)["rows"]
+                _store = {"array": np.load(array_path, mmap_mode="r"), "rows": rows}
+        return _store
+
+
+# rows of the store read, normalized and compared at a time
+CHUNK_ROWS = 4096
+
+# normalized gallery histograms of a color space, for the current
+# generation of the catalog
+_gallery = {}
+_gallery_lock = threading.Lock()
+
+
+def normalize_histograms(matrix):
+    """Returns the histograms of a (N, C, 256) matrix flattened to (N,
+    C * 256) float32 rows that sum to 1."""
+    m = matrix.reshape(len(matrix), -1).astype(np.float32)
+    m /= np.maximum(m.sum(axis=1, keepdims=True), 1)
+    return m
+
+
+def gallery_histograms(space):
+    """Returns the names of the gallery images whose histograms are up to
+    date in the precomputed store and the matrix of their normalized
+    histograms in the given color space, or None if there is no store.
+    Only the rows of the channels of the space are read from the store,
+    in chunks, and the result is kept until the catalog changes."""
+    store = get_store()
+    if store is None:
+        return None
+    generation = catalog.generation()
+    with _gallery_lock:
+        cached_gallery = _gallery.get(space)
+        if cached_gallery is not None and cached_gallery[0] == generation:
+            return cached_gallery[1], cached_gallery[2]
+
+    images, store_rows = [], []
+    for image_id in catalog.names():
+        row = store["rows"].get(image_id)
+        entry = catalog.get(image_id)
+        if row is not None and entry is not None and row["mtime"] == entry.mtime_ns:
+            images.append(image_id)
+            store_rows.append(row["row"])
+    stale = len(catalog) - len(images)
+    if stale:
+        logging.warning(f"{stale} images are missing from the histogram store, "
+                        "run app/prepare_histograms.py")
+
+    channels = [CHANNELS.index(c) for c in SPACES[space]]
+    matrix = np.empty((len(images), len(channels) * 256), dtype=np.float32)
+    for i in range(0, len(images), CHUNK_ROWS):
+        chunk = np.asarray(store_rows[i:i + CHUNK_ROWS])
+        matrix[i:i + len(chunk)] = normalize_histograms(store["array"][np.ix_(chunk, channels)])
+    with _gallery_lock:
+        _gallery[space] = (generation, images, matrix)
+    return images, matrix
+
+
+def normalized_distances(q, m, metric="l1"):
+    """Returns the distances between a normalized histogram and every row
+    of a matrix of normalized histograms."""
+    if metric == "l1":
+        return np.abs(m - q).sum(axis=1)
+    if metric == "chi2":
+        total = m + q
+        diff = (m - q) ** 2
+        return np.divide(diff, total, out=np.zeros_like(diff), where=total > 0).sum(axis=1)
+    if metric == "intersection":
+        return np.minimum(m, q).sum(axis=1)
+    if metric == "bhattacharyya":
+        coefficient = np.sqrt(m * q).sum(axis=1)
+        return np.sqrt(np.clip(1 - coefficient, 0, None))
+    if metric == "correlation":
+        qc = q - q.mean()
+        mc = m - m.mean(axis=1, keepdims=True)
+        norm = np.sqrt((mc ** 2).sum(axis=1) * (qc ** 2).sum())
+        return np.divide(mc @ qc, norm, out=np.zeros(len(m), dtype=m.dtype), where=norm > 0)
+    raise ValueError(f"Unknown metric {metric}")
+
+
+def compare_histograms(image_id, space, metric, limit):
+    """Ranks the gallery images by the distance of their histograms in
+    the given color space from the histograms of image_id, or returns
+    None if the gallery histograms have not been precomputed."""
+    gallery = gallery_histograms(space)
+    if gallery is None:
+        return None
+    images, matrix = gallery
+    channels = [CHANNELS.index(c) for c in SPACES[space]]
+    q = normalize_histograms(get_histograms(IMAGE_FOLDER / image_id)[channels][np.newaxis])[0]
+    with stage("histogram_compare"):
+        distances = np.empty(len(matrix), dtype=np.float32)
+        for i in range(0, len(matrix), CHUNK_ROWS):
+            distances[i:i + CHUNK_ROWS] = normalized_distances(q, matrix[i:i + CHUNK_ROWS], metric)
+    # similarity metrics are ranked in decreasing order
+    if metric in ("intersection", "correlation"):
+        distances = -distances
+    limit = min(limit, len(distances))
+    if limit == 0:
+        return []
+    top = np.argpartition(distances, limit - 1)[:limit]
+    top = top[np.argsort(distances[top], kind="stable")]
+    sign = -1 if metric in ("intersection", "correlation") else 1
+    return [
+        {"image_id": images[i], "distance": float(sign * distances[i])}
+        for i in top
+    ]
+
+
+def render_histogram_plot(image_path: Path, image_id: str, fmt: str = "png") -> bytes:
+    """Computes the grayscale histogram of an image and renders it."""
+    hist = get_histograms(image_path)[CHANNELS.index("gray")]
+    return render_histogram_chart(hist, f'Histogram of {image_id}', fmt)
+
+
+@router.get("/histogram", response_class=HTMLResponse, name="get_histogram_page")
+def get_histogram_page(request: Request):
+    return templates.TemplateResponse(
+        "histogram_select.html",
+        {
+            "request": request,
+            "images": list_images()
+        }
+    )
+
+
+@router.get("/histogram/json", response_class=JSONResponse)
+async def get_histogram_json(request: Request, image_id: str, space: str = "gray"):
+    if image_id not in catalog:
+        return JSONResponse(status_code=404, content={"error": "Image not found"})
+    image_path = IMAGE_FOLDER / image_id
+    if space not in SPACES:
+        return JSONResponse(status_code=400, content={"error": f"Unknown space {space}"})
+    etag = image_etag(image_id, "histogram", space)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+
+    histograms = await codec_pool.run(get_histograms, image_path)
+    if space == "gray":
+        histogram = histograms[CHANNELS.index("gray")].tolist()
+    else:
+        histogram = {c: histograms[CHANNELS.index(c)].tolist() for c in SPACES[space]}
+    content = {
+        "image_id": image_id,
+        "histogram": histogram
+    }
+    return cached(JSONResponse(content=content), etag)
+
+
+@router.get("/histogram/image")
+async def get_histogram_image(request: Request, image_id: str, format: str = "png"):
+    if image_id not in catalog:
+        return JSONResponse(status_code=404, content={"error": "Image not found"})
+    image_path = IMAGE_FOLDER / image_id
+    if format not in FORMATS:
+        return JSONResponse(status_code=400, content={"error": f"Unknown format {format}"})
+    etag = image_etag(image_id, "histogram-image", format)
+    response = not_modified(request, etag, media_type=MEDIA_TYPES[format])
+    if response is not None:
+        return response
+
+    content = await plot_pool.run(render_histogram_plot, image_path, image_id, format)
+    return cached(Response(content=content, media_type=MEDIA_TYPES[format]), etag)
+
+
+@router.get("/histogram/compare", response_class=JSONResponse)
+async def get_histogram_comparison(
+    image_id: str, space: str = "gray", metric: str = "l1", limit: int = Query(10, ge=1, le=1000)
+):
+    """Returns the gallery images with the most similar histograms."""
+    if image_id not in catalog:
+        return JSONResponse(status_code=404, content={"error": "Image not found"})
+    if space not in SPACES or metric not in METRICS:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"space must be one of {list(SPACES)}, metric one of {list(METRICS)}"},
+        )
+    results = await codec_pool.run(compare_histograms, image_id, space, metric, limit)
+    if results is None:
+        # comparing would decode every gallery image on every request
+        return JSONResponse(
+            status_code=503,
+            content={"error": "The gallery histograms are not available, run app/prepare_histograms.py"},
+        )
+    return {"image_id": image_id, "space": space, "metric": metric, "results": results}
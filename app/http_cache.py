@@ -0,0 +1,204 @@
+"""
+HTTP caching of the deterministic endpoints. The responses about a
+gallery image only depend on the file, on the parameters of the request
+(model, color space, format...) and on the version of the code, so
+their ETag is derived from these: the mtime and size of the file, known
+by the catalog, the parameters and HTTP_CACHE_VERSION. The endpoints
+compute the ETag first and answer a matching If-None-Match with 304,
+before decoding the image or running a model. Only the responses that
+depend on nothing but the file also send Last-Modified and honour
+If-Modified-Since, which cannot tell that anything else has changed.
+
+The compression middleware compresses the JSON responses larger than
+conf.compress_min_bytes with brotli, when the brotli package is
+installed and the client accepts it, or with gzip. The ETag of a JSON
+response depends on the encoding accepted by the client, whether or not
+the response was large enough to be compressed, so that the 304
+responses, which have no body, carry the same ETag as the 200 ones.
+"""
+import gzip
+import hashlib
+import json
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Request
+from fastapi.responses import Response
+
+from app.catalog import catalog
+from app.config import Configuration
+
+
+conf = Configuration()
+
+# version of the cached responses: it must be increased whenever the
+# content of the responses of a cached endpoint changes
+HTTP_CACHE_VERSION = 1
+
+# suffixes added to the ETag of a compressed response, by encoding
+ENCODING_SUFFIXES = {"br": "-br", "gzip": "-gzip"}
+
+_brotli = None
+
+
+def make_etag(*parts):
+    """Returns a strong ETag derived from the given values."""
+    key = json.dumps([HTTP_CACHE_VERSION, *parts], default=str)
+    return '"{}"'.format(hashlib.sha256(key.encode()).hexdigest()[:32])
+
+
+def image_etag(image_id, *parts):
+    """Returns the ETag of a response about a gallery image, or None if
+    the image does not exist."""
+    entry = catalog.get(image_id)
+    if entry is None:
+        return None
+    return make_etag(image_id, entry.mtime_ns, entry.size, *parts)
+
+
+def image_last_modified(image_id):
+    """Returns the Last-Modified date of a gallery image, or None. Only
+    the responses that depend on the file alone may send it."""
+    entry = catalog.get(image_id)
+    if entry is None:
+        return None
+    return formatdate(entry.mtime_ns / 1e9, usegmt=True)
+
+
+def cache_headers(etag, last_modified=None):
+    """Returns the caching headers of a response."""
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age={}".format(conf.http_cache_max_age),
+    }
+    if last_modified is not None:
+        headers["Last-Modified"] = last_modified
+    return headers
+
+
+def compressible(media_type):
+    """Returns True if the responses of a media type may be compressed."""
+    return media_type.startswith("application/json")
+
+
+def encoded_etag(etag, encoding):
+    """Returns the ETag of the representation of a response in an
+    encoding, None being the identity."""
+    if encoding is None or not etag.endswith('"'):
+        return etag
+    return etag[:-1] + ENCODING_SUFFIXES[encoding] + '"'
+
+
+def add_vary(headers):
+    """Adds Accept-Encoding to the Vary header of a response."""
+    vary = headers.get("vary")
+    if vary is None:
+        headers["Vary"] = "Accept-Encoding"
+    elif "accept-encoding" not in vary.lower():
+        headers["Vary"] = vary + ", Accept-Encoding"
+
+
+def _strip_encoding(etag):
+    for suffix in ENCODING_SUFFIXES.values():
+        if etag.endswith(suffix + '"'):
+            return etag[:-len(suffix) - 1] + '"'
+    return etag
+
+
+def is_fresh(request: Request, etag, last_modified=None):
+    """Returns True if the client already has the response with the given
+    ETag (or Last-Modified date), according to its conditional headers."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag in (_strip_encoding(tag) for tag in tags)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def not_modified(request: Request, etag, last_modified=None, media_type="application/json"):
+    """Returns a 304 response if the client already has the response,
+    otherwise None. The 304 response carries the ETag of the encoding
+    in which the 200 response would have been sent."""
+    if etag is None or not is_fresh(request, etag, last_modified):
+        return None
+    response = Response(status_code=304, headers=cache_headers(etag, last_modified))
+    if compressible(media_type):
+        encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+        response.headers["ETag"] = encoded_etag(etag, encoding)
+        add_vary(response.headers)
+    return response
+
+
+def cached(response, etag, last_modified=None):
+    """Adds the caching headers to a response and returns it."""
+    if etag is not None:
+        response.headers.update(cache_headers(etag, last_modified))
+    return response
+
+
+def brotli_module():
+    """Returns the brotli module, or None if it is not installed."""
+    global _brotli
+    if _brotli is None:
+        try:
+            import brotli
+        except ImportError:
+            brotli = False
+        _brotli = brotli
+    return _brotli or None
+
+
+def choose_encoding(accept_encoding):
+    """Returns the best encoding accepted by the client, or None."""
+    accepted = {
+        token.split(";")[0].strip().lower()
+        for token in accept_encoding.split(",")
+        if not token.replace(" ", "").endswith(";q=0")
+    }
+    if "br" in accepted and brotli_module() is not None:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli_module().compress(body, quality=4)
+    return gzip.compress(body, compresslevel=6)
+
+
+async def compression_middleware(request: Request, call_next):
+    """Compresses the large JSON responses with the best encoding that the
+    client accepts. The ETag of a JSON response gets the suffix of that
+    encoding, as it names a different representation, and every JSON
+    response varies with Accept-Encoding."""
+    response = await call_next(request)
+    content_type = response.headers.get("content-type", "")
+    if not compressible(content_type) or "content-encoding" in response.headers:
+        return response
+    add_vary(response.headers)
+    encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+    if encoding is None:
+        return response
+
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    compressed = Response(content=body, status_code=response.status_code)
+    compressed.raw_headers = [
+        (k, v) for k, v in response.raw_headers if k not in (b"content-length", b"etag")
+    ]
+    etag = response.headers.get("etag")
+    if etag is not None:
+        compressed.headers["ETag"] = encoded_etag(etag, encoding)
+    if len(body) >= conf.compress_min_bytes:
+        compressed.body = compress(body, encoding)
+        compressed.headers["Content-Encoding"] = encoding
+    compressed.headers["Content-Length"] = str(len(compressed.body))
+    return compressed
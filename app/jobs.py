@@ -0,0 +1,729 @@
+"""
+Asynchronous jobs for the long-running work: a classification, a
+transformation or a batch classification is submitted with a POST that
+returns a job ID right away, and its status, progress and result are
+then polled at /jobs/{id} or followed as Server-Sent Events at
+/jobs/{id}/events. Jobs wait in an in-process priority queue (lower
+priority values first) and run in a pool of job worker threads. Each
+client, identified by the X-Client-Id header or by its address, can
+have at most conf.job_max_per_client unfinished jobs, and new jobs are
+rejected with a 503 response when conf.job_max_queued jobs are
+unfinished. Jobs are stored in sqlite, so their results survive
+restarts and can be read by every worker process; jobs left unfinished
+by a process that no longer exists are marked as failed, since their
+uploaded images were kept in memory. Finished jobs are deleted after
+conf.job_ttl_seconds.
+
+A job runs in the worker process that accepted it. The other processes
+share its state through the store: the limits are counted from the
+table, a cancellation is recorded there and noticed by the owner of the
+job, and the event stream of a job owned by another process polls the
+store every conf.job_poll_seconds.
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import List
+
+from fastapi import APIRouter, File, Form, Request, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+from PIL import Image
+
+from app.admission import admission
+from app.blob_store import blob_store
+from app.catalog import catalog
+from app.config import Configuration
+from app.executors import ServiceOverloaded
+from app.startup import classify_image, classify_images
+from app.transformation import IMAGE_FOLDER, transform_and_encode
+from app.uploads import UploadError, decode_image, read_upload
+
+
+router = APIRouter()
+conf = Configuration()
+
+JOB_PREFIX = "job_"
+FINISHED = ("succeeded", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    """Raised by a job that notices it has been cancelled."""
+
+
+class ClientLimitExceeded(Exception):
+    """Raised when a client has too many unfinished jobs."""
+
+    def __init__(self, limit):
+        super().__init__("At most {} unfinished jobs per client".format(limit))
+
+
+class Job:
+    """A job of the queue, with its parameters and state."""
+
+    def __init__(self, job_id, client, kind, priority, params):
+        self.id = job_id
+        self.client = client
+        self.kind = kind
+        self.priority = priority
+        self.params = params
+        self.status = "queued"
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_requested = False
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "priority": self.priority,
+            "status": self.status,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+def process_alive(pid):
+    """Returns True if a process with the given ID exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobStore:
+    """sqlite table of the jobs. Every process opens its own connection,
+    since the worker processes of app/serve.py are forked. The owner
+    column holds the ID of the process that runs the job, and
+    cancel_requested is set by any process to cancel it."""
+
+    COLUMNS = ("id", "client", "kind", "priority", "status", "progress", "params",
+               "result", "error", "created", "started", "finished", "cancel_requested")
+    SAVED = COLUMNS[:-1] + ("owner",)
+
+    def __init__(self, path):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._db = None
+        self._pid = None
+        self._lock = threading.Lock()
+        with self._lock:
+            db = self._connection()
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, client TEXT, kind TEXT, "
+                "priority INTEGER, status TEXT, progress REAL, params TEXT, result TEXT, "
+                "error TEXT, created REAL, started REAL, finished REAL, "
+                "cancel_requested INTEGER DEFAULT 0, owner INTEGER)"
+            )
+            # stores created before these columns existed
+            columns = {row[1] for row in db.execute("PRAGMA table_info(jobs)")}
+            for name, declaration in (("cancel_requested", "INTEGER DEFAULT 0"), ("owner", "INTEGER")):
+                if name not in columns:
+                    db.execute("ALTER TABLE jobs ADD COLUMN {} {}".format(name, declaration))
+            db.commit()
+
+    def _connection(self):
+        """Returns the connection of this process. Must be called holding
+        the store lock."""
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._pid = os.getpid()
+        return self._db
+
+    def _row(self, job):
+        return (
+            job.id, job.client, job.kind, job.priority, job.status, job.progress,
+            json.dumps(job.params), json.dumps(job.result), job.error,
+            job.created, job.started, job.finished, os.getpid(),
+        )
+
+    def _reap(self, db):
+        """Fails the unfinished jobs of the processes that no longer exist,
+        such as a worker restarted by app/serve.py."""
+        owners = [row[0] for row in db.execute(
+            "SELECT DISTINCT owner FROM jobs WHERE status IN ('queued', 'running') "
+            "AND owner IS NOT NULL"
+        )]
+        dead = [owner for owner in owners if not process_alive(owner)]
+        if dead:
+            db.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Interrupted by a restart', "
+                "finished = ? WHERE status IN ('queued', 'running') AND owner IN ({})".format(
+                    ",".join("?" * len(dead))),
+                (time.time(), *dead),
+            )
+
+    def add(self, job, max_queued, max_per_client):
+        """Inserts a new job, unless there are already max_queued unfinished
+        jobs, or max_per_client unfinished jobs of its client, in every
+        process. Returns None, or the exceeded limit: "queue" or "client"."""
+        with self._lock:
+            db = self._connection()
+            # the write lock makes the count and the insert atomic
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                self._reap(db)
+                total, active = db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(client = ?), 0) FROM jobs "
+                    "WHERE status IN ('queued', 'running')",
+                    (job.client,),
+                ).fetchone()
+                if total >= max_queued:
+                    exceeded = "queue"
+                elif active >= max_per_client:
+                    exceeded = "client"
+                else:
+                    exceeded = None
+                    db.execute(
+                        "INSERT INTO jobs ({}) VALUES ({})".format(
+                            ",".join(self.SAVED), ",".join("?" * len(self.SAVED))),
+                        self._row(job),
+                    )
+                db.commit()
+            except BaseException:
+                db.rollback()
+                raise
+        return exceeded
+
+    def save(self, job):
+        """Stores the state of a job, keeping its cancellation request."""
+        row = self._row(job)
+        updates = ",".join("{0} = excluded.{0}".format(name) for name in self.SAVED[1:])
+        with self._lock:
+            self._connection().execute(
+                "INSERT INTO jobs ({}) VALUES ({}) ON CONFLICT(id) DO UPDATE SET {}".format(
+                    ",".join(self.SAVED), ",".join("?" * len(row)), updates),
+                row,
+            )
+            self._db.commit()
+
+    def start(self, job):
+        """Marks a queued job as running, unless it has been cancelled
+        meanwhile. Returns True if the job can run."""
+        with self._lock:
+            cursor = self._connection().execute(
+                "UPDATE jobs SET status = 'running', started = ? "
+                "WHERE id = ? AND status = 'queued' AND NOT cancel_requested",
+                (job.started, job.id),
+            )
+            self._db.commit()
+        return cursor.rowcount == 1
+
+    def progress(self, job_id, progress):
+        """Stores the progress of a running job and returns True if its
+        cancellation has been requested."""
+        with self._lock:
+            db = self._connection()
+            db.execute("UPDATE jobs SET progress = ? WHERE id = ?", (progress, job_id))
+            db.commit()
+            row = db.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def request_cancel(self, job_id):
+        """Requests the cancellation of an unfinished job, from any process:
+        a queued job is cancelled at once, a running one is stopped by its
+        owner. Returns True if the job was unfinished."""
+        with self._lock:
+            cursor = self._connection().execute(
+                "UPDATE jobs SET cancel_requested = 1, "
+                "finished = CASE WHEN status = 'queued' THEN ? ELSE finished END, "
+                "status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END "
+                "WHERE id = ? AND status IN ('queued', 'running')",
+                (time.time(), job_id),
+            )
+            self._db.commit()
+        return cursor.rowcount == 1
+
+    def load(self, job_id):
+        """Returns the job with the given ID, or None."""
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT {} FROM jobs WHERE id = ?".format(",".join(self.COLUMNS)), (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        values = dict(zip(self.COLUMNS, row))
+        job = Job(values["id"], values["client"], values["kind"], values["priority"],
+                  json.loads(values["params"]))
+        for name in ("status", "progress", "error", "created", "started", "finished"):
+            setattr(job, name, values[name])
+        job.result = json.loads(values["result"])
+        job.cancel_requested = bool(values["cancel_requested"])
+        return job
+
+    def expire(self, before):
+        """Fails the jobs of the processes that no longer exist, and deletes
+        the jobs finished before the given time."""
+        with self._lock:
+            db = self._connection()
+            self._reap(db)
+            db.execute("DELETE FROM jobs WHERE finished < ?", (before,))
+            db.commit()
+
+
+class JobQueue:
+    """Priority queue of the jobs, served by max_workers threads. The
+    unfinished jobs of this process are kept in memory, where the workers
+    update them and the subscribers are notified of every change; the
+    limits and the cancellations go through the store, which is shared
+    by the worker processes."""
+
+    # interval between two deletions of the expired jobs, in seconds
+    EXPIRE_INTERVAL = 60
+
+    def __init__(self, store, max_workers, max_queued, max_per_client, retry_after=1, ttl=None):
+        self.store = store
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_per_client = max_per_client
+        self.retry_after = retry_after
+        self.ttl = ttl
+        self._expired = None
+        self.handlers = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._jobs = {}
+        self._subscribers = {}
+        self._workers = []
+        self.completed = 0
+        self.rejected = 0
+
+    def handler(self, kind):
+        """Registers the function that runs the jobs of a kind."""
+        def register(fn):
+            self.handlers[kind] = fn
+            return fn
+        return register
+
+    def submit(self, client, kind, params, priority=5):
+        """Queues a job and returns it. Raises ServiceOverloaded if the
+        queue is full, and ClientLimitExceeded if the client already has
+        too many unfinished jobs, counting the jobs of every process."""
+        self.expire()
+        job = Job(JOB_PREFIX + secrets.token_urlsafe(12), client, kind, priority, params)
+        exceeded = self.store.add(job, self.max_queued, self.max_per_client)
+        if exceeded is not None:
+            with self._condition:
+                self.rejected += 1
+            if exceeded == "client":
+                raise ClientLimitExceeded(self.max_per_client)
+            raise ServiceOverloaded("jobs", self.retry_after)
+        with self._condition:
+            self._jobs[job.id] = job
+            heapq.heappush(self._heap, (priority, next(self._counter), job.id))
+            self._start_workers()
+            self._condition.notify()
+        return job
+
+    def expire(self):
+        """Deletes the jobs finished more than ttl seconds ago, at most once
+        every EXPIRE_INTERVAL seconds."""
+        now = time.time()
+        with self._condition:
+            recent = self._expired is not None and now - self._expired < self.EXPIRE_INTERVAL
+            if self.ttl is None or recent:
+                return
+            self._expired = now
+        self.store.expire(now - self.ttl)
+
+    def _start_workers(self):
+        """Starts the worker threads, the first time a job is submitted.
+        Must be called holding the queue lock."""
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(
+                target=self._run, name="jobs-{}".format(len(self._workers)), daemon=True
+            )
+            self._workers.append(worker)
+            worker.start()
+
+    def get(self, job_id):
+        """Returns the job with the given ID, from memory or from the store."""
+        with self._condition:
+            job = self._jobs.get(job_id)
+        # a queued job may have been cancelled by another process
+        if job is None or job.status == "queued":
+            return self.store.load(job_id) or job
+        return job
+
+    def cancel(self, job_id):
+        """Cancels a job: a queued job is never run, a running job is
+        stopped at its next check. The jobs of other processes are
+        cancelled through the store. Returns the job, or None if it does
+        not exist or is finished."""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.cancel_requested = True
+                if job.status == "queued":
+                    self._finish(job, "cancelled")
+                else:
+                    self.store.request_cancel(job_id)
+                return job
+        if not self.store.request_cancel(job_id):
+            return None
+        return self.store.load(job_id)
+
+    def update(self, job, progress):
+        """Records the progress of a running job, raising JobCancelled if
+        the job has been cancelled meanwhile, by any process."""
+        if self.store.progress(job.id, progress):
+            job.cancel_requested = True
+        with self._condition:
+            if job.cancel_requested:
+                raise JobCancelled()
+            job.progress = progress
+            self._notify(job)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                _, _, job_id = heapq.heappop(self._heap)
+                job = self._jobs.get(job_id)
+                if job is None or job.status != "queued":
+                    continue
+                job.started = time.time()
+                # a job cancelled by another process is not run
+                if not self.store.start(job):
+                    self._finish(job, "cancelled")
+                    continue
+                job.status = "running"
+                self._notify(job)
+
+            try:
+                result = self.handlers[job.kind](job, job.params)
+            except JobCancelled:
+                status, result, error = "cancelled", None, None
+            except Exception as e:
+                logging.exception("Job {} failed".format(job.id))
+                status, result, error = "failed", None, str(e)
+            else:
+                status, error = "succeeded", None
+            if self.store.progress(job.id, job.progress):
+                job.cancel_requested = True
+            with self._condition:
+                if job.cancel_requested:
+                    status, result = "cancelled", None
+                job.result = result
+                job.error = error
+                job.progress = 1.0 if status == "succeeded" else job.progress
+                self._finish(job, status)
+            self.expire()
+
+    def _finish(self, job, status):
+        """Records the end of a job and forgets it, once it is stored.
+        Must be called holding the queue lock."""
+        job.status = status
+        job.finished = time.time()
+        self.completed += 1
+        self.store.save(job)
+        self._notify(job)
+        self._jobs.pop(job.id, None)
+        self._subscribers.pop(job.id, None)
+
+    def subscribe(self, job_id):
+        """Returns an asyncio queue that receives the state of the job on
+        every change, or None if the job is not in memory (finished)."""
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            self._subscribers.setdefault(job_id, []).append((loop, events))
+            events.put_nowait(job.to_dict())
+        return events
+
+    def unsubscribe(self, job_id, events):
+        with self._condition:
+            subscribers = self._subscribers.get(job_id, [])
+            subscribers[:] = [s for s in subscribers if s[1] is not events]
+
+    def _notify(self, job):
+        """Sends the state of a job to its subscribers. Must be called
+        holding the queue lock."""
+        state = job.to_dict()
+        for loop, events in self._subscribers.get(job.id, ()):
+            loop.call_soon_threadsafe(events.put_nowait, state)
+
+    def stats(self):
+        """Returns the queue counters as a dictionary."""
+        with self._condition:
+            running = sum(1 for job in self._jobs.values() if job.status == "running")
+            return {
+                "queued": len(self._jobs) - running,
+                "running": running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+
+job_queue = JobQueue(
+    JobStore(conf.job_store_path),
+    max_workers=conf.job_workers,
+    max_queued=conf.job_max_queued,
+    max_per_client=conf.job_max_per_client,
+    retry_after=conf.retry_after_seconds,
+    ttl=conf.job_ttl_seconds,
+)
+job_queue.expire()
+
+
+def load_source(source):
+    """Returns the image of a job, stored in the blob store at submission."""
+    blob = blob_store.get(source)
+    if blob is None:
+        raise ValueError("The uploaded image has expired")
+    return decode_image(blob.data)
+
+
+def check_cancelled(job):
+    """Raises JobCancelled if the job has been cancelled, by any process."""
+    job_queue.update(job, job.progress)
+
+
+@job_queue.handler("classification")
+def run_classification(job, params):
+    img = load_source(params["source"]) if params["source"] is not None else None
+    # jobs wait for a slot of their model instead of being degraded
+    with admission.wait_slot(params["model_id"], lambda: check_cancelled(job)):
+        if img is not None:
+            return classify_image(params["model_id"], img_id=None, custom_img_id=img)
+        return classify_image(params["model_id"], img_id=params["image_id"])
+
+
+@job_queue.handler("transform")
+def run_transform(job, params):
+    if params["source"] is not None:
+        img = load_source(params["source"])
+    else:
+        img = Image.open(IMAGE_FOLDER / params["image_id"])
+    image_format = img.format or "PNG"
+    job_queue.update(job, 0.5)
+    transformed = transform_and_encode(
+        img, image_format, params["color"], params["brightness"],
+        params["contrast"], params["sharpness"],
+    )
+    media_type = Image.MIME.get(image_format.upper(), "application/octet-stream")
+    blob_id = blob_store.put(transformed, media_type)
+    return {"blob_id": blob_id, "url": "/blobs/{}".format(blob_id)}
+
+
+@job_queue.handler("batch")
+def run_batch(job, params):
+    # (name, image id or source) pairs, classified in chunks, so that the
+    # progress is reported and a cancellation is noticed between chunks
+    items = [(image_id, image_id) for image_id in params["image_ids"]]
+    items += [(name, source) for name, source in params["sources"]]
+    size = conf.batch_max_size
+    chunks = [
+        (model_id, items[i:i + size])
+        for model_id in params["model_ids"]
+        for i in range(0, len(items), size)
+    ]
+    results = []
+    for done, (model_id, chunk) in enumerate(chunks):
+        images = [image if image in catalog else load_source(image) for _, image in chunk]
+        with admission.wait_slot(model_id, lambda: check_cancelled(job)):
+            scores_list = classify_images(model_id, images)
+        for (name, _), scores in zip(chunk, scores_list):
+            results.append({"image_id": name, "model_id": model_id, "classification_scores": scores})
+        job_queue.update(job, (done + 1) / len(chunks))
+    return results
+
+
+def client_id(request: Request):
+    """Returns the identity of the client for the per-client limits."""
+    return request.headers.get("x-client-id") or (request.client.host if request.client else "")
+
+
+def submit(request, kind, params, priority):
+    try:
+        job = job_queue.submit(client_id(request), kind, params, min(max(priority, 0), 9))
+    except ClientLimitExceeded as e:
+        return JSONResponse(status_code=429, content={"error": str(e)},
+                            headers={"Retry-After": str(conf.retry_after_seconds)})
+    url = str(request.url_for("get_job", job_id=job.id))
+    return JSONResponse(
+        status_code=202,
+        content={"job_id": job.id, "status": job.status, "url": url},
+        headers={"Location": url},
+    )
+
+
+async def store_upload(file):
+    """Validates an uploaded image and keeps it in the blob store until
+    its job runs. Returns the blob ID."""
+    contents, mime_type = await read_upload(file)
+    return blob_store.put(contents, mime_type)
+
+
+@router.post("/jobs/classification")
+async def submit_classification(
+    request: Request,
+    model_id: str = Form(...),
+    image_id: str = Form(None),
+    file: UploadFile = File(None),
+    priority: int = Form(5),
+):
+    """Submits the classification of a gallery image or of an upload."""
+    if model_id not in Configuration.models:
+        return JSONResponse(status_code=400, content={"error": f"Unknown model {model_id}"})
+    source = None
+    if file is not None and file.filename:
+        try:
+            source = await store_upload(file)
+        except UploadError as e:
+            return JSONResponse(status_code=e.status_code, content={"error": str(e)})
+    elif image_id not in catalog:
+        return JSONResponse(status_code=404, content={"error": "Image not found"})
+    params = {"model_id": model_id, "image_id": image_id, "source": source}
+    return submit(request, "classification", params, priority)
+
+
+@router.post("/jobs/transform")
+async def submit_transform(
+    request: Request,
+    image_name: str = Form(""),
+    color: float = Form(1.0),
+    brightness: float = Form(1.0),
+    contrast: float = Form(1.0),
+    sharpness: float = Form(1.0),
+    image_file: UploadFile = File(None),
+    priority: int = Form(5),
+):
+    """Submits the transformation of a gallery image or of an upload."""
+    source = None
+    if image_file is not None and image_file.filename:
+        try:
+            source = await store_upload(image_file)
+        except UploadError as e:
+            return JSONResponse(status_code=e.status_code, content={"error": str(e)})
+    elif image_name not in catalog:
+        return JSONResponse(status_code=404, content={"error": f"Image '{image_name}' not found."})
+    params = {
+        "image_id": image_name, "source": source, "color": color,
+        "brightness": brightness, "contrast": contrast, "sharpness": sharpness,
+    }
+    return submit(request, "transform", params, priority)
+
+
+@router.post("/jobs/batch")
+async def submit_batch(
+    request: Request,
+    model_ids: List[str] = Form(...),
+    image_ids: List[str] = Form([]),
+    files: List[UploadFile] = File([]),
+    priority: int = Form(5),
+):
+    """Submits the classification of many images with many models."""
+    unknown_models = [m for m in model_ids if m not in Configuration.models]
+    if unknown_models:
+        return JSONResponse(status_code=400, content={"error": f"Unknown models: {unknown_models}"})
+    missing = [image_id for image_id in image_ids if image_id not in catalog]
+    if missing:
+        return JSONResponse(status_code=404, content={"error": f"Images not found: {missing}"})
+    sources = []
+    for file in files:
+        try:
+            sources.append((file.filename, await store_upload(file)))
+        except UploadError as e:
+            return JSONResponse(status_code=e.status_code, content={"error": f"{file.filename}: {e}"})
+    params = {"model_ids": model_ids, "image_ids": image_ids, "sources": sources}
+    return submit(request, "batch", params, priority)
+
+
+@router.get("/jobs/{job_id}", name="get_job")
+def get_job(job_id: str):
+    """Returns the status, progress and result of a job."""
+    job = job_queue.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Job not found"})
+    return job.to_dict()
+
+
+@router.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    """Cancels a queued or running job, whichever process runs it."""
+    job = job_queue.cancel(job_id)
+    if job is None:
+        job = job_queue.get(job_id)
+        if job is None:
+            return JSONResponse(status_code=404, content={"error": "Job not found"})
+        return JSONResponse(status_code=409, content={"error": f"Job already {job.status}"})
+    return job.to_dict()
+
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Streams the state of a job as Server-Sent Events, one event on
+    every change, until the job is finished. The jobs of other processes
+    are followed by polling the store."""
+    events = job_queue.subscribe(job_id)
+    if events is None:
+        job = job_queue.get(job_id)
+        if job is None:
+            return JSONResponse(status_code=404, content={"error": "Job not found"})
+
+    async def poll():
+        state = job.to_dict()
+        yield "event: {}\ndata: {}\n\n".format(state["status"], json.dumps(state))
+        idle = 0.0
+        while state["status"] not in FINISHED:
+            await asyncio.sleep(conf.job_poll_seconds)
+            polled = await asyncio.to_thread(job_queue.store.load, job_id)
+            if polled is None:
+                # expired
+                return
+            if polled.to_dict() != state:
+                state, idle = polled.to_dict(), 0.0
+                yield "event: {}\ndata: {}\n\n".format(state["status"], json.dumps(state))
+                continue
+            idle += conf.job_poll_seconds
+            if idle >= conf.job_keepalive_seconds:
+                idle = 0.0
+                yield ": keep-alive\n\n"
+
+    async def stream():
+        if events is None:
+            # finished, or run by another process
+            async for event in poll():
+                yield event
+            return
+        try:
+            while True:
+                try:
+                    state = await asyncio.wait_for(events.get(), conf.job_keepalive_seconds)
+                except asyncio.TimeoutError:
+                    # a comment keeps idle connections open through proxies
+                    yield ": keep-alive\n\n"
+                    continue
+                yield "event: {}\ndata: {}\n\n".format(state["status"], json.dumps(state))
+                if state["status"] in FINISHED:
+                    return
+        finally:
+            job_queue.unsubscribe(job_id, events)
+
+    return StreamingResponse(
+        stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
@@ -0,0 +1,176 @@
+"""
+Runtime metrics of the service in the Prometheus text exposition format,
+served at /metrics. Latencies are recorded in cumulative histograms:
+the duration of every HTTP request, by route, and the duration of the
+stages of the work (image load, preprocessing, forward pass, rendering,
+...), by model where it applies. Recording a value costs a bisection and
+a few additions under a lock, so the metrics can stay enabled. Gauges
+such as queue depths, cache hit rates and memory are computed by
+collector functions only when /metrics is scraped.
+"""
+import bisect
+import os
+import threading
+import time
+
+from fastapi import APIRouter, Request
+from fastapi.responses import Response
+
+
+router = APIRouter()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Histogram:
+    """A Prometheus histogram with a fixed set of label names."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        """Records a value for the series with the given label values."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                # counts per bucket (the last one is +Inf), and the sum
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labelvalues, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ("le",), labelvalues + (bound,))
+                lines.append("{}_bucket{} {}".format(self.name, labels, cumulative))
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append("{}_sum{} {}".format(self.name, labels, total))
+            lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+class Stage:
+    """Context manager recording the duration of a stage of the work."""
+
+    __slots__ = ("labels", "start")
+
+    def __init__(self, name, model=""):
+        self.labels = (name, model)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stage_duration.observe(time.perf_counter() - self.start, *self.labels)
+
+
+request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Time until the response starts, by route.",
+    ("method", "route", "status"),
+)
+stage_duration = Histogram(
+    "stage_duration_seconds",
+    "Duration of the stages of the work, by model where it applies.",
+    ("stage", "model"),
+)
+
+_histograms = [request_duration, stage_duration]
+_collectors = []
+
+
+def stage(name, model=""):
+    """Returns a context manager that times a stage of the work:
+
+        with stage("forward", model_id):
+            ...
+    """
+    return Stage(name, model)
+
+
+def register_collector(collector):
+    """Registers a function called on every scrape, which returns a list
+    of (name, type, documentation, samples), where samples is a list of
+    (labels dict, value) pairs."""
+    _collectors.append(collector)
+
+
+def process_collector():
+    """Returns the resident memory and CPU time of the process."""
+    metrics = []
+    try:
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        metrics.append(("process_resident_memory_bytes", "gauge", "Resident memory size.", [({}, rss)]))
+    except (OSError, ValueError):
+        pass
+    times = os.times()
+    metrics.append(
+        ("process_cpu_seconds_total", "counter", "User and system CPU time.", [({}, times.user + times.system)])
+    )
+    return metrics
+
+
+register_collector(process_collector)
+
+
+def render():
+    """Returns every metric in the Prometheus text format."""
+    lines = []
+    for histogram in _histograms:
+        lines.extend(histogram.render())
+    for collector in _collectors:
+        for name, kind, documentation, samples in collector():
+            lines.append("# HELP {} {}".format(name, documentation))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in samples:
+                lines.append("{}{} {}".format(name, _format_labels(tuple(labels), tuple(labels.values())), value))
+    return "\n".join(lines) + "\n"
+
+
+async def metrics_middleware(request: Request, call_next):
+    """Records the duration of every request, labeled with the route
+    template rather than the path, to keep the number of series bounded."""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        request_duration.observe(time.perf_counter() - start, request.method, path, status)
+
+
+@router.get("/metrics")
+def get_metrics():
+    """Serves the metrics in the Prometheus text format."""
+    return Response(content=render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,202 @@
+"""
+Inference backends of the classification models. Besides the eager
+float32 torchvision models, a model can run as a frozen TorchScript
+module or an ONNX Runtime session, optionally quantized to int8:
+
+    eager                eager float32 model (default)
+    eager-dynamic        eager model with int8 dynamic quantization of
+                         the linear layers, built at load time
+    torchscript          frozen TorchScript module, float32
+    torchscript-dynamic  frozen TorchScript module, dynamic int8
+    torchscript-static   frozen TorchScript module, static int8
+                         (post-training quantization calibrated on the
+                         gallery images)
+    onnx                 ONNX Runtime session, float32
+    onnx-dynamic         ONNX Runtime session, dynamic int8
+
+The TorchScript and ONNX variants are exported ahead of time by
+app/prepare_models.py, and the backend of each model is selected with
+conf.model_backends. ONNX requires the onnx, onnxscript and onnxruntime packages.
+"""
+import copy
+import importlib
+import logging
+import os
+
+import torch
+
+from app.config import Configuration
+from app.ml.head import input_size
+
+
+conf = Configuration()
+
+BACKENDS = (
+    "eager",
+    "eager-dynamic",
+    "torchscript",
+    "torchscript-dynamic",
+    "torchscript-static",
+    "onnx",
+    "onnx-dynamic",
+)
+
+# backends that are exported to a file by app/prepare_models.py
+EXPORTED_BACKENDS = BACKENDS[2:]
+
+
+class CompiledModel:
+    """A model running on a backend other than eager float32. It is called
+    like a torch module, with a batch of input tensors, and returns the
+    batch of logits."""
+
+    def __init__(self, fn, backend, nbytes):
+        self.fn = fn
+        self.backend = backend
+        self.nbytes = nbytes
+
+    def __call__(self, inputs):
+        return self.fn(inputs)
+
+
+def backend_path(model_id, backend):
+    """Returns the path of the exported variant of a model."""
+    extension = "onnx" if backend.startswith("onnx") else "pt"
+    return os.path.join(conf.compiled_models_path, "{}.{}.{}".format(model_id, backend, extension))
+
+
+def build_eager(model_id):
+    """Builds the pretrained torchvision model specified by model_id and
+    prepares it for inference (eval mode, no gradients)."""
+    module = importlib.import_module("torchvision.models")
+    model = module.__getattribute__(model_id)(weights="DEFAULT")
+    model.eval()
+    model.requires_grad_(False)
+    return model
+
+
+def example_input(model_id, batch_size=1):
+    """Returns a random input batch of the size expected by a model."""
+    _, crop = input_size(model_id)
+    return torch.randn(batch_size, 3, crop, crop)
+
+
+def quantize_dynamic(model):
+    """Returns a copy of a model with its linear layers quantized to int8,
+    with activations quantized on the fly."""
+    return torch.ao.quantization.quantize_dynamic(
+        copy.deepcopy(model), {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def quantize_static(model, calibration):
+    """Returns a copy of a model quantized to int8 with post-training
+    static quantization, calibrating the activation ranges on the
+    calibration batches."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    engine = torch.backends.quantized.engine
+    prepared = prepare_fx(copy.deepcopy(model), get_default_qconfig_mapping(engine), (calibration[0],))
+    with torch.inference_mode():
+        for batch in calibration:
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+def _freeze(model, example):
+    # optimize_for_inference is applied when loading, since the modules
+    # it produces cannot always be serialized
+    return torch.jit.freeze(torch.jit.trace(model, example).eval())
+
+
+def export_model(model, model_id, backend, calibration=None):
+    """Exports the eager model to the given backend and returns the path of
+    the exported file. The static backend requires calibration batches."""
+    os.makedirs(conf.compiled_models_path, exist_ok=True)
+    path = backend_path(model_id, backend)
+    tmp_path = path + ".tmp"
+    example = example_input(model_id)
+
+    if backend.startswith("torchscript"):
+        if backend == "torchscript-dynamic":
+            model = quantize_dynamic(model)
+        elif backend == "torchscript-static":
+            if not calibration:
+                raise ValueError("Static quantization requires calibration images")
+            model = quantize_static(model, calibration)
+        with torch.inference_mode():
+            module = _freeze(model, example)
+        torch.jit.save(module, tmp_path)
+    elif backend in ("onnx", "onnx-dynamic"):
+        torch.onnx.export(
+            model,
+            (example,),
+            tmp_path,
+            input_names=["input"],
+            output_names=["logits"],
+            dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+        )
+        if backend == "onnx-dynamic":
+            from onnxruntime.quantization import QuantType
+            from onnxruntime.quantization import quantize_dynamic as quantize_onnx
+
+            quantized_path = path + ".int8.tmp"
+            quantize_onnx(tmp_path, quantized_path, weight_type=QuantType.QInt8)
+            os.replace(quantized_path, tmp_path)
+    else:
+        raise ValueError("Backend {} cannot be exported".format(backend))
+
+    os.replace(tmp_path, path)
+    return path
+
+
+def _load_onnx(path):
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    if conf.torch_num_threads:
+        options.intra_op_num_threads = conf.torch_num_threads
+    session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def run(inputs):
+        (logits,) = session.run(None, {"input": inputs.numpy()})
+        return torch.from_numpy(logits)
+
+    return run
+
+
+def _state_nbytes(model):
+    """Returns the size of the state of a model, including the packed
+    parameters of the quantized layers, which are stored as tuples."""
+    nbytes = 0
+    for value in model.state_dict().values():
+        for t in value if isinstance(value, tuple) else (value,):
+            if torch.is_tensor(t):
+                nbytes += t.numel() * t.element_size()
+    return nbytes
+
+
+def load_backend(model_id, backend):
+    """Returns model_id running on the given backend. If the exported
+    variant is missing, the eager model is returned instead."""
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend {} for model {}".format(backend, model_id))
+    if backend == "eager":
+        return build_eager(model_id)
+    if backend == "eager-dynamic":
+        model = quantize_dynamic(build_eager(model_id))
+        return CompiledModel(model, backend, _state_nbytes(model))
+
+    path = backend_path(model_id, backend)
+    if not os.path.exists(path):
+        logging.warning(
+            "Model {} has no {} variant, run app/prepare_models.py --backends {}; "
+            "using the eager model".format(model_id, backend, backend)
+        )
+        return build_eager(model_id)
+    nbytes = os.path.getsize(path)
+    if backend.startswith("onnx"):
+        return CompiledModel(_load_onnx(path), backend, nbytes)
+    module = torch.jit.optimize_for_inference(torch.jit.load(path).eval())
+    return CompiledModel(module, backend, nbytes)
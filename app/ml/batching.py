@@ -0,0 +1,134 @@
+"""
+Dynamic micro-batching of the forward passes. Every model has its own
+queue, served by a background thread: concurrent requests for the same
+model are stacked into a single batch (up to a maximum batch size, or
+until a maximum wait time expires), run through one forward pass, and
+each request gets back its own row of the output.
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from app.config import Configuration
+from app.metrics import stage
+from app.ml.model_registry import registry
+
+
+conf = Configuration()
+
+
+class BatchScheduler:
+    """Collects the inputs submitted for one model and runs them in
+    batches of at most max_batch_size images, waiting at most
+    max_wait_ms after the first input of a batch has arrived."""
+
+    def __init__(self, model_id, max_batch_size=16, max_wait_ms=5.0, get_model=registry.get):
+        self.model_id = model_id
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.get_model = get_model
+        self._queue = queue.Queue()
+        self.batches = 0
+        self.items = 0
+        self._thread = threading.Thread(
+            target=self._run, name="batching-{}".format(model_id), daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, tensor):
+        """Queues a preprocessed image tensor (C, H, W) and returns a
+        Future that resolves to the corresponding output row."""
+        future = Future()
+        self._queue.put((tensor, future))
+        return future
+
+    def depth(self):
+        """Returns the number of inputs waiting to be batched."""
+        return self._queue.qsize()
+
+    def _collect(self):
+        """Blocks until an input is available, then keeps collecting
+        inputs until the batch is full or the wait time has expired."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # inputs with different shapes cannot be stacked together
+            groups = {}
+            for tensor, future in batch:
+                if future.set_running_or_notify_cancel():
+                    groups.setdefault(tuple(tensor.shape), []).append((tensor, future))
+            for group in groups.values():
+                self._forward(group)
+
+    def _forward(self, group):
+        import torch
+
+        futures = [future for _, future in group]
+        try:
+            model = self.get_model(self.model_id)
+            inputs = torch.stack([tensor for tensor, _ in group])
+            with stage("batch_forward", self.model_id), torch.inference_mode():
+                out = model(inputs)
+        except Exception as e:
+            logging.exception("Batched inference failed for {}".format(self.model_id))
+            for future in futures:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.items += len(group)
+        for i, future in enumerate(futures):
+            future.set_result(out[i])
+
+    def stats(self):
+        """Returns the scheduler counters as a dictionary."""
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "queue_depth": self.depth(),
+        }
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(model_id):
+    """Returns the batch scheduler of model_id, creating it if needed."""
+    with _schedulers_lock:
+        if model_id not in _schedulers:
+            if model_id not in conf.models:
+                raise ImportError("Model {} is not configured".format(model_id))
+            _schedulers[model_id] = BatchScheduler(
+                model_id,
+                max_batch_size=conf.batch_max_size,
+                max_wait_ms=conf.batch_max_wait_ms,
+            )
+        return _schedulers[model_id]
+
+
+def run_batched(model_id, tensor):
+    """Runs a preprocessed image tensor (C, H, W) through model_id, batched
+    together with the concurrent requests for the same model, and returns
+    the output row. Blocks until the result is available."""
+    return get_scheduler(model_id).submit(tensor).result()
+
+
+def stats():
+    """Returns the counters of every batch scheduler."""
+    with _schedulers_lock:
+        return {model_id: s.stats() for model_id, s in _schedulers.items()}
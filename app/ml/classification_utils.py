@@ -2,19 +2,36 @@
 This is a simple classification service. It accepts an url of an
 image and returns the top-5 classification labels and scores.
 """
-import importlib
-import json
-import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from PIL import Image
-from torchvision import transforms
 
 from app.config import Configuration
+from app.metrics import stage
+from app.ml.batching import get_scheduler, run_batched
+from app.ml.head import DEFAULT_INPUT_SIZE, get_head, get_transform, input_size, shared_inputs
+from app.ml.model_registry import registry
+from app.ml.result_cache import image_digest, result_cache
+from app.ml.tensor_store import get_store
 
 
 conf = Configuration()
 
+# version of the preprocessing pipeline, part of the key of the cached
+# results: it must be increased whenever the preprocessing changes
+PREPROCESSING_VERSION = 2
+
+# digests of the gallery images, by image path, with their mtime
+_gallery_digests = {}
+
+# pool in which the models of an ensemble run concurrently, when the
+# forward passes are not batched by the schedulers
+_ensemble_pool = None
+_ensemble_pool_lock = threading.Lock()
+
 
 def fetch_image(image_id):
     """Gets the image from the specified ID. It returns only images
@@ -24,67 +41,256 @@ def fetch_image(image_id):
     return img
 
 
-def get_labels():
-    """Returns the labels of Imagenet dataset as a list, where
-    the index of the list corresponds to the output class."""
-    labels_path = os.path.join(conf.image_folder_path, "imagenet_labels.json")
-    with open(labels_path) as f:
-        labels = json.load(f)
-    return labels
+def gallery_image_digest(image_id, img=None):
+    """Returns the digest of a gallery image, computed once per version
+    of the file. If img is None and the digest is not known yet, None
+    is returned; otherwise the digest of img is remembered."""
+    image_path = os.path.join(conf.image_folder_path, image_id)
+    entry = gallery_store_entry(image_id)
+    if entry is not None:
+        return entry["digest"]
+    mtime = os.stat(image_path).st_mtime_ns
+    known = _gallery_digests.get(image_path)
+    if known is not None and known[0] == mtime:
+        return known[1]
+    if img is None:
+        return None
+    digest = image_digest(img)
+    _gallery_digests[image_path] = (mtime, digest)
+    return digest
+
+
+def gallery_store_entry(image_id, model_id=None):
+    """Returns the entry of a gallery image in the tensor store, or None
+    if the store is not available or does not have the image. The store
+    holds the default preprocessing, so models with a different input
+    size do not use it."""
+    if model_id is not None and input_size(model_id) != DEFAULT_INPUT_SIZE:
+        return None
+    store = get_store(PREPROCESSING_VERSION)
+    if store is None:
+        return None
+    return store.lookup(os.path.join(conf.image_folder_path, image_id))
 
 
 def get_model(model_id):
-    """Imports a pretrained model from the ones that are specified in
-    the configuration file. This is needed as we want to pre-download the
-    specified model in order to avoid unnecessary waits for the user."""
-    if model_id in conf.models:
-        try:
-            module = importlib.import_module("torchvision.models")
-            return module.__getattribute__(model_id)(weights="DEFAULT")
-        except ImportError:
-            logging.error("Model {} not found".format(model_id))
-    else:
-        raise ImportError
+    """Returns a pretrained model from the ones that are specified in
+    the configuration file. Models are loaded once, in eval mode, and
+    then shared through the model registry."""
+    return registry.get(model_id)
 
 
-def classify_image(model_id, img_id, custom_img_id=None):
-    """Returns the top-5 classification score output from the
-    model specified in model_id when it is fed with the
-    image corresponding to img_id."""
+def load_input(img_id, custom_img_id=None):
+    """Returns the digest of the image to classify and the image itself,
+    converted to RGB. Known gallery images are not decoded, and None is
+    returned in place of the image."""
+    if custom_img_id:
+        img = custom_img_id.convert("RGB")
+        return image_digest(img), img
+
+    # the digest of known gallery images does not require decoding them
+    digest = gallery_image_digest(img_id)
+    if digest is not None:
+        return digest, None
+    img = fetch_image(img_id).convert("RGB")
+    return gallery_image_digest(img_id, img), img
 
+
+def preprocess(img, model_id=None):
+    """Applies the torchvision preprocessing of model_id (the default one
+    if None) to an RGB image and returns the input tensor (C, H, W)."""
+    return get_transform(model_id)(img)
+
+
+def gallery_input(image_id, img, model_id=None):
+    """Returns the input tensor of a gallery image, read from the tensor
+    store when possible, otherwise decoded (if img is None) and
+    preprocessed."""
+    entry = gallery_store_entry(image_id, model_id)
+    if entry is not None:
+        return get_store(PREPROCESSING_VERSION).tensor(entry)
+    if img is None:
+        img = fetch_image(image_id).convert("RGB")
+    return preprocess(img, model_id)
+
+
+def top_scores(out, k=None):
+    """Returns the top-k (conf.top_k by default) classification output
+    of a row of logits as a list of pairs [label_name, score], or one
+    such list per row for a batch of logits."""
+    return get_head(k)(out)
+
+
+def result_key(model_id, digest, k=None, members=None):
+    """Returns the key of a classification result in the result cache.
+    The key includes the backend of the model, or of each of the member
+    models of an ensemble, so that changing a backend invalidates its
+    results."""
+    backends = "+".join(conf.model_backends.get(m, "eager") for m in members or [model_id])
+    version = "{}-{}-{}".format(PREPROCESSING_VERSION, conf.top_k if k is None else k, backends)
+    return result_cache.make_key(model_id, digest, version)
+
+
+def cached_result(model_id, img_id, custom_img_id=None, k=None):
+    """Returns the cached classification of an image by model_id without
+    running the model, or None. The gallery images whose digest is not
+    known yet are not decoded and return None."""
     if custom_img_id:
-        img = custom_img_id
+        digest = image_digest(custom_img_id.convert("RGB"))
     else:
-        img = fetch_image(img_id)
+        digest = gallery_image_digest(img_id)
+    if digest is None:
+        return None
+    return result_cache.get(result_key(model_id, digest, k))
+
+
+def classify_image(model_id, img_id, custom_img_id=None, k=None):
+    """Returns the top-k classification score output from the
+    model specified in model_id when it is fed with the
+    image corresponding to img_id. Results are cached by model and
+    image content, so known images are not classified again."""
+
+    with stage("load"):
+        digest, img = load_input(img_id, custom_img_id)
+    cache_key = result_key(model_id, digest, k)
+    output = result_cache.get(cache_key)
+    if output is not None:
+        return output
+
+    # apply transform from torchvision, or read the preprocessed
+    # gallery image from the tensor store
+    with stage("preprocess", model_id):
+        if custom_img_id:
+            preprocessed = preprocess(img, model_id)
+        else:
+            preprocessed = gallery_input(img_id, img, model_id)
+
+    # gets the output from the model, batched together with the
+    # concurrent requests for the same model if batching is enabled
+    with stage("forward", model_id):
+        if conf.batching_enabled:
+            out = run_batched(model_id, preprocessed)
+        else:
+            model = get_model(model_id)
+            with torch.inference_mode():
+                out = model(preprocessed.unsqueeze(0))[0]
+
+    # takes the top-k classification output and returns it
+    # as a list of pairs [label_name, score]
+    with stage("postprocess", model_id):
+        output = top_scores(out, k)
+    result_cache.put(cache_key, output)
+
+    if img is not None:
+        img.close()
+    return output
+
+
+def classify_images(model_id, images, k=None):
+    """Returns the top-k classification score output of model_id for
+    each image in images, which are either gallery image ids or PIL
+    images. Cached results are reused and the remaining images are
+    run through the model in batches of at most conf.batch_max_size."""
+    outputs = [None] * len(images)
+    pending = []
+    for i, image in enumerate(images):
+        if isinstance(image, str):
+            digest, img = load_input(image)
+        else:
+            digest, img = load_input(None, image)
+        cache_key = result_key(model_id, digest, k)
+        outputs[i] = result_cache.get(cache_key)
+        if outputs[i] is None:
+            if isinstance(image, str):
+                preprocessed = gallery_input(image, img, model_id)
+            else:
+                preprocessed = preprocess(img, model_id)
+            if img is not None:
+                img.close()
+            pending.append((i, cache_key, preprocessed))
+
+    if pending:
+        model = get_model(model_id)
+    for start in range(0, len(pending), conf.batch_max_size):
+        chunk = pending[start:start + conf.batch_max_size]
+        inputs = torch.stack([preprocessed for _, _, preprocessed in chunk])
+        with stage("forward", model_id), torch.inference_mode():
+            out = model(inputs)
+        for output, (i, cache_key, _) in zip(top_scores(out, k), chunk):
+            outputs[i] = output
+            result_cache.put(cache_key, output)
+    return outputs
+
 
+def ensemble_pool():
+    """Returns the pool of the ensembles, creating it the first time."""
+    global _ensemble_pool
+    with _ensemble_pool_lock:
+        if _ensemble_pool is None:
+            _ensemble_pool = ThreadPoolExecutor(len(conf.models), thread_name_prefix="ensemble")
+        return _ensemble_pool
+
+
+def forward(model_id, tensor):
+    """Runs an input tensor (C, H, W) through a model and returns the
+    row of logits."""
     model = get_model(model_id)
-    model.eval()
-    transform = transforms.Compose(
-        (
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        )
-    )
-
-    # apply transform from torchvision
-    img = img.convert("RGB")
-    preprocessed = transform(img).unsqueeze(0)
-
-    # gets the output from the model
-    out = model(preprocessed)
-    _, indices = torch.sort(out, descending=True)
-
-    # transforms scores as percentages
-    percentage = torch.nn.functional.softmax(out, dim=1)[0] * 100
-
-    # gets the labels
-    labels = get_labels()
-
-    # takes the top-5 classification output and returns it
-    # as a list of tuples (label_name, score)
-    output = [[labels[idx], percentage[idx].item()] for idx in indices[0][:5]]
-
-    img.close()
+    with stage("forward", model_id), torch.inference_mode():
+        return model(tensor.unsqueeze(0))[0]
+
+
+def ensemble_inputs(model_ids, img_id, img):
+    """Returns the input tensors of the models, by input size. Gallery
+    inputs are read from the tensor store when possible; the others are
+    derived from a single resized copy of the image, decoded once."""
+    inputs = {}
+    if img is None:
+        for model_id in model_ids:
+            entry = gallery_store_entry(img_id, model_id)
+            if entry is not None:
+                inputs[input_size(model_id)] = get_store(PREPROCESSING_VERSION).tensor(entry)
+    sizes = {input_size(model_id) for model_id in model_ids} - inputs.keys()
+    if sizes:
+        if img is None:
+            img = fetch_image(img_id).convert("RGB")
+        inputs.update(shared_inputs(img, sizes))
+    return inputs
+
+
+def classify_ensemble(model_ids, img_id, custom_img_id=None, k=None):
+    """Returns the top-k classification of an image by each model of
+    model_ids and the top-k of their averaged probabilities, as a
+    dictionary {"models": {model_id: scores}, "ensemble": scores}. The
+    image is decoded and resized once for all the models, and their
+    forward passes run concurrently."""
+    model_ids = list(dict.fromkeys(model_ids))
+    with stage("load"):
+        digest, img = load_input(img_id, custom_img_id)
+    cache_key = result_key("ensemble:" + "+".join(model_ids), digest, k, model_ids)
+    output = result_cache.get(cache_key)
+    if output is not None:
+        return output
+
+    with stage("preprocess", "ensemble"):
+        inputs = ensemble_inputs(model_ids, img_id, img)
+
+    # every model has its own batch scheduler, so submitting the inputs
+    # to the schedulers already runs the models concurrently
+    if conf.batching_enabled:
+        futures = {m: get_scheduler(m).submit(inputs[input_size(m)]) for m in model_ids}
+    else:
+        pool = ensemble_pool()
+        futures = {m: pool.submit(forward, m, inputs[input_size(m)]) for m in model_ids}
+    rows = {model_id: future.result() for model_id, future in futures.items()}
+
+    head = get_head(k)
+    with stage("postprocess", "ensemble"):
+        output = {
+            "models": {model_id: head(rows[model_id]) for model_id in model_ids},
+            "ensemble": head.fuse([rows[model_id] for model_id in model_ids]),
+        }
+    result_cache.put(cache_key, output)
+
+    if img is not None:
+        img.close()
     return output
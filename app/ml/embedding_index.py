@@ -0,0 +1,134 @@
+"""
+Read access to the embeddings of the gallery images, built by
+app/prepare_embeddings.py. The store is a memory-mapped float16 matrix
+(N, D) of L2-normalized penultimate-layer features, plus a JSON index
+with the image of each row. Similar images are found by cosine
+similarity, computed as a matrix-vector product over the rows.
+
+Large stores are also partitioned into an inverted file (IVF) index:
+the rows are clustered with k-means and sorted by cluster, so that each
+cluster is a contiguous slice of the matrix, and a search only scans
+the clusters whose centroids are the most similar to the query.
+"""
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from app.config import Configuration
+
+
+conf = Configuration()
+
+# version of the embeddings, stored in the index: it must be increased
+# whenever the preprocessing or the extraction of the features changes
+EMBEDDING_VERSION = 1
+
+# rows converted to float32 at a time by a search, to bound the memory
+CHUNK_ROWS = 16384
+
+# backends of the models from which the features can be extracted
+FEATURE_BACKENDS = ("eager", "eager-dynamic")
+
+
+def store_paths(path):
+    """Returns the paths of the matrix, of the index and of the centroids."""
+    return path + ".npy", path + ".json", path + ".centroids.npy"
+
+
+def normalize(vectors):
+    """Returns the rows of a matrix (or a vector) scaled to unit norm."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class EmbeddingIndex:
+    """A memory-mapped matrix of embeddings with the index of its rows."""
+
+    def __init__(self, path):
+        matrix_path, index_path, centroids_path = store_paths(path)
+        with open(index_path) as f:
+            index = json.load(f)
+        self.model_id = index["model"]
+        self.backend = index.get("backend", "eager")
+        self.version = index["version"]
+        self.ids = index["ids"]
+        self.rows = {image_id: row for row, image_id in enumerate(self.ids)}
+        # (start, end) rows of each partition, if the store is partitioned
+        self.partitions = index.get("partitions")
+        self.matrix = np.load(matrix_path, mmap_mode="r")
+        self.centroids = None
+        if self.partitions and not os.path.exists(centroids_path):
+            logging.warning("The centroids of {} are missing, searches are exhaustive".format(path))
+            self.partitions = None
+        elif self.partitions:
+            self.centroids = np.load(centroids_path)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def vector(self, image_id):
+        """Returns the embedding of a gallery image, or None."""
+        row = self.rows.get(image_id)
+        return None if row is None else self.matrix[row].astype(np.float32)
+
+    def _scan(self, query, start, end):
+        """Returns the similarities of the query with the rows in [start, end)."""
+        scores = np.empty(end - start, dtype=np.float32)
+        for i in range(start, end, CHUNK_ROWS):
+            j = min(i + CHUNK_ROWS, end)
+            scores[i - start:j - start] = self.matrix[i:j].astype(np.float32) @ query
+        return scores
+
+    def search(self, query, k=10, probes=None, exclude=None):
+        """Returns the k images most similar to a query embedding, as a
+        list of (image_id, similarity), most similar first. On a
+        partitioned store only the probes closest partitions are scanned.
+        The image exclude (the query itself) is left out."""
+        query = normalize(query)
+        if self.partitions:
+            probes = min(probes or conf.embedding_probes, len(self.partitions))
+            closest = np.argpartition(-(self.centroids @ query), probes - 1)[:probes]
+            ranges = [self.partitions[p] for p in closest]
+        else:
+            ranges = [(0, len(self.ids))]
+        rows = np.concatenate([np.arange(start, end) for start, end in ranges])
+        scores = np.concatenate([self._scan(query, start, end) for start, end in ranges])
+        if exclude is not None and exclude in self.rows:
+            scores[rows == self.rows[exclude]] = -np.inf
+
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[rows[i]], float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+
+_index = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Returns the configured embedding store, or None if it does not
+    exist or was built with another version or model."""
+    global _index, _index_loaded
+    with _index_lock:
+        if not _index_loaded:
+            _index_loaded = True
+            path = conf.embedding_store_path
+            if path is not None and all(os.path.exists(p) for p in store_paths(path)[:2]):
+                index = EmbeddingIndex(path)
+                backend = conf.model_backends.get(conf.embedding_model, "eager")
+                if (index.version, index.model_id, index.backend) == (EMBEDDING_VERSION, conf.embedding_model, backend):
+                    _index = index
+                    logging.info("Embedding store of {} images loaded from {}".format(len(index), path))
+                else:
+                    logging.warning(
+                        "Embedding store {} is outdated, run app/prepare_embeddings.py".format(path)
+                    )
+        return _index
@@ -0,0 +1,193 @@
+"""
+Extraction of the penultimate-layer features of the classification
+models (e.g. the 512-d pooled features of resnet18), and construction
+of the embedding store read by app/ml/embedding_index.py. The store is
+built in a single batched pass over the gallery, and its rows are
+partitioned with spherical k-means when the gallery is large.
+
+The features are the input of the last linear layer of the model of the
+registry, captured by a forward hook, so the weights are shared with the
+classifications. The TorchScript and ONNX backends cannot be hooked.
+"""
+import json
+import logging
+import os
+import threading
+import weakref
+
+import numpy as np
+import torch
+
+from app.config import Configuration
+from app.ml.classification_utils import gallery_input, preprocess
+from app.ml.embedding_index import EMBEDDING_VERSION, CHUNK_ROWS, FEATURE_BACKENDS, normalize, store_paths
+from app.ml.model_registry import registry
+
+
+conf = Configuration()
+
+# modules of the registry whose last linear layer is hooked
+_hooked = weakref.WeakSet()
+_hooked_lock = threading.Lock()
+# features captured by the hook, in the thread that asked for them
+_capture = threading.local()
+
+
+def feature_module(model):
+    """Returns the eager module of a model of the registry, whose last
+    linear layer can be hooked, or None for the TorchScript and ONNX
+    backends."""
+    from app.ml.backends import CompiledModel
+
+    module = model.fn if isinstance(model, CompiledModel) else model
+    if not isinstance(module, torch.nn.Module) or isinstance(module, torch.jit.ScriptModule):
+        return None
+    return module
+
+
+def last_linear(module):
+    """Returns the last linear layer of a classification model."""
+    if hasattr(module, "fc"):
+        # resnet18, inception_v3
+        return module.fc
+    # alexnet, vgg16
+    return module.classifier[-1]
+
+
+def _capture_features(layer, inputs):
+    if getattr(_capture, "active", False):
+        _capture.features = inputs[0]
+
+
+def get_extractor(model_id):
+    """Returns the model of model_id from the registry, with a hook that
+    captures the input of its last linear layer in the calling thread."""
+    model = registry.get(model_id)
+    module = feature_module(model)
+    if module is None:
+        raise ValueError("The features of {} cannot be extracted from its {} backend, use one of {}".format(
+            model_id, conf.model_backends.get(model_id, "eager"), FEATURE_BACKENDS))
+    with _hooked_lock:
+        if module not in _hooked:
+            last_linear(module).register_forward_pre_hook(_capture_features)
+            _hooked.add(module)
+    return model
+
+
+def embed(model_id, inputs):
+    """Returns the L2-normalized features of a batch of input tensors as
+    a float32 array (N, D)."""
+    model = get_extractor(model_id)
+    _capture.active = True
+    try:
+        with torch.inference_mode():
+            model(inputs)
+        features = _capture.features
+    finally:
+        _capture.active = False
+        _capture.features = None
+    return normalize(features.float().numpy())
+
+
+def embed_image(img, model_id=None):
+    """Returns the normalized features of an RGB image."""
+    model_id = model_id or conf.embedding_model
+    return embed(model_id, preprocess(img, model_id).unsqueeze(0))[0]
+
+
+def kmeans(vectors, partitions, iterations=10, seed=0):
+    """Clusters unit vectors with spherical k-means and returns the unit
+    centroids (partitions, D)."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), partitions, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = np.bincount(assignment, minlength=partitions) == 0
+        # empty clusters are restarted from random vectors
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+
+def assign(matrix, centroids):
+    """Returns the closest centroid of every row of a matrix."""
+    assignment = np.empty(len(matrix), dtype=np.int64)
+    for i in range(0, len(matrix), CHUNK_ROWS):
+        chunk = matrix[i:i + CHUNK_ROWS].astype(np.float32)
+        assignment[i:i + CHUNK_ROWS] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignment
+
+
+def default_partitions(n):
+    """Returns the number of partitions of a store of n images."""
+    if conf.embedding_partitions is not None:
+        return conf.embedding_partitions
+    if n < conf.embedding_ivf_min_images:
+        return 0
+    return int(np.sqrt(n))
+
+
+def build_embedding_store(images, model_id=None, batch_size=32, partitions=None):
+    """Computes the embeddings of the gallery images in batches and writes
+    them to the embedding store, partitioned if partitions > 0."""
+    model_id = model_id or conf.embedding_model
+    path = conf.embedding_store_path
+    matrix_path, index_path, centroids_path = store_paths(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not images:
+        raise ValueError("There are no images to embed")
+    partitions = default_partitions(len(images)) if partitions is None else partitions
+    partitions = min(partitions, len(images))
+
+    # the embeddings are written to a temporary matrix, and then moved
+    # in place, sorted by partition, so running servers are undisturbed
+    matrix = None
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        inputs = torch.stack([gallery_input(image_id, None, model_id) for image_id in batch])
+        features = embed(model_id, inputs)
+        if matrix is None:
+            matrix = np.lib.format.open_memmap(
+                matrix_path + ".tmp", mode="w+", dtype=np.float16,
+                shape=(len(images), features.shape[1]),
+            )
+        matrix[start:start + len(batch)] = features
+        logging.info("{}/{} images embedded".format(start + len(batch), len(images)))
+
+    ids = list(images)
+    index = {
+        "version": EMBEDDING_VERSION,
+        "model": model_id,
+        "backend": conf.model_backends.get(model_id, "eager"),
+        "ids": ids,
+    }
+    if partitions:
+        sample = matrix[np.random.default_rng(0).permutation(len(images))[:partitions * 64]]
+        centroids = kmeans(normalize(sample), partitions)
+        assignment = assign(matrix, centroids)
+        order = np.argsort(assignment, kind="stable")
+        sorted_matrix = np.lib.format.open_memmap(
+            matrix_path + ".sorted.tmp", mode="w+", dtype=np.float16, shape=matrix.shape
+        )
+        for i in range(0, len(order), CHUNK_ROWS):
+            sorted_matrix[i:i + CHUNK_ROWS] = matrix[order[i:i + CHUNK_ROWS]]
+        sorted_matrix.flush()
+        del matrix
+        os.replace(matrix_path + ".sorted.tmp", matrix_path + ".tmp")
+        matrix = sorted_matrix
+        ends = np.cumsum(np.bincount(assignment, minlength=partitions))
+        index["ids"] = [ids[i] for i in order]
+        index["partitions"] = [[int(start), int(end)] for start, end in zip(np.r_[0, ends[:-1]], ends)]
+        np.save(centroids_path + ".tmp.npy", centroids.astype(np.float32))
+        os.replace(centroids_path + ".tmp.npy", centroids_path)
+    matrix.flush()
+    del matrix
+
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(matrix_path + ".tmp", matrix_path)
+    os.replace(index_path + ".tmp", index_path)
+    logging.info("Embeddings of {} images stored in {}, {} partitions".format(
+        len(images), matrix_path, partitions))
@@ -0,0 +1,109 @@
+"""
+Preprocessing and post-processing shared by the classification paths.
+The ImageNet labels are read once into a tuple, the torchvision
+transforms are built once per input size, and the scores are computed
+with torch.topk on whole batches: the softmax is evaluated only for the
+k selected logits, normalized by the log-sum-exp of each row.
+"""
+import json
+import os
+from functools import lru_cache
+
+import torch
+from torchvision import transforms
+from torchvision.transforms import functional
+
+from app.config import Configuration
+
+
+conf = Configuration()
+
+# (resize, crop) of the models that are not listed in conf.model_input_sizes
+DEFAULT_INPUT_SIZE = (256, 224)
+
+NORMALIZE_MEAN = (0.485, 0.456, 0.406)
+NORMALIZE_STD = (0.229, 0.224, 0.225)
+
+
+@lru_cache(maxsize=None)
+def get_labels():
+    """Returns the labels of Imagenet dataset as a tuple, where
+    the index of the tuple corresponds to the output class."""
+    labels_path = os.path.join(conf.image_folder_path, "imagenet_labels.json")
+    with open(labels_path) as f:
+        return tuple(json.load(f))
+
+
+def input_size(model_id):
+    """Returns the (resize, crop) sizes of the input of a model."""
+    return conf.model_input_sizes.get(model_id, DEFAULT_INPUT_SIZE)
+
+
+@lru_cache(maxsize=None)
+def _transform(size):
+    resize, crop = size
+    return transforms.Compose(
+        (
+            transforms.Resize(resize),
+            transforms.CenterCrop(crop),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=NORMALIZE_MEAN, std=NORMALIZE_STD),
+        )
+    )
+
+
+def get_transform(model_id=None):
+    """Returns the preprocessing of the input of a model, or the default
+    one if model_id is None."""
+    return _transform(DEFAULT_INPUT_SIZE if model_id is None else input_size(model_id))
+
+
+def shared_inputs(img, sizes):
+    """Returns the input tensors of an RGB image for several (resize, crop)
+    sizes, by size. The image is resized once to the largest size, and
+    the inputs of the smaller sizes are derived from that buffer, which
+    is much smaller than the decoded image."""
+    largest = max(resize for resize, _ in sizes)
+    buffer = functional.resize(img, largest)
+    inputs = {}
+    for resize, crop in sizes:
+        scaled = buffer if resize == largest else functional.resize(buffer, resize)
+        tensor = functional.to_tensor(functional.center_crop(scaled, crop))
+        inputs[resize, crop] = functional.normalize(tensor, NORMALIZE_MEAN, NORMALIZE_STD)
+    return inputs
+
+
+class ClassificationHead:
+    """Turns rows of logits into the top-k labels with their scores as
+    percentages."""
+
+    def __init__(self, k):
+        self.k = k
+
+    def __call__(self, logits):
+        """Returns a list of [label, score] pairs for a row of logits, or
+        one such list per row for a batch of logits (N, C)."""
+        if logits.dim() == 1:
+            return self(logits.unsqueeze(0))[0]
+        labels = get_labels()
+        logits = logits.float()
+        values, indices = torch.topk(logits, self.k, dim=1)
+        scores = torch.exp(values - torch.logsumexp(logits, dim=1, keepdim=True)) * 100
+        return [
+            [[labels[idx], score] for idx, score in zip(row_indices, row_scores)]
+            for row_indices, row_scores in zip(indices.tolist(), scores.tolist())
+        ]
+
+    def fuse(self, rows):
+        """Returns the top-k [label, score] pairs of the average of the
+        probabilities of several rows of logits, one per model."""
+        probabilities = torch.stack([torch.softmax(row.float(), dim=0) for row in rows]).mean(dim=0)
+        values, indices = torch.topk(probabilities, self.k)
+        labels = get_labels()
+        return [[labels[idx], score * 100] for idx, score in zip(indices.tolist(), values.tolist())]
+
+
+@lru_cache(maxsize=None)
+def get_head(k=None):
+    """Returns the head returning the top k classes, conf.top_k by default."""
+    return ClassificationHead(conf.top_k if k is None else k)
@@ -0,0 +1,141 @@
+"""
+Process-wide registry of the classification models. Each model listed
+in the configuration is built (and its weights deserialized) only the
+first time it is requested; afterwards the same instance is shared by
+every request. An optional memory budget evicts the least recently
+used models when it is exceeded.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from app.config import Configuration
+from app.metrics import stage
+
+
+conf = Configuration()
+
+
+def load_model(model_id):
+    """Loads the model specified by model_id on the backend selected in
+    conf.model_backends (eager float32 by default), ready for inference."""
+    # the backends import torch, which is loaded with the first model
+    from app.ml.backends import load_backend
+
+    if model_id not in conf.models:
+        raise ImportError("Model {} is not configured".format(model_id))
+    return load_backend(model_id, conf.model_backends.get(model_id, "eager"))
+
+
+def model_nbytes(model):
+    """Returns the memory used by the parameters and buffers of a model,
+    or the size reported by a compiled model."""
+    from app.ml.backends import CompiledModel
+
+    if isinstance(model, CompiledModel):
+        return model.nbytes
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ModelRegistry:
+    """Keeps the loaded models in memory, in least recently used order.
+
+    If max_bytes is set, the least recently used models are evicted
+    whenever the total size of the loaded models exceeds it. The most
+    recently requested model is never evicted, even if it alone is
+    larger than the budget."""
+
+    def __init__(self, loader=load_model, max_bytes=None):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = {}
+
+    def get(self, model_id):
+        """Returns the model specified by model_id, loading it if needed."""
+        with self._lock:
+            if model_id in self._models:
+                self._models.move_to_end(model_id)
+                self.hits += 1
+                return self._models[model_id]
+            load_lock = self._load_locks.setdefault(model_id, threading.Lock())
+
+        # models are loaded outside the registry lock, so that a slow load
+        # does not block requests for models that are already available
+        with load_lock:
+            with self._lock:
+                if model_id in self._models:
+                    self._models.move_to_end(model_id)
+                    self.hits += 1
+                    return self._models[model_id]
+                self.misses += 1
+
+            start = time.perf_counter()
+            with stage("model_load", model_id):
+                model = self.loader(model_id)
+            elapsed = time.perf_counter() - start
+            logging.info("Model {} loaded in {:.2f}s".format(model_id, elapsed))
+
+            with self._lock:
+                self._models[model_id] = model
+                self._sizes[model_id] = model_nbytes(model)
+                self.load_seconds[model_id] = elapsed
+                self._evict()
+            return model
+
+    def _evict(self):
+        """Drops the least recently used models until the memory budget
+        is respected. Must be called holding the registry lock."""
+        if self.max_bytes is None:
+            return
+        while len(self._models) > 1 and self.nbytes() > self.max_bytes:
+            model_id, _ = self._models.popitem(last=False)
+            del self._sizes[model_id]
+            self.evictions += 1
+            logging.info("Model {} evicted from the registry".format(model_id))
+
+    def evict(self, model_id):
+        """Removes a model from the registry, if it is loaded."""
+        with self._lock:
+            if self._models.pop(model_id, None) is not None:
+                del self._sizes[model_id]
+                self.evictions += 1
+
+    def clear(self):
+        """Removes every model from the registry."""
+        with self._lock:
+            self._models.clear()
+            self._sizes.clear()
+
+    def loaded(self):
+        """Returns the ids of the loaded models, least recently used first."""
+        with self._lock:
+            return list(self._models)
+
+    def nbytes(self):
+        """Returns the memory used by the loaded models."""
+        return sum(self._sizes.values())
+
+    def stats(self):
+        """Returns the registry counters as a dictionary."""
+        with self._lock:
+            return {
+                "loaded": list(self._models),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "load_seconds": dict(self.load_seconds),
+                "nbytes": self.nbytes(),
+                "max_bytes": self.max_bytes,
+            }
+
+
+registry = ModelRegistry(max_bytes=conf.model_cache_max_bytes)
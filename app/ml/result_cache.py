@@ -0,0 +1,180 @@
+"""
+Content-addressed cache of the classification results. Results are
+keyed by the model, the SHA-256 of the decoded image and the version of
+the preprocessing pipeline, so uploads and gallery images with the same
+content share the same entries. The cache has an in-memory LRU tier,
+bounded in size and with a time to live, and an optional sqlite tier
+that survives restarts, with the same time to live and bounded to
+disk_max_entries rows. Every process opens its own connection to the
+database, since the worker processes of app/serve.py are forked.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from app.config import Configuration
+
+
+conf = Configuration()
+
+
+def image_digest(img):
+    """Returns the SHA-256 of the decoded pixels of a PIL image."""
+    h = hashlib.sha256()
+    h.update("{}:{}x{}:".format(img.mode, *img.size).encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Two-tier cache of classification results. The memory tier keeps
+    at most max_entries results, each for at most ttl seconds (None
+    disables the expiration). If path is given, results are also stored
+    in a sqlite database, which is looked up on memory misses; expired
+    rows, and the oldest rows beyond disk_max_entries, are deleted every
+    PRUNE_INTERVAL seconds."""
+
+    # interval between two prunings of the sqlite tier, in seconds
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, max_entries=10000, ttl=None, path=None, disk_max_entries=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.disk_max_entries = disk_max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        self._pruned = time.monotonic()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        """Returns the connection of this process to the sqlite tier, or
+        None if there is none. Must be called holding the cache lock."""
+        if self.path is None:
+            return None
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._pid = os.getpid()
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, expires REAL)"
+            )
+            # databases created before the expiration was stored
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(results)")}
+            if "expires" not in columns:
+                self._db.execute("ALTER TABLE results ADD COLUMN expires REAL")
+                if self.ttl is not None:
+                    self._db.execute("UPDATE results SET expires = ?", (time.time() + self.ttl,))
+            self._db.commit()
+        return self._db
+
+    def _prune(self, db):
+        """Deletes the expired rows and the oldest rows beyond
+        disk_max_entries. Must be called holding the cache lock."""
+        db.execute("DELETE FROM results WHERE expires <= ?", (time.time(),))
+        if self.disk_max_entries is not None:
+            # rows are replaced on every put, so the rowid follows the age
+            db.execute(
+                "DELETE FROM results WHERE rowid IN "
+                "(SELECT rowid FROM results ORDER BY rowid DESC LIMIT -1 OFFSET ?)",
+                (self.disk_max_entries,),
+            )
+
+    @staticmethod
+    def make_key(model_id, digest, version):
+        return "{}:{}:{}".format(model_id, digest, version)
+
+    def get(self, key):
+        """Returns the cached result for key, or None."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time.monotonic():
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                del self._memory[key]
+
+            db = self._connection()
+            if db is not None:
+                row = db.execute(
+                    "SELECT value, expires FROM results WHERE key = ? "
+                    "AND (expires IS NULL OR expires > ?)",
+                    (key, time.time()),
+                ).fetchone()
+                if row is not None:
+                    value = json.loads(row[0])
+                    # the memory entry does not outlive the disk one
+                    remaining = None if row[1] is None else row[1] - time.time()
+                    self._remember(key, value, remaining)
+                    self.disk_hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """Stores a JSON-serializable result under key."""
+        with self._lock:
+            self._remember(key, value)
+            db = self._connection()
+            if db is not None:
+                expires = time.time() + self.ttl if self.ttl is not None else None
+                db.execute(
+                    "INSERT OR REPLACE INTO results (key, value, expires) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), expires),
+                )
+                if time.monotonic() - self._pruned >= self.PRUNE_INTERVAL:
+                    self._pruned = time.monotonic()
+                    self._prune(db)
+                db.commit()
+
+    def _remember(self, key, value, ttl=None):
+        """Adds an entry to the memory tier, for ttl seconds (by default the
+        ttl of the cache), evicting the least recently used ones. Must be
+        called holding the cache lock."""
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        self._memory[key] = (expires, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        """Empties both tiers of the cache."""
+        with self._lock:
+            self._memory.clear()
+            db = self._connection()
+            if db is not None:
+                db.execute("DELETE FROM results")
+                db.commit()
+
+    def stats(self):
+        """Returns the cache counters as a dictionary."""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {
+                "entries": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": hits / lookups if lookups else 0.0,
+            }
+
+
+result_cache = ResultCache(
+    max_entries=conf.result_cache_max_entries,
+    ttl=conf.result_cache_ttl_seconds,
+    path=conf.result_cache_path,
+    disk_max_entries=conf.result_cache_disk_max_entries,
+)
@@ -0,0 +1,82 @@
+"""
+Read access to the store of preprocessed gallery images built by
+app/prepare_tensors.py. The store is a single .npy array of shape
+(N, 3, 224, 224), memory-mapped so that the pages are shared by every
+worker, plus a JSON index mapping each image to its row, the mtime of
+the file it was computed from and the digest of its decoded pixels.
+"""
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import torch
+
+from app.config import Configuration
+
+
+conf = Configuration()
+
+
+def store_paths(path):
+    """Returns the paths of the array and of the index of a store."""
+    return path + ".npy", path + ".json"
+
+
+class TensorStore:
+    """A memory-mapped array of preprocessed images with its index."""
+
+    def __init__(self, path):
+        array_path, index_path = store_paths(path)
+        with open(index_path) as f:
+            index = json.load(f)
+        self.version = index["version"]
+        self.rows = index["rows"]
+        # copy-on-write mapping: rows can be wrapped by torch tensors
+        # without copying them, and the file is never modified
+        self.array = np.load(array_path, mmap_mode="c")
+
+    def lookup(self, image_path):
+        """Returns the index entry of an image, or None if the image is not
+        in the store or has been modified since the store was built."""
+        entry = self.rows.get(os.path.basename(image_path))
+        if entry is None:
+            return None
+        try:
+            if os.stat(image_path).st_mtime_ns != entry["mtime"]:
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def tensor(self, entry):
+        """Returns the preprocessed image of an index entry as a float32
+        tensor. float32 stores are read without copying."""
+        row = torch.from_numpy(self.array[entry["row"]])
+        return row if row.dtype == torch.float32 else row.float()
+
+
+_store = None
+_store_loaded = False
+_store_lock = threading.Lock()
+
+
+def get_store(version):
+    """Returns the configured tensor store, or None if it does not exist
+    or was built with a different preprocessing version."""
+    global _store, _store_loaded
+    with _store_lock:
+        if not _store_loaded:
+            _store_loaded = True
+            path = conf.tensor_store_path
+            if path is not None and all(os.path.exists(p) for p in store_paths(path)):
+                store = TensorStore(path)
+                if store.version == version:
+                    _store = store
+                    logging.info("Tensor store loaded from {}".format(path))
+                else:
+                    logging.warning(
+                        "Tensor store {} is outdated, run app/prepare_tensors.py".format(path)
+                    )
+        return _store
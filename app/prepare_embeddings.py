@@ -0,0 +1,26 @@
+import argparse
+import logging
+import os
+import sys
+
+# Ensure the project root is in the import path, to reuse the
+# preprocessing and the models of the classification service
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import Configuration
+from app.ml.embeddings import build_embedding_store
+from app.utils import list_images
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=build_embedding_store.__doc__)
+    parser.add_argument("--batch-size", type=int, default=Configuration.batch_max_size)
+    parser.add_argument(
+        "--partitions",
+        type=int,
+        default=None,
+        help="partitions of the IVF index, 0 for none (by default about sqrt(N) for large galleries)",
+    )
+    args = parser.parse_args()
+    build_embedding_store(sorted(list_images()), Configuration.embedding_model, args.batch_size, args.partitions)
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# Ensure the project root is in the import path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.histogram import precompute_histograms
+
+
+if __name__ == "__main__":
+    precompute_histograms()
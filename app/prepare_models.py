@@ -1,7 +1,19 @@
+import argparse
 import importlib
 import logging
+import os
+import sys
 
-from config import Configuration
+import torch
+
+# Ensure the project root is in the import path, to reuse the model
+# backends and the preprocessing of the classification service
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import Configuration
+from app.ml.backends import EXPORTED_BACKENDS, build_eager, export_model
+from app.ml.classification_utils import fetch_image, preprocess
+from app.utils import list_images
 
 conf = Configuration()
 
@@ -18,5 +30,48 @@ def prepare_models():
             logging.error("Model {} not found".format(model_name))
 
 
+def calibration_batches(model_id, n_images, batch_size=8):
+    """Returns batches of preprocessed gallery images, used to calibrate
+    the static quantization of a model."""
+    images = list_images()[:n_images]
+    inputs = [preprocess(fetch_image(image_id).convert("RGB"), model_id) for image_id in images]
+    return [torch.stack(inputs[i:i + batch_size]) for i in range(0, len(inputs), batch_size)]
+
+
+def export_models(backends, models=None, n_calibration=32):
+    """Exports the configured models to the given inference backends."""
+    for model_id in models or conf.models:
+        model = build_eager(model_id)
+        calibration = None
+        if "torchscript-static" in backends:
+            calibration = calibration_batches(model_id, n_calibration)
+        for backend in backends:
+            try:
+                path = export_model(model, model_id, backend, calibration)
+                logging.info("Model {} exported to {}".format(model_id, path))
+            except Exception as e:
+                logging.error("Model {} could not be exported to {}: {}".format(model_id, backend, e))
+        del model
+
+
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=prepare_models.__doc__)
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        choices=EXPORTED_BACKENDS,
+        default=(),
+        help="also export the models to these backends, see app/ml/backends.py",
+    )
+    parser.add_argument("--models", nargs="+", choices=conf.models, help="models to export, all by default")
+    parser.add_argument(
+        "--calibration-images",
+        type=int,
+        default=32,
+        help="gallery images used to calibrate the static quantization",
+    )
+    args = parser.parse_args()
     prepare_models()
+    if args.backends:
+        export_models(args.backends, args.models, args.calibration_images)
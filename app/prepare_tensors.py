@@ -0,0 +1,65 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+# Ensure the project root is in the import path, to reuse the
+# preprocessing of the classification service
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import Configuration
+from app.ml.classification_utils import (
+    PREPROCESSING_VERSION,
+    fetch_image,
+    preprocess,
+)
+from app.ml.result_cache import image_digest
+from app.ml.tensor_store import store_paths
+from app.utils import list_images
+
+
+def prepare_tensors(dtype="float32"):
+    """Decodes and preprocesses every image of the gallery once, and
+    stores the results in a memory-mappable array with its index."""
+    conf = Configuration()
+    path = conf.tensor_store_path
+    array_path, index_path = store_paths(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # the store is written to temporary files and then moved in place,
+    # so running servers keep reading the old mapping undisturbed
+    images = sorted(list_images())
+    array = np.lib.format.open_memmap(
+        array_path + ".tmp", mode="w+", dtype=dtype, shape=(len(images), 3, 224, 224)
+    )
+    rows = {}
+    for row, image_id in enumerate(images):
+        image_path = os.path.join(conf.image_folder_path, image_id)
+        mtime = os.stat(image_path).st_mtime_ns
+        img = fetch_image(image_id).convert("RGB")
+        array[row] = preprocess(img).numpy()
+        rows[image_id] = {"row": row, "mtime": mtime, "digest": image_digest(img)}
+        img.close()
+    array.flush()
+    del array
+
+    with open(index_path + ".tmp", "w") as f:
+        json.dump({"version": PREPROCESSING_VERSION, "dtype": dtype, "rows": rows}, f)
+    os.replace(array_path + ".tmp", array_path)
+    os.replace(index_path + ".tmp", index_path)
+    logging.info(f"{len(images)} preprocessed images stored in {array_path}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=prepare_tensors.__doc__)
+    parser.add_argument(
+        "--dtype",
+        choices=("float32", "float16"),
+        default=Configuration.tensor_store_dtype,
+        help="float32 rows are read without copies, float16 halves the size",
+    )
+    args = parser.parse_args()
+    prepare_tensors(args.dtype)
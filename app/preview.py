@@ -0,0 +1,126 @@
+"""
+Fast previews for the transformation page. The source image (a gallery
+image or an uploaded image kept in the blob store) is decoded once into
+a downscaled proxy, which is cached; every slider change only enhances
+the proxy and encodes a small JPEG. The full-resolution image is still
+rendered by POST /transform.
+"""
+import io
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from fastapi import APIRouter, File, Query, UploadFile
+from fastapi.responses import JSONResponse, Response
+from PIL import Image
+
+from app.blob_store import blob_store
+from app.catalog import catalog
+from app.config import Configuration
+from app.enhancement import enhance
+from app.executors import codec_pool
+from app.uploads import UploadError, read_upload
+
+router = APIRouter()
+conf = Configuration()
+IMAGE_FOLDER = Path(conf.image_folder_path)
+
+_proxies = OrderedDict()
+_proxies_lock = threading.Lock()
+
+
+def source_version(source):
+    """Returns a value that changes whenever the content of a source
+    changes, or None if the source does not exist."""
+    if blob_store.is_blob_id(source):
+        blob = blob_store.get(source)
+        return blob.etag if blob is not None else None
+    entry = catalog.get(source)
+    return entry.mtime_ns if entry is not None else None
+
+
+def load_proxy(source, max_side):
+    """Decodes a source image into a proxy whose longest side is at most
+    max_side. JPEG images are decoded directly at a reduced scale."""
+    if blob_store.is_blob_id(source):
+        blob = blob_store.get(source)
+        if blob is None:
+            # expired since its version was read
+            raise FileNotFoundError(source)
+        img = Image.open(io.BytesIO(blob.data))
+        width, height = img.size
+        if width * height > conf.upload_max_pixels:
+            raise UploadError("The uploaded image is too large.", status_code=413)
+    else:
+        img = Image.open(IMAGE_FOLDER / source)
+    img.draft("RGB", (max_side, max_side))
+    img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    img.thumbnail((max_side, max_side))
+    return img
+
+
+def get_proxy(source, max_side):
+    """Returns the cached proxy of a source, or None if it does not exist
+    or cannot be decoded."""
+    version = source_version(source)
+    if version is None:
+        return None
+    key = (source, version, max_side)
+    with _proxies_lock:
+        if key in _proxies:
+            _proxies.move_to_end(key)
+            return _proxies[key]
+    try:
+        proxy = load_proxy(source, max_side)
+    except (OSError, Image.DecompressionBombError):
+        # removed meanwhile, not an image, or too large to be decoded
+        return None
+    with _proxies_lock:
+        _proxies[key] = proxy
+        while len(_proxies) > conf.preview_cache_size:
+            _proxies.popitem(last=False)
+    return proxy
+
+
+def render_preview(source, max_side, color, brightness, contrast, sharpness):
+    """Enhances the proxy of a source and encodes it as a JPEG, or returns
+    None if the source does not exist."""
+    proxy = get_proxy(source, max_side)
+    if proxy is None:
+        return None
+    preview = enhance(proxy, color, brightness, contrast, sharpness)
+    buf = io.BytesIO()
+    preview.convert("RGB").save(buf, format="JPEG", quality=conf.preview_quality)
+    return buf.getvalue()
+
+
+@router.post("/transform/source")
+async def upload_transform_source(image_file: UploadFile = File(...)):
+    """Stores an uploaded image for previews and returns its source ID."""
+    try:
+        contents, mime_type = await read_upload(image_file)
+    except UploadError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e)})
+    return {"source": blob_store.put(contents, mime_type)}
+
+
+@router.get("/transform/preview")
+async def transform_preview(
+    source: str,
+    color: float = 1.0,
+    brightness: float = 1.0,
+    contrast: float = 1.0,
+    sharpness: float = 1.0,
+    size: int = Query(None, ge=1),
+):
+    """Returns a downscaled JPEG preview of the enhanced source image."""
+    max_side = min(size or conf.preview_max_side, conf.preview_max_side)
+    try:
+        content = await codec_pool.run(
+            render_preview, source, max_side, color, brightness, contrast, sharpness
+        )
+    except UploadError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e)})
+    if content is None:
+        return JSONResponse(status_code=404, content={"error": "Image not found"})
+    return Response(content=content, media_type="image/jpeg")
@@ -0,0 +1,207 @@
+"""
+Chart rendering for the downloadable plots. Charts are drawn with the
+object-oriented matplotlib API on Agg canvases, without the global state
+of pyplot: every thread keeps its own figure for each chart type and
+size, which is reused from one chart to the next. Rendered charts are
+cached by content, chart type, size and format. The top-5 bar chart and
+the histogram can also be produced as small SVG documents, without
+matplotlib at all.
+"""
+import hashlib
+import io
+import json
+import threading
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+
+from app.config import Configuration
+from app.metrics import stage
+
+
+conf = Configuration()
+
+FORMATS = ("png", "svg")
+MEDIA_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+class ChartCache:
+    """LRU cache of the rendered charts."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._charts = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            chart = self._charts.get(key)
+            if chart is None:
+                self.misses += 1
+                return None
+            self._charts.move_to_end(key)
+            self.hits += 1
+            return chart
+
+    def put(self, key, chart):
+        with self._lock:
+            self._charts[key] = chart
+            self._charts.move_to_end(key)
+            while len(self._charts) > self.max_entries:
+                self._charts.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._charts), "hits": self.hits, "misses": self.misses}
+
+
+chart_cache = ChartCache(conf.chart_cache_size)
+_templates = threading.local()
+
+
+def content_key(chart_type, content, size, fmt):
+    """Returns the cache key of a chart."""
+    digest = hashlib.sha256(json.dumps(content).encode()).hexdigest()
+    return (digest, chart_type, tuple(size), fmt)
+
+
+def get_template(chart_type, size):
+    """Returns the figure and axes of this thread for a chart type and
+    size, creating them the first time."""
+    templates = getattr(_templates, "figures", None)
+    if templates is None:
+        templates = _templates.figures = {}
+    key = (chart_type, tuple(size))
+    if key not in templates:
+        # matplotlib is imported with the first chart, not at startup
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        fig = Figure(figsize=size)
+        FigureCanvasAgg(fig)
+        templates[key] = (fig, fig.add_subplot())
+    return templates[key]
+
+
+def top_scores(scores, k=5):
+    """Returns the labels and values of the k highest scores."""
+    classification_dict = dict(scores)
+    sorted_items = sorted(classification_dict.items(), key=lambda x: x[1], reverse=True)[:k]
+    return [list(item) for item in sorted_items]
+
+
+def _png(fig):
+    buf = io.BytesIO()
+    fig.canvas.print_png(buf)
+    return buf.getvalue()
+
+
+def _scores_png(items, size):
+    fig, ax = get_template("scores", size)
+    ax.cla()
+    labels, values = zip(*items) if items else ([], [])
+    ax.bar(labels, values)
+    ax.set_title("Top 5 Classification Scores")
+    ax.set_xlabel("Class")
+    ax.set_ylabel("Score")
+    fig.tight_layout()
+    return _png(fig)
+
+
+def _scores_svg(items, size):
+    width, height = size[0] * 100, size[1] * 100
+    left, bottom, top = 60, 40, 30
+    plot_width, plot_height = width - left - 20, height - bottom - top
+    peak = max([v for _, v in items] + [1e-9])
+    slot = plot_width / max(len(items), 1)
+    parts = [
+        f'<text x="{width / 2}" y="20" text-anchor="middle">Top 5 Classification Scores</text>',
+        f'<line x1="{left}" y1="{top + plot_height}" x2="{left + plot_width}" '
+        f'y2="{top + plot_height}" stroke="black"/>',
+    ]
+    for i, (label, value) in enumerate(items):
+        bar_height = plot_height * value / peak
+        x = left + i * slot + slot * 0.1
+        parts.append(
+            f'<rect x="{x:.1f}" y="{top + plot_height - bar_height:.1f}" '
+            f'width="{slot * 0.8:.1f}" height="{bar_height:.1f}" fill="#1f77b4"/>'
+        )
+        parts.append(
+            f'<text x="{x + slot * 0.4:.1f}" y="{top + plot_height + 15}" '
+            f'text-anchor="middle" font-size="11">{escape(str(label))}</text>'
+        )
+        parts.append(
+            f'<text x="{x + slot * 0.4:.1f}" y="{top + plot_height - bar_height - 4:.1f}" '
+            f'text-anchor="middle" font-size="10">{value:.2f}</text>'
+        )
+    return _svg(width, height, parts)
+
+
+def _histogram_png(hist, title, size):
+    fig, ax = get_template("histogram", size)
+    if not ax.lines:
+        ax.plot(range(256), [0] * 256, color='black')
+        ax.set_xlabel('Pixel Value')
+        ax.set_ylabel('Frequency')
+    ax.lines[0].set_ydata(hist)
+    ax.relim()
+    ax.autoscale_view()
+    ax.set_title(title)
+    return _png(fig)
+
+
+def _histogram_svg(hist, title, size):
+    width, height = size[0] * 100, size[1] * 100
+    left, bottom, top = 50, 30, 30
+    plot_width, plot_height = width - left - 20, height - bottom - top
+    peak = max(max(hist), 1)
+    step = plot_width / (len(hist) - 1)
+    points = " ".join(
+        f"{left + i * step:.1f},{top + plot_height * (1 - v / peak):.1f}"
+        for i, v in enumerate(hist)
+    )
+    parts = [
+        f'<text x="{width / 2}" y="20" text-anchor="middle">{escape(title)}</text>',
+        f'<polyline points="{points}" fill="none" stroke="black"/>',
+        f'<line x1="{left}" y1="{top + plot_height}" x2="{left + plot_width}" '
+        f'y2="{top + plot_height}" stroke="black"/>',
+        f'<text x="{width / 2}" y="{height - 8}" text-anchor="middle" font-size="11">Pixel Value</text>',
+    ]
+    return _svg(width, height, parts)
+
+
+def _svg(width, height, parts):
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.0f}" height="{height:.0f}" '
+        f'font-family="sans-serif" font-size="14">' + "".join(parts) + "</svg>"
+    ).encode()
+
+
+def render_scores_chart(scores, fmt="png", size=(8, 4)):
+    """Renders the top-5 classification scores as a bar chart, in the
+    given format, and returns the encoded chart."""
+    items = top_scores(scores)
+    key = content_key("scores", items, size, fmt)
+    chart = chart_cache.get(key)
+    if chart is None:
+        with stage("plot_render"):
+            chart = _scores_svg(items, size) if fmt == "svg" else _scores_png(items, size)
+        chart_cache.put(key, chart)
+    return chart
+
+
+def render_histogram_chart(hist, title, fmt="png", size=(6.4, 4.8)):
+    """Renders a 256-bin histogram as a line chart, in the given format,
+    and returns the encoded chart."""
+    hist = [int(v) for v in hist]
+    key = content_key("histogram", [title, hist], size, fmt)
+    chart = chart_cache.get(key)
+    if chart is None:
+        with stage("plot_render"):
+            if fmt == "svg":
+                chart = _histogram_svg(hist, title, size)
+            else:
+                chart = _histogram_png(hist, title, size)
+        chart_cache.put(key, chart)
+    return chart
@@ -0,0 +1,156 @@
+"""
+Multi-process launcher of the service. Unlike `uvicorn --workers`, which
+starts every worker from scratch, the models are loaded once in the
+parent process, their weights are moved to shared memory, and the
+workers are forked from the parent: the memory used by the weights
+scales with the number of models, not with models x workers. The torch
+intra-op threads are split among the workers, so that they do not
+oversubscribe the cores.
+
+    python app/serve.py --workers 4 --port 8000
+"""
+import argparse
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+# Ensure the project root is in the import path, to import the app
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+import torch
+import uvicorn
+
+from app.config import Configuration
+
+
+conf = Configuration()
+
+
+def worker_threads(workers):
+    """Returns the number of torch intra-op threads of each worker."""
+    if conf.torch_num_threads is not None:
+        return conf.torch_num_threads
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def share_models(model_ids):
+    """Loads the models in the registry of this process and moves their
+    weights to shared memory, so that forked workers do not copy them."""
+    from app.ml.model_registry import registry
+
+    for model_id in model_ids:
+        model = registry.get(model_id)
+        if isinstance(model, torch.nn.Module):
+            model.share_memory()
+    return registry.nbytes()
+
+
+def bind_socket(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock, threads, log_level):
+    """Serves the app on the inherited socket. Runs in a forked worker."""
+    torch.set_num_threads(threads)
+    config = uvicorn.Config(app, log_level=log_level)
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+
+
+def fork_worker(app, sock, threads, log_level):
+    pid = os.fork()
+    if pid == 0:
+        # the parent's signal handlers must not run in the worker
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            run_worker(app, sock, threads, log_level)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def serve(host, port, workers, model_ids, log_level="info"):
+    """Loads the models, forks the workers and restarts them if they die,
+    until the launcher receives SIGINT or SIGTERM."""
+    # uploaded images must be visible to every worker
+    shared_dir = None
+    if conf.blob_shared_dir is None:
+        shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        shared_dir = tempfile.mkdtemp(prefix="blobs-", dir=shm)
+        Configuration.blob_shared_dir = shared_dir
+
+    os.chdir(ROOT)
+    from main import app
+
+    # the parent only loads weights: with a single thread no OpenMP pool
+    # is started, which the forked workers could not use
+    torch.set_num_threads(1)
+
+    start = time.perf_counter()
+    nbytes = share_models(model_ids)
+    logging.info("{} models loaded in {:.1f}s, {:.0f} MB shared".format(
+        len(model_ids), time.perf_counter() - start, nbytes / 2**20))
+
+    sock = bind_socket(host, port)
+    threads = worker_threads(workers)
+    logging.info("Starting {} workers with {} torch threads each on http://{}:{}".format(
+        workers, threads, host, port))
+    pids = {fork_worker(app, sock, threads, log_level) for _ in range(workers)}
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while pids:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        pids.discard(pid)
+        if not stopping:
+            logging.warning("Worker {} exited with status {}, restarting it".format(pid, status))
+            pids.add(fork_worker(app, sock, threads, log_level))
+    sock.close()
+    if shared_dir is not None:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        choices=conf.models,
+        default=conf.models,
+        help="models loaded before forking, the others are loaded by each worker",
+    )
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.models, args.log_level)
@@ -0,0 +1,78 @@
+"""
+Search of the gallery images most similar to a gallery image or to an
+upload, by cosine similarity of their embeddings (see
+app/ml/embedding_index.py). The embeddings of the gallery are read from
+the store built by app/prepare_embeddings.py, so only an uploaded image
+is run through the feature extractor.
+"""
+from fastapi import APIRouter, File, Query, UploadFile
+from fastapi.responses import JSONResponse
+
+from app.admission import admission
+from app.catalog import catalog
+from app.executors import codec_pool, inference_pool
+from app.ml.embedding_index import get_index
+from app.uploads import UploadError, decode_image, read_upload
+
+router = APIRouter()
+
+MISSING_STORE = "The embedding store is not available, run app/prepare_embeddings.py"
+
+
+def search_gallery(index, image_id, k, probes):
+    """Returns the images most similar to a gallery image."""
+    return index.search(index.vector(image_id), k, probes, exclude=image_id)
+
+
+def search_upload(index, content, k, probes):
+    """Decodes an uploaded image, extracts its embedding and returns the
+    most similar gallery images."""
+    from app.ml.embeddings import embed_image
+
+    img = decode_image(content).convert("RGB")
+    return index.search(embed_image(img, index.model_id), k, probes)
+
+
+def format_results(results):
+    # images removed from the gallery after the store was built are skipped
+    return [
+        {"image_id": image_id, "similarity": similarity}
+        for image_id, similarity in results
+        if image_id in catalog
+    ]
+
+
+@router.get("/similar")
+async def similar_images(
+    image_id: str,
+    k: int = Query(10, ge=1, le=1000),
+    probes: int = Query(None, ge=1),
+):
+    """Returns the k gallery images most similar to a gallery image."""
+    index = get_index()
+    if index is None:
+        return JSONResponse(status_code=503, content={"error": MISSING_STORE})
+    if image_id not in catalog or index.vector(image_id) is None:
+        return JSONResponse(status_code=404, content={"error": "Image not found"})
+    results = await codec_pool.run(search_gallery, index, image_id, k, probes)
+    return {"image_id": image_id, "model_id": index.model_id, "results": format_results(results)}
+
+
+@router.post("/similar")
+async def similar_to_upload(
+    file: UploadFile = File(...),
+    k: int = Query(10, ge=1, le=1000),
+    probes: int = Query(None, ge=1),
+):
+    """Returns the k gallery images most similar to an uploaded image."""
+    index = get_index()
+    if index is None:
+        return JSONResponse(status_code=503, content={"error": MISSING_STORE})
+    try:
+        content, _ = await read_upload(file)
+        # the feature extractor is the embedding model, within its limits
+        async with admission.slot(index.model_id):
+            results = await inference_pool.run(search_upload, index, content, k, probes)
+    except UploadError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e)})
+    return {"image_id": file.filename, "model_id": index.model_id, "results": format_results(results)}
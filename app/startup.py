@@ -0,0 +1,157 @@
+"""
+Startup of the service. The heavy libraries (torch and torchvision,
+OpenCV, matplotlib, libmagic) are imported by the modules that use them
+only when they are first needed, so the pages that do not need them are
+served as soon as the server starts. The classification entry points
+below import the classification module on their first call, which
+happens in the inference pool rather than on the event loop.
+
+When the server starts, a background thread then imports the libraries
+and loads the models of conf.warmup_models, running each of them once
+on a dummy batch of every size in conf.warmup_batch_sizes, so that the
+first requests do not pay for loading the weights and for the first
+inference. /ready answers 503 until the warm-up is complete.
+"""
+import logging
+import threading
+import time
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from app.config import Configuration
+
+
+router = APIRouter()
+conf = Configuration()
+
+
+def classify_image(*args, **kwargs):
+    """Calls app.ml.classification_utils.classify_image, importing it
+    on the first call."""
+    from app.ml.classification_utils import classify_image
+
+    return classify_image(*args, **kwargs)
+
+
+def classify_images(*args, **kwargs):
+    """Calls app.ml.classification_utils.classify_images, importing it
+    on the first call."""
+    from app.ml.classification_utils import classify_images
+
+    return classify_images(*args, **kwargs)
+
+
+def classify_ensemble(*args, **kwargs):
+    """Calls app.ml.classification_utils.classify_ensemble, importing it
+    on the first call."""
+    from app.ml.classification_utils import classify_ensemble
+
+    return classify_ensemble(*args, **kwargs)
+
+
+def cached_classification(*args, **kwargs):
+    """Calls app.ml.classification_utils.cached_result, importing it
+    on the first call."""
+    from app.ml.classification_utils import cached_result
+
+    return cached_result(*args, **kwargs)
+
+
+def import_libraries():
+    """Imports the modules whose import is deferred."""
+    import cv2  # noqa: F401
+    import magic  # noqa: F401
+    from matplotlib.backends.backend_agg import FigureCanvasAgg  # noqa: F401
+    from matplotlib.figure import Figure  # noqa: F401
+
+    import app.ml.backends  # noqa: F401
+    import app.ml.classification_utils  # noqa: F401
+
+
+def warm_model(model_id, batch_sizes):
+    """Loads a model and runs it, with the classification head, on a
+    dummy batch of each size."""
+    import torch
+
+    from app.ml.head import get_head, input_size
+    from app.ml.model_registry import registry
+
+    model = registry.get(model_id)
+    _, crop = input_size(model_id)
+    head = get_head()
+    with torch.inference_mode():
+        for batch_size in batch_sizes:
+            head(model(torch.zeros(batch_size, 3, crop, crop)))
+
+
+class Warmup:
+    """Imports the deferred libraries and warms up the models in a
+    background thread, and keeps the state of each step."""
+
+    def __init__(self, model_ids, batch_sizes):
+        self.model_ids = tuple(model_ids)
+        self.batch_sizes = tuple(batch_sizes)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.states = {"libraries": "pending"}
+        self.states.update((model_id, "pending") for model_id in self.model_ids)
+        self.seconds = {}
+        self.errors = {}
+
+    def start(self):
+        """Starts the warm-up, once."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+        self._thread.start()
+
+    def _step(self, name, fn, *args):
+        with self._lock:
+            self.states[name] = "running"
+        start = time.perf_counter()
+        try:
+            fn(*args)
+        except Exception as e:
+            logging.exception("Warm-up of {} failed".format(name))
+            with self._lock:
+                self.states[name] = "failed"
+                self.errors[name] = str(e)
+            return
+        with self._lock:
+            self.states[name] = "ready"
+            self.seconds[name] = time.perf_counter() - start
+        logging.info("Warm-up of {} done in {:.2f}s".format(name, self.seconds[name]))
+
+    def _run(self):
+        self._step("libraries", import_libraries)
+        for model_id in self.model_ids:
+            self._step(model_id, warm_model, model_id, self.batch_sizes)
+
+    def ready(self):
+        """Returns True when every step has completed successfully."""
+        with self._lock:
+            return all(state == "ready" for state in self.states.values())
+
+    def stats(self):
+        """Returns the state of each step as a dictionary."""
+        with self._lock:
+            return {
+                "states": dict(self.states),
+                "seconds": dict(self.seconds),
+                "errors": dict(self.errors),
+            }
+
+
+warmup = Warmup(conf.warmup_models, conf.warmup_batch_sizes)
+
+
+@router.get("/ready")
+def ready():
+    """Answers 200 when the warm-up is complete, 503 until then, with
+    the state of each step of the warm-up."""
+    return JSONResponse(
+        status_code=200 if warmup.ready() else 503,
+        content={"ready": warmup.ready(), **warmup.stats()},
+    )
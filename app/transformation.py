@@ -1,17 +1,47 @@
-import base64
 import io
 from pathlib import Path
 from fastapi import APIRouter, Request, Form, UploadFile, File
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
-from PIL import Image, ImageEnhance
+from PIL import Image
+from app.catalog import catalog
 from app.utils import list_images
 from app.config import Configuration
+from app.blob_store import blob_store
+from app.enhancement import enhance
+from app.executors import codec_pool
+from app.metrics import stage
+from app.uploads import UploadError, decode_image, read_upload
 
 router = APIRouter()
 templates = Jinja2Templates(directory="app/templates")
 IMAGE_FOLDER = Path(Configuration().image_folder_path)
 
+
+def enhance_image(img, color, brightness, contrast, sharpness):
+    """Applies the color, brightness, contrast and sharpness enhancements
+    to an image, in this order, with the fused enhancement engine."""
+    return enhance(img, color, brightness, contrast, sharpness)
+
+
+def encode_image(img, fmt):
+    """Encodes a PIL image in the given format for rendering or downloading."""
+    buf = io.BytesIO()
+    # Convert RGBA to RGB if format doesn't support transparency
+    if fmt.upper() == "JPEG" and img.mode == "RGBA":
+        img = img.convert("RGB")
+    img.save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def transform_and_encode(original_img, image_format, color, brightness, contrast, sharpness):
+    """Enhances an image and returns the transformed image encoded in
+    the format of the original one."""
+    with stage("enhance"):
+        transformed_img = enhance_image(original_img, color, brightness, contrast, sharpness)
+    with stage("encode"):
+        return encode_image(transformed_img, image_format)
+
 @router.get("/transform", response_class=HTMLResponse)
 def show_transform_form(request: Request):
     # Render the image transformation form with a list of available images
@@ -30,23 +60,49 @@ async def apply_transformations(
     contrast: float = Form(1.0),
     sharpness: float = Form(1.0),
     image_file: UploadFile = File(None),
+    source: str = Form(""),
+    source_name: str = Form(""),
 ):
-    # Load the image from upload or selection
-    if image_file and image_file.filename:
+    # Load the image from upload or selection; an image already uploaded
+    # for the previews is referenced by its blob ID instead
+    blob = blob_store.get(source) if blob_store.is_blob_id(source) else None
+    if source and blob is None:
+        # the file input is disabled once the image is uploaded, so there
+        # is nothing else to fall back on
+        return templates.TemplateResponse("transform.html", {
+            "request": request,
+            "error": "The uploaded image has expired, please upload it again.",
+            "images": list_images()
+        }, status_code=410)
+    if blob is not None:
         try:
-            contents = await image_file.read()
-            original_img = Image.open(io.BytesIO(contents))
+            original_img = await codec_pool.run(decode_image, blob.data)
+            image_format = original_img.format or "PNG"
+        except UploadError as e:
+            return templates.TemplateResponse("transform.html", {
+                "request": request,
+                "error": f"Failed to load uploaded image: {e}",
+                "images": list_images()
+            }, status_code=e.status_code)
+        image_name_display = source_name or "image"
+        original_url = request.url_for("get_blob", blob_id=source)
+    elif image_file and image_file.filename:
+        try:
+            contents, mime_type = await read_upload(image_file)
+            original_img = await codec_pool.run(decode_image, contents)
             image_format = original_img.format or "PNG"  # Default to PNG if format not detected
-        except Exception as e:
+        except UploadError as e:
             return templates.TemplateResponse("transform.html", {
                 "request": request,
                 "error": f"Failed to load uploaded image: {e}",
                 "images": list_images()
-            })
+            }, status_code=e.status_code)
         image_name_display = image_file.filename
+        # the uploaded file is served as it is, without encoding it again
+        original_url = request.url_for("get_blob", blob_id=blob_store.put(contents, mime_type))
     elif image_name:
         image_path = IMAGE_FOLDER / image_name
-        if not image_path.is_file():
+        if image_name not in catalog:
             return templates.TemplateResponse("transform.html", {
                 "request": request,
                 "error": f"Image '{image_name}' not found.",
@@ -62,6 +118,7 @@ async def apply_transformations(
                 "images": list_images()
             })
         image_name_display = image_name
+        original_url = request.url_for("static", path=f"imagenet_subset/{image_name}")
     else:
         # No image selected or uploaded
         return templates.TemplateResponse("transform.html", {
@@ -70,38 +127,29 @@ async def apply_transformations(
             "images": list_images()
         })
 
-    # Apply image enhancements in sequence
-    transformed_img = ImageEnhance.Color(original_img).enhance(color)
-    transformed_img = ImageEnhance.Brightness(transformed_img).enhance(brightness)
-    transformed_img = ImageEnhance.Contrast(transformed_img).enhance(contrast)
-    transformed_img = ImageEnhance.Sharpness(transformed_img).enhance(sharpness)
-
-    # Convert a PIL image to base64 for rendering or downloading
-    def img_to_base64(img, fmt):
-        buf = io.BytesIO()
-        # Convert RGBA to RGB if format doesn't support transparency
-        if fmt.upper() == "JPEG" and img.mode == "RGBA":
-            img = img.convert("RGB")
-        img.save(buf, format=fmt)
-        return base64.b64encode(buf.getvalue()).decode("utf-8")
-
-    # Convert both original and transformed images to base64
-    original_b64 = img_to_base64(original_img, image_format)
-    transformed_b64 = img_to_base64(transformed_img, image_format)
+    # Apply image enhancements in sequence and encode the transformed
+    # image, off the event loop; the page references it in the blob store
+    transformed = await codec_pool.run(
+        transform_and_encode,
+        original_img, image_format, color, brightness, contrast, sharpness,
+    )
+    media_type = Image.MIME.get(image_format.upper(), "application/octet-stream")
+    transformed_url = request.url_for("get_blob", blob_id=blob_store.put(transformed, media_type))
 
     # Use the appropriate file extension for the download
     download_filename = f"transformed_{Path(image_name_display or 'image').stem}.{image_format.lower()}"
 
     # Render the result page with images and download link
-    return templates.TemplateResponse("transform_result.html", {
-        "request": request,
-        "image_name": image_name_display,
-        "original_b64": original_b64,
-        "transformed_b64": transformed_b64,
-        "download_filename": download_filename,
-        "image_format": image_format.lower(),
-        "color": color,
-        "brightness": brightness,
-        "contrast": contrast,
-        "sharpness": sharpness,
-    })
+    with stage("template_render"):
+        return templates.TemplateResponse("transform_result.html", {
+            "request": request,
+            "image_name": image_name_display,
+            "original_url": original_url,
+            "transformed_url": transformed_url,
+            "download_filename": download_filename,
+            "image_format": image_format.lower(),
+            "color": color,
+            "brightness": brightness,
+            "contrast": contrast,
+            "sharpness": sharpness,
+        })
@@ -0,0 +1,155 @@
+"""
+Ingestion of the uploaded images. The body of an upload is read in
+chunks, up to a maximum size, and its type is sniffed from the first
+bytes with a shared libmagic handle, so that invalid or oversized files
+are rejected before they are read entirely. The image size is checked
+from the header before decoding, to reject decompression bombs.
+
+The multipart form is parsed, and its files spooled, before the
+endpoints run, so the size of the whole request body is also limited by
+RequestSizeLimit, from its Content-Length and then on the stream.
+"""
+import threading
+from io import BytesIO
+
+from fastapi import UploadFile
+from fastapi.responses import JSONResponse
+from PIL import Image
+
+from app.config import Configuration
+
+
+conf = Configuration()
+
+# creating a libmagic handle loads its database, so a single handle is
+# shared, created on the first upload; libmagic handles are not
+# thread-safe, hence the lock
+_magic = None
+_magic_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """Raised when an upload is rejected, with the HTTP status to return."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RequestTooLarge(Exception):
+    """Raised on the request stream when the body exceeds its limit."""
+
+
+class RequestSizeLimit:
+    """ASGI middleware rejecting with 413 the requests whose body is larger
+    than max_bytes: at once if their Content-Length says so, otherwise as
+    soon as the body read from the stream exceeds it."""
+
+    def __init__(self, app, max_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        too_large = JSONResponse(status_code=413, content={"error": "The request is too large."})
+        headers = dict(scope["headers"])
+        try:
+            length = int(headers.get(b"content-length", 0))
+        except ValueError:
+            length = 0
+        if length > self.max_bytes:
+            await too_large(scope, receive, send)
+            return
+
+        received = 0
+        exceeded = False
+        started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    exceeded = True
+                    raise RequestTooLarge()
+            return message
+
+        async def limited_send(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                if exceeded:
+                    # the body parser turned the error into another response
+                    await too_large(scope, receive, send)
+            if not exceeded:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, limited_send)
+        except RequestTooLarge:
+            if started:
+                raise
+            await too_large(scope, receive, send)
+
+
+def sniff_mime_type(data: bytes) -> str:
+    """Returns the MIME type of a file from its first bytes."""
+    global _magic
+    with _magic_lock:
+        if _magic is None:
+            import magic
+
+            _magic = magic.Magic(mime=True)
+        return _magic.from_buffer(bytes(data[:conf.upload_sniff_bytes]))
+
+
+async def read_upload(file: UploadFile):
+    """Reads an uploaded image in chunks and returns its content and
+    MIME type. Raises UploadError if the file is larger than
+    conf.upload_max_bytes or is not an image."""
+    if file.size is not None and file.size > conf.upload_max_bytes:
+        raise UploadError("The uploaded file is too large.", status_code=413)
+
+    content = bytearray()
+    mime_type = None
+    while True:
+        chunk = await file.read(conf.upload_chunk_size)
+        if not chunk:
+            break
+        content += chunk
+        if len(content) > conf.upload_max_bytes:
+            raise UploadError("The uploaded file is too large.", status_code=413)
+        if mime_type is None and len(content) >= conf.upload_sniff_bytes:
+            mime_type = sniff_mime_type(content)
+            if not mime_type.startswith("image"):
+                raise UploadError("The uploaded file is not a valid image.", status_code=415)
+
+    if mime_type is None:
+        mime_type = sniff_mime_type(content)
+        if not mime_type.startswith("image"):
+            raise UploadError("The uploaded file is not a valid image.", status_code=415)
+    return bytes(content), mime_type
+
+
+def decode_image(content: bytes):
+    """Decodes an uploaded image. The dimensions are read from the header
+    first, and images with more than conf.upload_max_pixels pixels are
+    rejected before being decoded."""
+    try:
+        img = Image.open(BytesIO(content))
+    except Image.DecompressionBombError:
+        raise UploadError("The uploaded image is too large.", status_code=413)
+    except Exception:
+        raise UploadError("The uploaded file is not a valid image.", status_code=415)
+
+    width, height = img.size
+    if width * height > conf.upload_max_pixels:
+        raise UploadError("The uploaded image is too large.", status_code=413)
+    try:
+        img.load()
+    except Exception:
+        raise UploadError("The uploaded image could not be decoded.", status_code=415)
+    return img
@@ -1,5 +1,5 @@
-import os
 from pathlib import Path
+from app.catalog import catalog
 from app.config import Configuration
 
 conf = Configuration()
@@ -7,15 +7,7 @@ IMAGE_FOLDER = Path(Configuration.image_folder_path)
 
 def list_images():
 
-    """Returns the list of available images from the correct folder."""
-    supported_formats = (".JPEG", ".jpeg", ".jpg", ".png")
-    img_folder = conf.image_folder_path  # Ensure this is correctly set
-
-
-    if not os.path.exists(img_folder):
-        print(f"WARNING: Image folder '{img_folder}' does not exist.")
-        return []
-
-    return [f for f in os.listdir(img_folder) if f.endswith(supported_formats)]
+    """Returns the sorted list of available images from the image catalog."""
+    return list(catalog.names())
 
 #fixed for use more format
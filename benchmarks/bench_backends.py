@@ -0,0 +1,72 @@
+"""
+Compares the inference backends of each model with the eager float32
+baseline on the local gallery: top-1 agreement (same top class), top-5
+agreement (overlap of the top-5 classes) and speedup of a batched
+forward pass. The exported variants must have been prepared with
+app/prepare_models.py --backends ...:
+
+    python benchmarks/bench_backends.py --models vgg16 --images 64
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import Configuration
+from app.ml.backends import BACKENDS, CompiledModel, load_backend
+from app.ml.classification_utils import fetch_image, preprocess
+from app.utils import list_images
+
+
+def forward(model, inputs, batch_size):
+    """Returns the logits of the inputs and the mean time per batch."""
+    outputs = []
+    with torch.inference_mode():
+        model(inputs[:batch_size])
+        start = time.perf_counter()
+        for i in range(0, len(inputs), batch_size):
+            outputs.append(model(inputs[i:i + batch_size]))
+    n_batches = (len(inputs) + batch_size - 1) // batch_size
+    return torch.cat(outputs), (time.perf_counter() - start) / n_batches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--models", nargs="+", default=Configuration.models)
+    parser.add_argument("--backends", nargs="+", default=BACKENDS[1:], choices=BACKENDS[1:])
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--batch", type=int, default=8)
+    args = parser.parse_args()
+
+    images = [fetch_image(image_id).convert("RGB") for image_id in list_images()[:args.images]]
+    print(f"{len(images)} gallery images, batches of {args.batch}")
+    print(f"{'model':<14}{'backend':<22}{'ms/batch':>10}{'speedup':>9}{'top-1':>8}{'top-5':>8}")
+    for model_id in args.models:
+        inputs = torch.stack([preprocess(img, model_id) for img in images])
+        baseline, baseline_time = forward(load_backend(model_id, "eager"), inputs, args.batch)
+        reference = baseline.topk(5, dim=1).indices
+        print(f"{model_id:<14}{'eager':<22}{baseline_time * 1000:>10.1f}{1:>9.2f}{1:>8.3f}{1:>8.3f}")
+        for backend in args.backends:
+            model = load_backend(model_id, backend)
+            if not isinstance(model, CompiledModel):
+                print(f"{model_id:<14}{backend:<22}{'not exported':>10}")
+                continue
+            logits, elapsed = forward(model, inputs, args.batch)
+            top5 = logits.topk(5, dim=1).indices
+            top1_agreement = (top5[:, 0] == reference[:, 0]).float().mean().item()
+            top5_agreement = sum(
+                len(set(a) & set(b)) for a, b in zip(top5.tolist(), reference.tolist())
+            ) / reference.numel()
+            print(
+                f"{model_id:<14}{backend:<22}{elapsed * 1000:>10.1f}{baseline_time / elapsed:>9.2f}"
+                f"{top1_agreement:>8.3f}{top5_agreement:>8.3f}"
+            )
+            del model
+
+
+if __name__ == "__main__":
+    main()
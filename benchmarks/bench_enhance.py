@@ -0,0 +1,69 @@
+"""
+Compares the fused enhancement engine with the sequential ImageEnhance
+chain it replaces, on a gallery image or a synthetic one:
+
+    python benchmarks/bench_enhance.py --size 4000 3000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.enhancement import enhance, enhance_sequential
+
+# (color, brightness, contrast, sharpness)
+SETTINGS = (
+    (1.0, 1.0, 1.0, 1.0),
+    (1.5, 1.0, 1.0, 1.0),
+    (1.3, 1.2, 1.1, 1.0),
+    (0.5, 1.5, 2.0, 1.0),
+    (1.3, 1.2, 1.1, 1.5),
+)
+
+
+def load_image(path, size):
+    if path:
+        return Image.open(path).convert("RGB")
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    return Image.fromarray(noise).filter(ImageFilter.GaussianBlur(2))
+
+
+def timed(fn, img, factors, repeat):
+    """Returns the best time of fn over repeat runs, and its output."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(img, *factors)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--image", help="image to enhance, synthetic if omitted")
+    parser.add_argument("--size", type=int, nargs=2, default=(1920, 1080))
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    img = load_image(args.image, args.size)
+    img.load()
+    print(f"image {img.size[0]}x{img.size[1]} {img.mode}")
+    print(f"{'factors':<24}{'sequential ms':>15}{'fused ms':>10}{'speedup':>9}{'max diff':>10}")
+    for factors in SETTINGS:
+        reference_time, reference = timed(enhance_sequential, img, factors, args.repeat)
+        fused_time, fused = timed(enhance, img, factors, args.repeat)
+        diff = np.abs(np.asarray(fused, dtype=np.int16) - np.asarray(reference, dtype=np.int16)).max()
+        print(
+            f"{str(factors):<24}{reference_time * 1000:>15.1f}{fused_time * 1000:>10.1f}"
+            f"{reference_time / fused_time:>9.2f}{diff:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Measures the per-request overhead of the classification outside the
+forward pass: the preprocessing of an image and the post-processing of
+the logits, comparing the classification head with the previous code
+(labels read from disk, transforms rebuilt and a full sort for every
+request):
+
+    python benchmarks/bench_head.py --batch 16
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import Configuration
+from app.ml.head import get_head, get_labels, get_transform
+
+
+def previous_transform():
+    return transforms.Compose(
+        (
+            transforms.Resize(256),
+            transforms.CenterCrop(224),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+        )
+    )
+
+
+def previous_top_scores(out):
+    _, indices = torch.sort(out, descending=True)
+    percentage = torch.nn.functional.softmax(out, dim=0) * 100
+    labels_path = os.path.join(Configuration.image_folder_path, "imagenet_labels.json")
+    with open(labels_path) as f:
+        labels = json.load(f)
+    return [[labels[idx], percentage[idx].item()] for idx in indices[:5]]
+
+
+def timed(fn, repeat):
+    """Returns the mean time of fn in microseconds."""
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    img = Image.fromarray(rng.integers(0, 256, (375, 500, 3), dtype=np.uint8))
+    logits = torch.randn(args.batch, len(get_labels()))
+    head = get_head()
+    transform = get_transform()
+
+    rows = (
+        ("transform build", previous_transform, get_transform),
+        ("preprocess", lambda: previous_transform()(img), lambda: transform(img)),
+        (
+            f"post-process x{args.batch}",
+            lambda: [previous_top_scores(row) for row in logits],
+            lambda: head(logits),
+        ),
+    )
+    print(f"{'stage':<22}{'previous us':>14}{'head us':>12}")
+    for name, previous, current in rows:
+        print(f"{name:<22}{timed(previous, args.repeat):>14.1f}{timed(current, args.repeat):>12.1f}")
+
+    # the outputs must match the previous implementation
+    for row, output in zip(logits, head(logits)):
+        expected = previous_top_scores(row)
+        assert [label for label, _ in output] == [label for label, _ in expected]
+        assert np.allclose([s for _, s in output], [s for _, s in expected], atol=1e-4)
+
+
+if __name__ == "__main__":
+    main()
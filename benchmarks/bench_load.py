@@ -0,0 +1,129 @@
+"""
+End-to-end load test of the service, run in-process: the FastAPI app is
+driven through an httpx ASGI transport, without a server or network,
+by a given number of concurrent clients. Each endpoint is loaded in
+turn with requests on the gallery images, and its latencies (p50, p95,
+p99), throughput and error count are written as JSON, to be compared
+with benchmarks/compare.py:
+
+    python benchmarks/bench_load.py --concurrency 1 8 32 --requests 200 --output bench/load.json
+
+The result cache answers repeated classifications of the same image
+without running the models: use --no-result-cache to measure the
+inference path instead.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+# main.py resolves the static and template folders from the working directory
+os.chdir(ROOT)
+
+from app.config import Configuration
+from app.ml.result_cache import result_cache
+from app.utils import list_images
+from benchmarks.report import summarize, write_report
+from main import app
+
+
+ENDPOINTS = ("classifications", "custom_classifications", "histogram_json", "transform")
+
+
+def request_factories(images, model_id, uploads):
+    """Returns, for each endpoint, a function that sends the i-th request
+    of a load test with a client and returns the response."""
+    return {
+        "classifications": lambda client, i: client.post(
+            "/classifications",
+            data={"image_id": images[i % len(images)], "model_id": model_id},
+        ),
+        "custom_classifications": lambda client, i: client.post(
+            "/custom_classifications",
+            data={"model_id": model_id},
+            files={"file": ("upload.jpg", uploads[i % len(uploads)], "image/jpeg")},
+        ),
+        "histogram_json": lambda client, i: client.get(
+            "/histogram/json", params={"image_id": images[i % len(images)]}
+        ),
+        "transform": lambda client, i: client.post(
+            "/transform",
+            data={"image_name": images[i % len(images)], "color": 1.3, "brightness": 1.1,
+                  "contrast": 0.9, "sharpness": 1.5},
+        ),
+    }
+
+
+async def run_load(send, requests, concurrency, clear_cache):
+    """Sends requests with concurrency clients and returns the summary
+    of the latencies of the successful requests, with the errors."""
+    transport = httpx.ASGITransport(app=app)
+    counter = itertools.count()
+    latencies, errors = [], 0
+
+    async def client_loop(client):
+        nonlocal errors
+        for i in iter(lambda: next(counter), None):
+            if i >= requests:
+                return
+            if clear_cache:
+                result_cache.clear()
+            start = time.perf_counter()
+            response = await send(client, i)
+            elapsed = time.perf_counter() - start
+            if response.status_code < 400:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    summary = summarize(latencies, elapsed)
+    summary["errors"] = errors
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--endpoints", nargs="+", default=ENDPOINTS, choices=ENDPOINTS)
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="requests per run")
+    parser.add_argument("--model", default=Configuration.models[0])
+    parser.add_argument("--images", type=int, default=32, help="gallery images used")
+    parser.add_argument("--no-result-cache", action="store_true",
+                        help="empty the result cache before every request")
+    parser.add_argument("--output", default="bench/load.json")
+    args = parser.parse_args()
+
+    images = list_images()[:args.images]
+    uploads = []
+    for image_id in images[:8]:
+        with open(os.path.join(Configuration.image_folder_path, image_id), "rb") as f:
+            uploads.append(f.read())
+    factories = request_factories(images, args.model, uploads)
+
+    results = {}
+    print(f"{'endpoint':<24}{'clients':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'errors':>8}")
+    for endpoint in args.endpoints:
+        # one untimed request loads the model and warms up the caches
+        asyncio.run(run_load(factories[endpoint], 1, 1, False))
+        results[endpoint] = {}
+        for concurrency in args.concurrency:
+            s = asyncio.run(run_load(factories[endpoint], args.requests, concurrency, args.no_result_cache))
+            results[endpoint][str(concurrency)] = s
+            print(f"{endpoint:<24}{concurrency:>8}{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}"
+                  f"{s['p99_ms']:>10.1f}{s['throughput_rps']:>10.1f}{s['errors']:>8}")
+
+    write_report(args.output, "load", args, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Micro-benchmarks of the stages of the service, run in-process on the
+local gallery: classify_image for each model, cold (model loaded for
+the request) and warm (model already loaded, result cache empty), the
+preprocessing, cv2.calcHist and the histograms of an image, the
+enhancement chain, and the rendering of the charts. The results are
+written as JSON, to be compared with benchmarks/compare.py:
+
+    python benchmarks/bench_micro.py --models resnet18 --output bench/micro.json
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import Configuration
+from app.enhancement import enhance, enhance_sequential
+from app.histogram import CHANNELS, compute_histograms
+from app.ml.classification_utils import classify_image, fetch_image, preprocess
+from app.ml.model_registry import registry
+from app.ml.result_cache import result_cache
+from app.rendering import _histogram_png, _histogram_svg, _scores_png, _scores_svg
+from app.utils import list_images
+from benchmarks.report import summarize, write_report
+
+
+def measure(fn, repeat, setup=None):
+    """Calls fn repeat times, after a warm-up call, and returns the
+    summary of its latencies. setup is called, untimed, before each call."""
+    if setup is not None:
+        setup()
+    fn()
+    latencies = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def bench_classification(models, image_id, repeat):
+    """Returns the cold, warm and cached latencies of classify_image."""
+    results = {}
+    for model_id in models:
+        # cold: the request loads the model
+        registry.evict(model_id)
+        result_cache.clear()
+        start = time.perf_counter()
+        scores = classify_image(model_id, image_id)
+        cold = time.perf_counter() - start
+
+        classify = lambda: classify_image(model_id, image_id)
+        results[model_id] = {
+            "cold_ms": cold * 1e3,
+            "warm": measure(classify, repeat, setup=result_cache.clear),
+            "cached": measure(classify, repeat),
+        }
+        print(f"{model_id:<14}cold {cold * 1e3:9.1f} ms   warm p50 "
+              f"{results[model_id]['warm']['p50_ms']:8.1f} ms   top-1 {scores[0][0]}")
+        registry.evict(model_id)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--models", nargs="+", default=Configuration.models)
+    parser.add_argument("--image", default=None, help="gallery image (the first one by default)")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--batching", action="store_true",
+                        help="run the forward passes through the batch scheduler")
+    parser.add_argument("--output", default="bench/micro.json")
+    args = parser.parse_args()
+
+    Configuration.batching_enabled = args.batching
+    image_id = args.image or list_images()[0]
+    image_path = os.path.join(Configuration.image_folder_path, image_id)
+    img = fetch_image(image_id).convert("RGB")
+    gray = cv2.cvtColor(cv2.imread(image_path), cv2.COLOR_BGR2GRAY)
+    hist = compute_histograms(image_path)[CHANNELS.index("gray")].tolist()
+    scores = [[f"class {i}", 100 / (i + 1)] for i in range(5)]
+
+    results = {"classify_image": bench_classification(args.models, image_id, args.repeat)}
+    stages = {
+        "preprocess": lambda: preprocess(img),
+        "calcHist gray": lambda: cv2.calcHist([gray], [0], None, [256], [0, 256]),
+        "compute_histograms": lambda: compute_histograms(image_path),
+        "enhance": lambda: enhance(img, 1.3, 1.1, 0.9, 1.5),
+        "enhance sequential": lambda: enhance_sequential(img, 1.3, 1.1, 0.9, 1.5),
+        "scores chart png": lambda: _scores_png(scores, (8, 4)),
+        "scores chart svg": lambda: _scores_svg(scores, (8, 4)),
+        "histogram chart png": lambda: _histogram_png(hist, image_id, (6.4, 4.8)),
+        "histogram chart svg": lambda: _histogram_svg(hist, image_id, (6.4, 4.8)),
+    }
+    print(f"{'stage':<22}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, fn in stages.items():
+        results[name] = measure(fn, args.repeat)
+        s = results[name]
+        print(f"{name:<22}{s['p50_ms']:>10.2f}{s['p95_ms']:>10.2f}{s['p99_ms']:>10.2f}")
+
+    write_report(args.output, "micro", args, results)
+
+
+if __name__ == "__main__":
+    main()
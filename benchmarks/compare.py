@@ -0,0 +1,66 @@
+"""
+Compares two reports of bench_micro.py or bench_load.py, typically
+measured on two commits, and prints the change of every latency and
+throughput. Changes worse than --threshold percent are flagged, and the
+exit status is 1 if there is any, so the script can gate a CI job:
+
+    python benchmarks/compare.py bench/load-main.json bench/load.json --threshold 10
+"""
+import argparse
+import json
+import sys
+
+# metrics where a lower value is better; throughput is the only higher-is-better one
+LOWER_IS_BETTER = ("cold_ms", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms", "peak_rss_bytes")
+HIGHER_IS_BETTER = ("throughput_rps",)
+
+
+def flatten(results, prefix=""):
+    """Returns the numeric leaves of nested results, keyed by their path."""
+    values = {}
+    for key, value in results.items():
+        path = f"{prefix}/{key}" if prefix else key
+        if isinstance(value, dict):
+            values.update(flatten(value, path))
+        elif isinstance(value, (int, float)):
+            values[path] = value
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline["suite"] != current["suite"]:
+        sys.exit(f"Cannot compare a {baseline['suite']} report with a {current['suite']} report")
+
+    before = flatten(baseline["results"])
+    after = flatten(current["results"])
+    before["peak_rss_bytes"] = baseline["peak_rss_bytes"]
+    after["peak_rss_bytes"] = current["peak_rss_bytes"]
+
+    print(f"{baseline['commit']} -> {current['commit']}")
+    regressions = 0
+    for path in sorted(before.keys() & after.keys()):
+        metric = path.rsplit("/", 1)[-1]
+        if metric not in LOWER_IS_BETTER + HIGHER_IS_BETTER or not before[path]:
+            continue
+        change = (after[path] - before[path]) / before[path] * 100
+        worse = -change if metric in HIGHER_IS_BETTER else change
+        flag = ""
+        if worse > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{path:<56}{before[path]:>14.2f}{after[path]:>14.2f}{change:>+9.1f}%{flag}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Helpers shared by bench_micro.py and bench_load.py: latency summaries,
+peak memory and the JSON reports that compare.py reads. Every report
+records the commit it was measured on, so that two reports can be
+compared to find regressions.
+"""
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(sorted_values, q):
+    """Returns the q-th percentile (0-100) of sorted values, interpolated
+    linearly between the closest ranks."""
+    if not sorted_values:
+        return 0.0
+    rank = (len(sorted_values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+
+def summarize(latencies, elapsed=None):
+    """Returns the count, mean, p50/p95/p99 and max of a list of
+    latencies in seconds, in milliseconds, and the throughput if the
+    total elapsed time is given."""
+    values = sorted(latencies)
+    summary = {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values) * 1e3 if values else 0.0,
+        "p50_ms": percentile(values, 50) * 1e3,
+        "p95_ms": percentile(values, 95) * 1e3,
+        "p99_ms": percentile(values, 99) * 1e3,
+        "max_ms": values[-1] * 1e3 if values else 0.0,
+    }
+    if elapsed is not None:
+        summary["throughput_rps"] = len(values) / elapsed if elapsed > 0 else 0.0
+    return summary
+
+
+def peak_rss_bytes():
+    """Returns the peak resident memory of the process."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def git_commit():
+    """Returns the commit of the working tree, or None outside git."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_report(path, suite, args, results):
+    """Writes the results of a benchmark suite as JSON, with the commit,
+    the environment and the peak memory of the run."""
+    import torch
+
+    report = {
+        "suite": suite,
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "cpus": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "args": vars(args),
+        "peak_rss_bytes": peak_rss_bytes(),
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {path}")
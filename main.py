@@ -2,33 +2,63 @@ import os
 import sys
 import json
 import io
-import cv2
-import matplotlib
-matplotlib.use('Agg')  # Prevents GUI issues with matplotlib
-import matplotlib.pyplot as plt
 from pathlib import Path
+from typing import List
 import numpy as np
 from io import BytesIO
 import base64
+from contextlib import AsyncExitStack, asynccontextmanager
 from PIL import Image
-import magic
 
-from fastapi import FastAPI, Request, UploadFile, Form
-from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from fastapi import FastAPI, File, HTTPException, Query, Request, UploadFile, Form
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
 from app.config import Configuration
+from app.executors import (
+    ServiceOverloaded,
+    codec_pool,
+    configure_torch_threads,
+    inference_pool,
+    plot_pool,
+)
+from app import executors
+from app.admission import admission, served_headers
+from app.uploads import RequestSizeLimit, UploadError, decode_image, read_upload
+from app.catalog import catalog
 from app.utils import list_images, IMAGE_FOLDER
 from app.forms.classification_form import ClassificationForm
-from app.ml.classification_utils import classify_image
+from app.ml import batching
+from app.ml.model_registry import registry as model_registry
+from app.ml.result_cache import result_cache
 from app.transformation import router as transformation_router
+from app.preview import router as preview_router
+from app.batch_classification import router as batch_classification_router
+from app.blob_store import blob_store, router as blob_router
+from app.histogram import router as histogram_router
+from app.jobs import job_queue, router as jobs_router
+from app.similarity import router as similarity_router
+from app import metrics
+from app.http_cache import (
+    cached, compression_middleware, image_etag, image_last_modified, make_etag, not_modified,
+)
+from app.startup import classify_ensemble, router as startup_router, warmup
+from app.rendering import FORMATS, MEDIA_TYPES, chart_cache, render_scores_chart
 
 
 # Ensure `app/` is in the import path
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))  # Add `app/` to import path
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Starts the warm-up of the libraries and models in the background,
+    without delaying the startup of the server."""
+    warmup.start()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 config = Configuration()
 
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
@@ -36,14 +66,136 @@ templates = Jinja2Templates(directory="app/templates")
 
 IMAGE_FOLDER = Path(config.image_folder_path)
 
+configure_torch_threads()
+
+app.middleware("http")(compression_middleware)
+app.add_middleware(RequestSizeLimit, max_bytes=config.upload_max_request_bytes)
+if config.metrics_enabled:
+    app.middleware("http")(metrics.metrics_middleware)
+
+
+@app.exception_handler(ServiceOverloaded)
+def service_overloaded(request: Request, exc: ServiceOverloaded):
+    """Asks the client to retry later when a worker pool is full."""
+    return JSONResponse(
+        status_code=503,
+        content={"error": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
 @app.get("/info")
-def info() -> dict[str, list[str]]:
-    """Returns a dictionary with the list of models and
-    the list of available image files."""
-    list_of_images = list_images()
+def info(
+    request: Request,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(config.info_page_size, ge=0),
+    prefix: str = None,
+    class_id: str = None,
+):
+    """Returns a dictionary with the list of models and a page of
+    the available image files, optionally filtered by name prefix
+    or class, with the total number of matching images."""
+    etag = make_etag("info", catalog.generation(), Configuration.models, offset, limit, prefix, class_id)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    total, list_of_images = catalog.page(offset, limit, prefix, class_id)
     list_of_models = Configuration.models
-    data = {"models": list_of_models, "images": list_of_images}
-    return data
+    data = {
+        "models": list_of_models,
+        "images": list_of_images,
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+    }
+    return cached(JSONResponse(content=data), etag)
+
+
+@app.get("/info/{image_id}")
+async def image_info(image_id: str, request: Request):
+    """Returns the size, modification time, dimensions and content hash
+    of an image file."""
+    # the details depend on the file alone, so If-Modified-Since is honoured
+    etag, last_modified = image_etag(image_id, "details"), image_last_modified(image_id)
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
+    details = await codec_pool.run(catalog.details, image_id)
+    if details is None:
+        return JSONResponse(status_code=404, content={"error": "Image not found"})
+    return cached(JSONResponse(content=details), etag, last_modified)
+
+
+@app.get("/stats")
+def stats() -> dict:
+    """Returns the runtime counters of the service, such as the
+    hits, misses and load times of the model registry."""
+    return {
+        "models": model_registry.stats(),
+        "batching": batching.stats(),
+        "pools": executors.stats(),
+        "results": result_cache.stats(),
+        "charts": chart_cache.stats(),
+        "blobs": blob_store.stats(),
+        "catalog": catalog.stats(),
+        "warmup": warmup.stats(),
+        "jobs": job_queue.stats(),
+        "admission": admission.stats(),
+    }
+
+
+def service_metrics():
+    """Returns the queue depths, cache hit ratios and memory of the
+    components of the service, for /metrics."""
+    pools = executors.stats()
+    schedulers = batching.stats()
+    models = model_registry.stats()
+    results = result_cache.stats()
+    charts = chart_cache.stats()
+    jobs = job_queue.stats()
+    limiters = admission.stats()
+    chart_lookups = charts["hits"] + charts["misses"]
+    return [
+        ("pool_in_flight", "gauge", "Tasks running or queued in each worker pool.",
+         [({"pool": name}, s["in_flight"]) for name, s in pools.items()]),
+        ("pool_rejected_total", "counter", "Tasks rejected by each full worker pool.",
+         [({"pool": name}, s["rejected"]) for name, s in pools.items()]),
+        ("batch_queue_depth", "gauge", "Inputs waiting to be batched, by model.",
+         [({"model": name}, s["queue_depth"]) for name, s in schedulers.items()]),
+        ("admission_running", "gauge", "Classifications running, by model.",
+         [({"model": name}, s["running"]) for name, s in limiters["models"].items()]),
+        ("admission_queued", "gauge", "Classifications waiting for a slot, by model.",
+         [({"model": name}, s["queued"]) for name, s in limiters["models"].items()]),
+        ("admission_rejected_total", "counter", "Classifications not admitted, by model.",
+         [({"model": name}, s["rejected"]) for name, s in limiters["models"].items()]),
+        ("admission_degraded_total", "counter", "Requests answered by a degraded classification.",
+         [({"policy": name}, count) for name, count in limiters["degraded"].items()]),
+        ("jobs_queued", "gauge", "Jobs waiting in the job queue.",
+         [({}, jobs["queued"])]),
+        ("jobs_running", "gauge", "Jobs being run by the job workers.",
+         [({}, jobs["running"])]),
+        ("batch_mean_size", "gauge", "Mean size of the batched forward passes, by model.",
+         [({"model": name}, s["mean_batch_size"]) for name, s in schedulers.items()]),
+        ("cache_hit_ratio", "gauge", "Hit ratio of the caches of the service.", [
+            ({"cache": "results"}, results["hit_ratio"]),
+            ({"cache": "charts"}, charts["hits"] / chart_lookups if chart_lookups else 0.0),
+        ]),
+        ("cache_entries", "gauge", "Entries held by the caches of the service.", [
+            ({"cache": "results"}, results["entries"]),
+            ({"cache": "charts"}, charts["entries"]),
+        ]),
+        ("model_registry_hits_total", "counter", "Requests for models already loaded.",
+         [({}, models["hits"])]),
+        ("model_registry_misses_total", "counter", "Requests that loaded a model.",
+         [({}, models["misses"])]),
+        ("model_registry_bytes", "gauge", "Memory used by the loaded models.",
+         [({}, models["nbytes"])]),
+        ("blob_store_bytes", "gauge", "Memory used by the blob store.",
+         [({}, blob_store.stats()["nbytes"])]),
+    ]
+
+
+metrics.register_collector(service_metrics)
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -72,21 +224,92 @@ async def request_classification(request: Request):
     await form.load_data()
     image_id = form.image_id
     model_id = form.model_id
-    classification_scores = classify_image(model_id=model_id, img_id=image_id)
-    return templates.TemplateResponse(
-        "classification_output.html",
-        {
-            "request": request,
-            "image_id": image_id,
-            "model_id": model_id,
-            "classification_scores": json.dumps(classification_scores),
-        },
-    )
+    if image_id not in catalog:
+        return JSONResponse(status_code=404, content={"error": "Image not found"})
+    classification_scores, served = await admission.classify(model_id, image_id)
+    with metrics.stage("template_render"):
+        return templates.TemplateResponse(
+            "classification_output.html",
+            {
+                "request": request,
+                "image_id": image_id,
+                "model_id": served["model"],
+                "requested_model_id": model_id,
+                "degraded": served["degraded"],
+                "classification_scores": json.dumps(classification_scores),
+            },
+            headers=served_headers(served),
+        )
+
+
+@app.post("/classifications/ensemble")
+async def ensemble_classification(
+    model_ids: List[str] = Form([]),
+    image_id: str = Form(None),
+    file: UploadFile = File(None),
+):
+    """
+    Classifies a gallery image, or an uploaded one, with several models
+    at once, decoding and resizing the image only once.
+
+    Args:
+        model_ids (List[str]): The models to compare, all the configured ones by default.
+        image_id (str): The gallery image to classify.
+        file (UploadFile): An uploaded image to classify instead.
+
+    Returns:
+        dict: The top-k scores of each model, and the top-k of the averaged
+        probabilities of the models under "ensemble".
+    """
+    model_ids = model_ids or list(Configuration.models)
+    unknown_models = [m for m in model_ids if m not in Configuration.models]
+    if unknown_models:
+        return JSONResponse(status_code=400, content={"error": f"Unknown models: {unknown_models}"})
+    image = None
+    if file is not None and file.filename:
+        try:
+            file_content, _ = await read_upload(file)
+            image = await codec_pool.run(decode_image, file_content)
+        except UploadError as e:
+            return JSONResponse(status_code=e.status_code, content={"error": str(e)})
+        image_id = file.filename
+    elif image_id not in catalog:
+        return JSONResponse(status_code=404, content={"error": "Image not found"})
+    # an ensemble holds a slot of each of its models, and is not degraded
+    async with AsyncExitStack() as slots:
+        for model_id in dict.fromkeys(model_ids):
+            await slots.enter_async_context(admission.slot(model_id))
+        if image is not None:
+            scores = await inference_pool.run(classify_ensemble, model_ids, None, custom_img_id=image)
+        else:
+            scores = await inference_pool.run(classify_ensemble, model_ids, image_id)
+    return {"image_id": image_id, **scores}
 
 
 #2
 app.include_router(transformation_router)
 
+# previews of the transformations
+app.include_router(preview_router)
+
+# batch classification API
+app.include_router(batch_classification_router)
+
+# uploaded and transformed images
+app.include_router(blob_router)
+
+# metrics in the Prometheus text format
+app.include_router(metrics.router)
+
+# readiness of the service
+app.include_router(startup_router)
+
+# asynchronous jobs
+app.include_router(jobs_router)
+
+# similarity search over the gallery embeddings
+app.include_router(similarity_router)
+
 #4-upload-image-button
 @app.get("/custom_classifications")
 def create_classify(request: Request):
@@ -121,35 +344,20 @@ async def upload_file(file: UploadFile, request: Request):
         TemplateResponse: A rendered template showing the classification results.
     """
     try:
-        # Read the uploaded file content
-        file_content = await file.read()
-
-        # Detect the MIME type of the uploaded file
-        mime = magic.Magic(mime=True)
-        file_type = mime.from_buffer(file_content)
-
-        # Ensure the uploaded file is an image
-        if not file_type.startswith("image"):
-            raise ValueError("The uploaded file is not a valid image.")
-
-        # Load the image from memory
-        image_buffer = BytesIO(file_content)
-        image = Image.open(image_buffer)
-
-        # Convert the image to PNG format and store it in memory
-        png_stream = BytesIO()
-        image.save(png_stream, format="PNG")
+        # Read the uploaded file content, ensuring it is an image
+        file_content, mime_type = await read_upload(file)
 
-        # Encode the image in base64 to be used in HTML
-        encoded_image = base64.b64encode(png_stream.getvalue()).decode("utf-8")
-        data_url = f"data:image/png;base64,{encoded_image}"
+        # Decode the image, and keep the uploaded file in the blob store,
+        # from where the HTML page and the download buttons reference it
+        image = await codec_pool.run(decode_image, file_content)
+        blob_id = blob_store.put(file_content, mime_type)
 
         # Load selected model and perform classification
         form = ClassificationForm(request)
         await form.load_data()
         model_id = form.model_id
-        classification_scores = classify_image(
-            model_id=model_id, img_id=None, custom_img_id=image
+        classification_scores, served = await admission.classify(
+            model_id, img_id=None, custom_img_id=image
         )
 
         # Render the classification results
@@ -157,10 +365,18 @@ async def upload_file(file: UploadFile, request: Request):
             "custom_classification_output.html",
             {
                 "request": request,
-                "image_id": data_url,
+                "image_id": blob_id,
+                "model_id": served["model"],
+                "requested_model_id": model_id,
+                "degraded": served["degraded"],
                 "classification_scores": json.dumps(classification_scores),
             },
+            headers=served_headers(served),
         )
+    except ServiceOverloaded:
+        raise
+    except UploadError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e)})
     except Exception as e:
         return {"error": f"An error occurred during the image upload: {str(e)}"}
 
@@ -169,6 +385,40 @@ async def upload_file(file: UploadFile, request: Request):
 def is_base64_image(data: str) -> bool:
     return data.startswith("data:image")
 
+
+def decode_data_url(data_url: str):
+    """Decodes the image contained in a base64 data URL."""
+    header, encoded = data_url.split(",", 1)
+    image_data = base64.b64decode(encoded)
+    return Image.open(BytesIO(image_data))
+
+
+async def compute_scores(image_id: str, model_id: str):
+    """Classifies a gallery image, an image of the blob store or an image
+    sent as a data URL, without blocking the event loop. Returns the
+    scores and the model that answered, as reported by admission control."""
+    if blob_store.is_blob_id(image_id):
+        blob = blob_store.get(image_id)
+        if blob is None:
+            raise HTTPException(status_code=404, detail="Image expired or not found")
+        img = await codec_pool.run(decode_image, blob.data)
+    elif is_base64_image(image_id):
+        img = await codec_pool.run(decode_data_url, image_id)
+    elif image_id in catalog:
+        return await admission.classify(model_id, image_id)
+    else:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return await admission.classify(model_id, None, custom_img_id=img)
+
+def scores_etag(request: Request, image_id: str, model_id: str, *parts):
+    """Returns the ETag of the scores of a gallery image requested with
+    GET, which depend only on the image file, the model and its backend,
+    or None."""
+    if request.method != "GET" or model_id not in Configuration.models:
+        return None
+    backend = Configuration.model_backends.get(model_id, "eager")
+    return image_etag(image_id, "scores", model_id, backend, Configuration.top_k, *parts)
+
 @app.api_route("/download/json", methods=["GET", "POST"])
 async def download_json(
     request: Request,
@@ -183,63 +433,61 @@ async def download_json(
         model_id = form.get("model_id")
         classification_scores = form.get("classification_scores")
 
+    # gallery images requested with GET are answered with 304 when the
+    # client already has the results
+    etag = scores_etag(request, image_id, model_id)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+
     # If data already calculated
+    headers = {"Content-Disposition": "attachment; filename=results.json"}
     if classification_scores:
         scores = json.loads(classification_scores)
     else:
-        if is_base64_image(image_id):
-            header, encoded = image_id.split(",", 1)
-            image_data = base64.b64decode(encoded)
-            img = Image.open(BytesIO(image_data))
-            scores = classify_image(model_id=model_id, img_id=None, custom_img_id=img)
-        else:
-            scores = classify_image(model_id=model_id, img_id=image_id)
+        scores, served = await compute_scores(image_id, model_id)
+        headers.update(served_headers(served))
+        if served["degraded"] is not None:
+            # a degraded result is not the one named by the ETag
+            etag = None
 
-    headers = {"Content-Disposition": "attachment; filename=results.json"}
-    return JSONResponse(content=scores, headers=headers)
+    return cached(JSONResponse(content=scores, headers=headers), etag)
 
 @app.api_route("/download/plot", methods=["GET", "POST"])
 async def download_plot(
     request: Request,
     image_id: str = None,
     model_id: str = None,
-    classification_scores: str = Form(None)
+    classification_scores: str = Form(None),
+    format: str = "png",
 ):
     if request.method == "POST":
         form = await request.form()
         image_id = form.get("image_id")
         model_id = form.get("model_id")
         classification_scores = form.get("classification_scores")
+        format = form.get("format", format)
+
+    if format not in FORMATS:
+        return JSONResponse(status_code=400, content={"error": f"Unknown format {format}"})
+
+    etag = scores_etag(request, image_id, model_id, format)
+    response = not_modified(request, etag, media_type=MEDIA_TYPES[format])
+    if response is not None:
+        return response
 
+    headers = {"Content-Disposition": f"attachment; filename=results_plot.{format}"}
     if classification_scores:
         scores = dict(json.loads(classification_scores))
     else:
-        if is_base64_image(image_id):
-            header, encoded = image_id.split(",", 1)
-            image_data = base64.b64decode(encoded)
-            img = Image.open(BytesIO(image_data))
-            scores = classify_image(model_id=model_id, img_id=None, custom_img_id=img)
-        else:
-            scores = classify_image(model_id=model_id, img_id=image_id)
-
-    classification_dict = dict(scores)
-    sorted_items = sorted(classification_dict.items(), key=lambda x: x[1], reverse=True)[:5]
-    labels, values = zip(*sorted_items) if sorted_items else ([], [])
-
-    fig, ax = plt.subplots(figsize=(8, 4))
-    ax.bar(labels, values)
-    ax.set_title("Top 5 Classification Scores")
-    ax.set_xlabel("Class")
-    ax.set_ylabel("Score")
+        scores, served = await compute_scores(image_id, model_id)
+        headers.update(served_headers(served))
+        if served["degraded"] is not None:
+            etag = None
 
-    buf = io.BytesIO()
-    plt.tight_layout()
-    plt.savefig(buf, format="png")
-    plt.close(fig)
-    buf.seek(0)
+    buf = io.BytesIO(await plot_pool.run(render_scores_chart, scores, format))
 
-    headers = {"Content-Disposition": "attachment; filename=results_plot.png"}
-    return StreamingResponse(buf, media_type="image/png", headers=headers)
+    return cached(StreamingResponse(buf, media_type=MEDIA_TYPES[format], headers=headers), etag)
 
 
 # The application can be run with a command such as:
@@ -247,50 +495,4 @@ async def download_plot(
 
 #1
 # Register the histogram API routes
-#app.include_router(histogram_router) #questa linea se con modifiche in file esterno
-
-@app.get("/histogram", response_class=HTMLResponse, name="get_histogram_page")
-def get_histogram_page(request: Request):
-    return templates.TemplateResponse(
-        "histogram_select.html",
-        {
-            "request": request,
-            "images": list_images()
-        }
-    )
-
-@app.get("/histogram/json", response_class=JSONResponse)
-def get_histogram_json(image_id: str):
-    image_path = Path(IMAGE_FOLDER) / image_id
-    if not image_path.exists():
-        return JSONResponse(status_code=404, content={"error": "Image not found"})
-
-    image = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
-    hist = cv2.calcHist([image], [0], None, [256], [0, 256])
-    return {
-        "image_id": image_id,
-        "histogram": hist.flatten().tolist()
-    }
-
-@app.get("/histogram/image")
-def get_histogram_image(image_id: str):
-    image_path = Path(IMAGE_FOLDER) / image_id
-    if not image_path.exists():
-        return JSONResponse(status_code=404, content={"error": "Image not found"})
-
-    image = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
-    hist = cv2.calcHist([image], [0], None, [256], [0, 256])
-
-    plt.figure()
-    plt.plot(hist, color='black')
-    plt.xlabel('Pixel Value')
-    plt.ylabel('Frequency')
-    plt.title(f'Histogram of {image_id}')
-
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format='png')
-    buffer.seek(0)
-    plt.close()
-
-    return Response(content=buffer.getvalue(), media_type="image/png")
-
+app.include_router(histogram_router)